@@ -22,7 +22,7 @@ import streamlit as st
 from datetime import datetime
 import subprocess
 import atexit
-from src.gui_utils import inizializza, crea_sidebar, generate_response, mostra_cronologia_chat
+from src.gui_utils import inizializza, crea_sidebar, generate_response, mostra_cronologia_chat, mostra_metriche_streaming
 from src.providers.base import Provider
 
 # Avvia sqlite-web in background all'avvio dell'applicazione
@@ -51,7 +51,7 @@ provider_scelto, messaggio_di_sistema = crea_sidebar(st.session_state.providers)
 
 provider : Provider = providers[provider_scelto]                         
 if provider.disponibile():
-    mostra_cronologia_chat(provider.get_cronologia_messaggi())
+    mostra_cronologia_chat(provider.get_cronologia_messaggi(), chiave_finestra=f"{provider_scelto}_{provider.get_modello_scelto()}")
     prompt = st.chat_input("Scrivi il tuo messaggio...", accept_file="multiple")
     if prompt: # invia il messaggio al modello e carica la cronologia comprensiva di risposta
         try:
@@ -63,6 +63,7 @@ if provider.disponibile():
             try: # Aggiunge alla cronologia a schermo anche l'ultimo messaggio inviato dall'utente e la relativa risposta del modello
                 messaggi_da_mostrare=-2 if messaggio_di_sistema.strip()=="" else -3
                 mostra_cronologia_chat(provider.get_cronologia_messaggi()[messaggi_da_mostrare:])
+                mostra_metriche_streaming()
             except Exception as e:
                 with st.chat_message("assistant"):
                     st.exception(e)
@@ -1,12 +1,33 @@
 # Classe usata solo per tornare gli allegati alla GUI
 class Allegato():
-    
-    def __init__(self, tipo="", contenuto="", mime_type="", filename=""):
+
+    def __init__(self, tipo="", contenuto="", mime_type="", filename="", caricatore=None, impronta=None):
         self.tipo=tipo
-        self.contenuto=contenuto
+        self._contenuto=contenuto
+        # funzione che legge il contenuto dal DB alla prima richiesta (per gli allegati caricati dal DB)
+        self._caricatore=caricatore
         self.mime_type=mime_type
         self.filename=filename
-        
+        # sha256 dei byte del contenuto (per gli allegati caricati dal DB è quello del blob)
+        self.impronta=impronta
+
+    @property
+    def contenuto(self):
+        if self._caricatore is not None:
+            self._contenuto=self._caricatore()
+            self._caricatore=None
+        return self._contenuto
+
+    @contenuto.setter
+    def contenuto(self, contenuto):
+        self._contenuto=contenuto
+        self._caricatore=None
+        self.impronta=None
+
+    def caricato(self) -> bool:
+        """Ritorna True se il contenuto è già in memoria."""
+        return self._caricatore is None
+
     def to_dict(self):
         return {
             "tipo": self.tipo,
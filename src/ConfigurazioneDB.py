@@ -9,13 +9,22 @@ Sostituisce le vecchie classi:
 """
 
 import json
+import gzip
 import base64
+import hashlib
+import os
+import shutil
+import logging
+import time
 from datetime import datetime
+from functools import partial
+from peewee import fn, chunked, SQL
+from playhouse.migrate import SqliteMigrator, migrate
 from src.Messaggio import Messaggio
 from src.Allegato import Allegato
 from src.models import (
     db, BaseModel, ProviderModel, ConfigurazioneRagModel,
-    ModelloModel, ChatModel, MessaggioModel, AllegatoModel,
+    ModelloModel, ChatModel, MessaggioModel, AllegatoModel, BlobModel,
     MessaggioInChatModel, ToolModel, MCPServerModel
 )
 
@@ -26,11 +35,60 @@ class ConfigurazioneDB:
     Gestisce provider, RAG, cronologia chat, allegati e tools.
     """
     
+    # tipi di allegato il cui contenuto è testo (per gli altri è una stringa base64)
+    TIPI_TESTUALI = ("text", "text-plain", "url")
+    # oltre questa dimensione (in byte) il contenuto di un blob viene scritto su disco invece che nel database
+    SOGLIA_BLOB_SU_DISCO = 1024 * 1024
+    DIRECTORY_BLOB = "blobs"
+    # i file in DIRECTORY_BLOB senza blob nel database vengono eliminati solo dopo questo tempo (in secondi):
+    # uno più recente può appartenere a una transazione non ancora conclusa
+    ETA_MINIMA_FILE_ORFANI = 3600
+    # righe scritte da ogni insert_many (SQLite limita il numero di parametri di un'istruzione)
+    RIGHE_PER_INSERIMENTO = 100
+    # messaggi scritti in ogni transazione durante l'importazione delle chat
+    MESSAGGI_PER_TRANSAZIONE = 500
+    # valore di export_type nell'intestazione delle esportazioni NDJSON
+    FORMATO_NDJSON = 'chat_ndjson'
+    
+    _db_aggiornato = False  # tabelle create e migrate in questo processo
+    
     @classmethod
     def inizializza_db(cls):
-        """Inizializza il database creando tutte le tabelle"""
+        """
+        Apre la connessione al database. Al primo utilizzo nel processo crea le tabelle mancanti,
+        aggiunge le colonne nuove a quelle esistenti e sposta nei blob gli allegati salvati in base64.
+        """
         db.connect(reuse_if_open=True)
-        BaseModel.create_tables()
+        if not cls._db_aggiornato:
+            # le colonne vanno aggiunte prima di create_tables, che crea anche gli indici su quelle colonne
+            cls._aggiungi_colonne_mancanti()
+            BaseModel.create_tables()
+            cls._migra_allegati_in_blob()
+            cls._db_aggiornato = True
+    
+    @classmethod
+    def _aggiungi_colonne_mancanti(cls):
+        """
+        Aggiunge alle tabelle esistenti le colonne dei modelli che non contengono ancora:
+        create_tables non modifica le tabelle già presenti. Le colonne aggiunte ai modelli
+        devono quindi ammettere NULL o avere un valore di default, e i loro indici vanno
+        dichiarati in Meta.indexes (li crea create_tables).
+        """
+        migrator = SqliteMigrator(db)
+        operazioni = []
+        tabelle = set(db.get_tables())
+        for modello in BaseModel.__subclasses__():
+            tabella = modello._meta.table_name
+            if tabella not in tabelle:
+                continue  # verrà creata da create_tables
+            esistenti = {colonna.name for colonna in db.get_columns(tabella)}
+            for campo in modello._meta.sorted_fields:
+                if campo.column_name not in esistenti:
+                    logging.info(f"[DB] Aggiungo la colonna {campo.column_name} alla tabella {tabella}")
+                    operazioni.append(migrator.add_column(tabella, campo.column_name, campo))
+        if operazioni:
+            with db.atomic():
+                migrate(*operazioni)
     
     @classmethod
     def chiudi_db(cls):
@@ -52,7 +110,8 @@ class ConfigurazioneDB:
             base_url: URL base del provider
             api_key: API key del provider
             modello: Modello corrente selezionato
-            rag_config: Configurazione RAG (dict con chiavi: attivo, modello, top_k, directory_allegati, modalita_ricerca)
+            rag_config: Configurazione RAG (dict con chiavi: attivo, modello, top_k, directory_allegati, modalita_ricerca,
+                        rerank, budget_rerank_ms, lambda_mmr, fetch_k, corpora)
         
         Returns:
             Istanza di ProviderModel salvata
@@ -101,7 +160,12 @@ class ConfigurazioneDB:
                 'modello': None,
                 'top_k': 5,
                 'directory_allegati': 'uploads',
-                'modalita_ricerca': 'similarity'
+                'modalita_ricerca': 'similarity',
+                'rerank': False,
+                'budget_rerank_ms': 1500,
+                'lambda_mmr': 0.3,
+                'fetch_k': 0,
+                'corpora': []
             }
             
             return config
@@ -127,7 +191,12 @@ class ConfigurazioneDB:
                 'modello': None,
                 'top_k': 5,
                 'directory_allegati': 'uploads',
-                'modalita_ricerca': 'similarity'
+                'modalita_ricerca': 'similarity',
+                'rerank': False,
+                'budget_rerank_ms': 1500,
+                'lambda_mmr': 0.3,
+                'fetch_k': 0,
+                'corpora': []
             }
             providers.append(config)
         
@@ -169,7 +238,12 @@ class ConfigurazioneDB:
             modello=config.get('modello'),
             top_k=config.get('top_k', 5),
             directory_allegati=config.get('directory_allegati', 'uploads'),
-            modalita_ricerca=config.get('modalita_ricerca', 'similarity')
+            modalita_ricerca=config.get('modalita_ricerca', 'similarity'),
+            rerank=config.get('rerank', False),
+            budget_rerank_ms=config.get('budget_rerank_ms', 1500),
+            lambda_mmr=config.get('lambda_mmr', 0.3),
+            fetch_k=config.get('fetch_k', 0),
+            corpora=json.dumps(config.get('corpora') or [])
         )
     
     @classmethod
@@ -207,154 +281,344 @@ class ConfigurazioneDB:
         )
         return [m.id for m in modelli]
     
+    # ==================== GESTIONE BLOB DEGLI ALLEGATI ====================
+    
+    @classmethod
+    def _contenuto_in_bytes(cls, tipo: str, contenuto) -> bytes:
+        """Converte il contenuto di un Allegato (base64 o testo, a seconda del tipo) nei byte grezzi."""
+        if isinstance(contenuto, bytes):
+            return contenuto
+        if tipo in cls.TIPI_TESTUALI:
+            return (contenuto or "").encode("utf-8")
+        return base64.b64decode(contenuto or "")
+    
+    @classmethod
+    def _bytes_in_contenuto(cls, tipo: str, dati: bytes) -> str:
+        """Operazione inversa di _contenuto_in_bytes: ritorna il contenuto nel formato usato da Allegato."""
+        if tipo in cls.TIPI_TESTUALI:
+            return dati.decode("utf-8")
+        return base64.b64encode(dati).decode("ascii")
+    
+    @classmethod
+    def _salva_blob(cls, dati: bytes) -> str:
+        """
+        Memorizza il contenuto se non è già presente e ne incrementa i riferimenti.
+        Ritorna lo sha256 con cui l'allegato fa riferimento al blob.
+        """
+        impronta = hashlib.sha256(dati).hexdigest()
+        if BlobModel.update(riferimenti=BlobModel.riferimenti + 1).where(BlobModel.hash == impronta).execute():
+            return impronta
+        percorso = None
+        if len(dati) > cls.SOGLIA_BLOB_SU_DISCO:
+            # il file viene scritto prima del commit: se la transazione viene annullata resta senza blob
+            # e lo elimina raccogli_blob_orfani()
+            percorso = os.path.join(cls.DIRECTORY_BLOB, impronta[:2], impronta)
+            os.makedirs(os.path.dirname(percorso), exist_ok=True)
+            with open(f"{percorso}.tmp", "wb") as f:
+                f.write(dati)
+            os.replace(f"{percorso}.tmp", percorso)
+        BlobModel.create(
+            hash=impronta,
+            dimensione=len(dati),
+            contenuto=None if percorso else dati,
+            percorso=percorso,
+            riferimenti=1
+        )
+        return impronta
+    
+    @classmethod
+    def _leggi_blob(cls, impronta: str) -> bytes:
+        """Ritorna i byte grezzi di un blob, dal database o dal disco."""
+        blob = BlobModel.get_by_id(impronta)
+        if blob.percorso:
+            with open(blob.percorso, "rb") as f:
+                return f.read()
+        return bytes(blob.contenuto)
+    
+    @classmethod
+    def _elimina_allegati(cls, condizione):
+        """Elimina gli allegati che soddisfano la condizione e rilascia i blob che usavano."""
+        impronte = [a.blob_hash for a in AllegatoModel.select(AllegatoModel.blob_hash)
+                    .where(condizione & AllegatoModel.blob_hash.is_null(False))]
+        AllegatoModel.delete().where(condizione).execute()
+        for impronta in impronte:
+            BlobModel.update(riferimenti=BlobModel.riferimenti - 1).where(BlobModel.hash == impronta).execute()
+    
+    @staticmethod
+    def _id_allegato(msg_id: str, timestamp: datetime, indice: int) -> str:
+        # msg_id è lo stesso per tutti i messaggi di una chat (provider-modello): serve anche il timestamp
+        return hashlib.sha1(f"{msg_id}|{timestamp.isoformat()}|{indice}".encode("utf-8")).hexdigest()
+    
+    @classmethod
+    def _migra_allegati_in_blob(cls):
+        """
+        Sposta nei blob il contenuto degli allegati salvati in base64 nella tabella allegato.
+        Un allegato non convertibile (es. base64 corrotto) viene segnalato nel log e lasciato com'è:
+        non deve impedire l'avvio dell'applicazione.
+        """
+        da_migrare = [a.id for a in AllegatoModel.select(AllegatoModel.id)
+                      .where(AllegatoModel.blob_hash.is_null() & (AllegatoModel.contenuto != ''))]
+        if not da_migrare:
+            return
+        migrati = 0
+        with db.atomic():
+            for id_allegato in da_migrare:
+                try:
+                    # savepoint: un errore annulla solo la migrazione di questo allegato
+                    with db.atomic():
+                        allegato = AllegatoModel.get_by_id(id_allegato)
+                        impronta = cls._salva_blob(cls._contenuto_in_bytes(allegato.tipo, allegato.contenuto))
+                        AllegatoModel.update(blob_hash=impronta, contenuto='').where(AllegatoModel.id == id_allegato).execute()
+                    migrati += 1
+                except Exception as e:
+                    logging.warning(f"[DB] Allegato {id_allegato} non spostato nei blob: {e}")
+        if not migrati:
+            return
+        # VACUUM restituisce al filesystem lo spazio occupato dal vecchio base64
+        db.execute_sql("VACUUM")
+        logging.info(f"[DB] Spostati nei blob {migrati} allegati su {len(da_migrare)}")
+    
+    @classmethod
+    def raccogli_blob_orfani(cls) -> int:
+        """
+        Elimina gli allegati dei messaggi che non appartengono più a nessuna chat, ricalcola i riferimenti
+        dei blob ed elimina (dal database e dal disco) quelli non più usati da nessun allegato.
+        Elimina anche i file in DIRECTORY_BLOB senza blob nel database (es. scritti da una transazione
+        annullata). Ritorna il numero di blob eliminati.
+        """
+        cls.inizializza_db()
+        with db.atomic():
+            in_chat = MessaggioInChatModel.select().where(
+                (MessaggioInChatModel.messaggio_id == AllegatoModel.messaggio_id) &
+                (MessaggioInChatModel.messaggio_timestamp == AllegatoModel.messaggio_timestamp)
+            )
+            AllegatoModel.delete().where(~fn.EXISTS(in_chat)).execute()
+            BlobModel.update(riferimenti=(
+                AllegatoModel.select(fn.COUNT(AllegatoModel.id)).where(AllegatoModel.blob_hash == BlobModel.hash)
+            )).execute()
+            orfani = list(BlobModel.select(BlobModel.hash, BlobModel.percorso).where(BlobModel.riferimenti <= 0))
+            BlobModel.delete().where(BlobModel.riferimenti <= 0).execute()
+            usati = {os.path.normpath(p) for (p,) in BlobModel.select(BlobModel.percorso)
+                     .where(BlobModel.percorso.is_null(False)).tuples()}
+        for blob in orfani:
+            if blob.percorso and os.path.exists(blob.percorso):
+                os.remove(blob.percorso)
+                if not os.listdir(os.path.dirname(blob.percorso)):
+                    os.rmdir(os.path.dirname(blob.percorso))
+        if orfani:
+            logging.info(f"[DB] Eliminati {len(orfani)} blob non più usati")
+        cls._elimina_file_blob_orfani(usati)
+        return len(orfani)
+    
+    @classmethod
+    def _elimina_file_blob_orfani(cls, usati: set[str]):
+        """Elimina i file in DIRECTORY_BLOB più vecchi di ETA_MINIMA_FILE_ORFANI che nessun blob usa."""
+        if not os.path.isdir(cls.DIRECTORY_BLOB):
+            return
+        limite = time.time() - cls.ETA_MINIMA_FILE_ORFANI
+        eliminati = 0
+        for radice, _, nomi_file in os.walk(cls.DIRECTORY_BLOB, topdown=False):
+            for nome_file in nomi_file:
+                percorso = os.path.normpath(os.path.join(radice, nome_file))
+                try:
+                    if percorso not in usati and os.path.getmtime(percorso) < limite:
+                        os.remove(percorso)
+                        eliminati += 1
+                except OSError:
+                    pass  # file eliminato nel frattempo o non accessibile
+            try:
+                if radice != cls.DIRECTORY_BLOB and not os.listdir(radice):
+                    os.rmdir(radice)
+            except OSError:
+                pass
+        if eliminati:
+            logging.info(f"[DB] Eliminati {eliminati} file senza blob da {cls.DIRECTORY_BLOB}")
+    
     # ==================== GESTIONE CRONOLOGIA CHAT ====================
     
     @classmethod
-    def salva_chat(cls, provider: str, modello: str, cronologia: list[Messaggio]):
+    def salva_chat(cls, provider: str, modello: str, cronologia: list[Messaggio]) -> int:
         """
-        Salva la cronologia di una chat.
+        Salva la cronologia di una chat in un'unica transazione.
+        Se i messaggi già salvati sono l'inizio della cronologia vengono scritti solo quelli successivi,
+        altrimenti (chat ripulita, messaggi diversi, ...) la chat viene riscritta da capo.
         
         Args:
             provider: Nome del provider
             modello: ID del modello
             cronologia: Lista di oggetti Messaggio
+        
+        Returns:
+            Numero di messaggi scritti
         """
         cls.inizializza_db()
         
-        # Assicurati che provider e modello esistano
+        with db.atomic():
+            chat = cls._ottieni_chat(provider, modello)
+            
+            # Timestamp dei messaggi già salvati, in ordine
+            salvati = [timestamp for (timestamp,) in (MessaggioInChatModel
+                       .select(MessaggioInChatModel.messaggio_timestamp)
+                       .where(MessaggioInChatModel.chat == chat)
+                       .order_by(MessaggioInChatModel.messaggio_timestamp)
+                       .tuples())]
+            riscritta = [cls._timestamp(m) for m in cronologia[:len(salvati)]] != salvati
+            if riscritta:
+                # Elimina i messaggi esistenti per questa chat e salva tutta la cronologia
+                MessaggioInChatModel.delete().where(
+                    MessaggioInChatModel.chat == chat
+                ).execute()
+                nuovi = cronologia
+            else:
+                nuovi = cronologia[len(salvati):]
+            cls._inserisci_messaggi(chat, nuovi)
+        
+        # i messaggi tolti dalla chat possono aver lasciato allegati e blob inutilizzati
+        if riscritta and salvati:
+            cls.raccogli_blob_orfani()
+        return len(nuovi)
+    
+    @staticmethod
+    def _ottieni_chat(provider: str, modello: str) -> ChatModel:
+        """Ritorna la chat del provider e del modello, creando se mancano anche il provider e il modello."""
         ProviderModel.get_or_create(nome=provider, defaults={
             'base_url': '',
             'api_key': ''
         })
         ModelloModel.get_or_create(id=modello, defaults={'provider': provider})
-        
-        # Ottieni o crea la chat
         chat, _ = ChatModel.get_or_create(
             provider=provider,
             modello=modello
         )
-        
-        # Elimina i messaggi esistenti per questa chat
-        MessaggioInChatModel.delete().where(
-            MessaggioInChatModel.chat == chat
-        ).execute()
-        
-        # Salva i nuovi messaggi
-        for mess in cronologia:
+        return chat
+    
+    @classmethod
+    def _inserisci_messaggi(cls, chat: ChatModel, messaggi: list[Messaggio]):
+        """
+        Inserisce i messaggi e i loro allegati con insert_many e li collega alla chat. Va chiamato dentro db.atomic().
+        I messaggi già presenti (stesso id e timestamp) vengono solo collegati alla chat: i loro allegati,
+        che non cambiano, vengono riscritti solo se sono diversi nel numero.
+        """
+        if not messaggi:
+            return
+        
+        # Numero di allegati già salvati per ogni messaggio (id, timestamp)
+        allegati_salvati = {(msg_id, timestamp): n for msg_id, timestamp, n in (AllegatoModel
+                            .select(AllegatoModel.messaggio_id, AllegatoModel.messaggio_timestamp, fn.COUNT(AllegatoModel.id))
+                            .where(AllegatoModel.messaggio_id.in_({m.get_id() for m in messaggi}))
+                            .group_by(AllegatoModel.messaggio_id, AllegatoModel.messaggio_timestamp)
+                            .tuples())}
+        
+        righe_messaggi, righe_collegamenti, righe_allegati = [], [], []
+        for mess in messaggi:
             msg_id = mess.get_id()
-            ruolo = mess.get_ruolo()
-            testo = mess.get_testo()
-            timestamp = mess.timestamp()
-            
-            if isinstance(timestamp, str):
-                timestamp = datetime.fromisoformat(timestamp)
-            
-            # Salva il messaggio
-            MessaggioModel.insert(
-                id=msg_id,
-                timestamp=timestamp,
-                ruolo=ruolo,
-                contenuto=testo
-            ).on_conflict_ignore().execute()
-            
-            # Collega il messaggio alla chat
-            MessaggioInChatModel.create(
-                chat=chat,
-                messaggio_id=msg_id,
-                messaggio_timestamp=timestamp
-            )
+            timestamp = cls._timestamp(mess)
+            righe_messaggi.append({
+                'id': msg_id,
+                'timestamp': timestamp,
+                'ruolo': mess.get_ruolo(),
+                'contenuto': mess.get_testo()
+            })
+            righe_collegamenti.append({
+                'chat': chat,
+                'messaggio_id': msg_id,
+                'messaggio_timestamp': timestamp
+            })
             
-            # Elimina gli allegati esistenti per questo messaggio
-            AllegatoModel.delete().where(
-                (AllegatoModel.messaggio_id == msg_id) &
-                (AllegatoModel.messaggio_timestamp == timestamp)
-            ).execute()
+            allegati = mess.get_allegati()
+            if allegati_salvati.get((msg_id, timestamp), 0) == len(allegati):
+                continue
+            if (msg_id, timestamp) in allegati_salvati:
+                cls._elimina_allegati((AllegatoModel.messaggio_id == msg_id) & (AllegatoModel.messaggio_timestamp == timestamp))
             
-            # Salva i nuovi allegati
-            for idx, allegato in enumerate(mess.get_allegati()):
-                contenuto = allegato.contenuto
-                tipo = allegato.tipo
-                
-                # Il contenuto è già nel formato corretto:
-                # - base64 string per file binari (image, video, audio, file)
-                # - testo plain per file di testo
-                # Non serve ricodificare
-                
-                AllegatoModel.create(
-                    id=f"{msg_id}-{idx}",  # Usa indice invece di timestamp
-                    messaggio_id=msg_id,
-                    messaggio_timestamp=timestamp,
-                    tipo=tipo,
-                    mime_type=allegato.mime_type,
-                    contenuto=contenuto,
-                    filename=allegato.filename
-                )
+            # Il contenuto degli allegati va nei blob come byte grezzi, condiviso tra allegati uguali
+            for idx, allegato in enumerate(allegati):
+                righe_allegati.append({
+                    'id': cls._id_allegato(msg_id, timestamp, idx),
+                    'messaggio_id': msg_id,
+                    'messaggio_timestamp': timestamp,
+                    'tipo': allegato.tipo,
+                    'mime_type': allegato.mime_type,
+                    'blob_hash': cls._salva_blob(cls._contenuto_in_bytes(allegato.tipo, allegato.contenuto)),
+                    'filename': allegato.filename
+                })
+        
+        for lotto in chunked(righe_messaggi, cls.RIGHE_PER_INSERIMENTO):
+            MessaggioModel.insert_many(lotto).on_conflict_ignore().execute()
+        for lotto in chunked(righe_collegamenti, cls.RIGHE_PER_INSERIMENTO):
+            MessaggioInChatModel.insert_many(lotto).on_conflict_ignore().execute()
+        for lotto in chunked(righe_allegati, cls.RIGHE_PER_INSERIMENTO):
+            AllegatoModel.insert_many(lotto).execute()
+    
+    @staticmethod
+    def _timestamp(messaggio: Messaggio) -> datetime:
+        timestamp = messaggio.timestamp()
+        return datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp
     
     @classmethod
     def carica_cronologia(cls, provider: str, modello: str) -> list[Messaggio]:
         """
-        Carica la cronologia di una chat.
+        Carica la cronologia di una chat con due query: una per i messaggi e una per i dati degli allegati.
+        Il contenuto degli allegati non viene letto: ogni Allegato lo legge dai blob alla prima richiesta
+        (quando il messaggio viene mostrato o inviato al modello).
         
         Returns:
             Lista di oggetti Messaggio
         """
         cls.inizializza_db()
         
-        try:
-            chat = ChatModel.get(
-                (ChatModel.provider == provider) &
-                (ChatModel.modello == modello)
-            )
-        except ChatModel.DoesNotExist:
-            return []
-        
-        # Carica i messaggi ordinati per timestamp
-        messaggi_in_chat = (MessaggioInChatModel
-                           .select()
-                           .where(MessaggioInChatModel.chat == chat)
-                           .order_by(MessaggioInChatModel.messaggio_timestamp))
-        
-        messaggi = []
-        for mic in messaggi_in_chat:
-            # Carica il messaggio
-            msg = MessaggioModel.get(
-                (MessaggioModel.id == mic.messaggio_id) &
-                (MessaggioModel.timestamp == mic.messaggio_timestamp)
-            )
-            
-            # Carica gli allegati
-            allegati_db = AllegatoModel.select().where(
-                (AllegatoModel.messaggio_id == msg.id) &
-                (AllegatoModel.messaggio_timestamp == msg.timestamp)
-            )
-            
-            allegati = []
-            for a in allegati_db:
-                contenuto = a.contenuto
-                tipo = a.tipo
-                
-                # Il contenuto è già in formato corretto dal DB:
-                # - base64 string per file binari (image, video, audio, file)
-                # - testo plain per file di testo
-                # Non decodificare, mantieni il formato originale
-                
-                allegati.append(Allegato(
-                    tipo=tipo,
-                    contenuto=contenuto,
-                    mime_type=a.mime_type,
-                    filename=a.filename
-                ))
-            
+        # Messaggi della chat ordinati per timestamp
+        righe_messaggi = (MessaggioModel
+                          .select(MessaggioModel.id, MessaggioModel.timestamp, MessaggioModel.ruolo, MessaggioModel.contenuto)
+                          .join(MessaggioInChatModel, on=(
+                              (MessaggioInChatModel.messaggio_id == MessaggioModel.id) &
+                              (MessaggioInChatModel.messaggio_timestamp == MessaggioModel.timestamp)))
+                          .join(ChatModel, on=(MessaggioInChatModel.chat == ChatModel.id))
+                          .where((ChatModel.provider == provider) & (ChatModel.modello == modello))
+                          .order_by(MessaggioModel.timestamp)
+                          .tuples())
+        
+        messaggi, allegati_per_messaggio = [], {}
+        for msg_id, timestamp, ruolo, testo in righe_messaggi:
+            allegati = allegati_per_messaggio.setdefault((msg_id, timestamp), [])
             messaggi.append(Messaggio(
-                testo=msg.contenuto,
-                ruolo=msg.ruolo,
+                testo=testo,
+                ruolo=ruolo,
                 allegati=allegati,
-                timestamp=msg.timestamp,  # Passa datetime direttamente, non la stringa ISO
-                id=msg.id
+                timestamp=timestamp,  # Passa datetime direttamente, non la stringa ISO
+                id=msg_id
+            ))
+        if not messaggi:
+            return []
+        
+        # Allegati dei messaggi caricati, nell'ordine in cui sono stati salvati
+        righe_allegati = (AllegatoModel
+                          .select(AllegatoModel.messaggio_id, AllegatoModel.messaggio_timestamp, AllegatoModel.tipo,
+                                  AllegatoModel.mime_type, AllegatoModel.filename, AllegatoModel.blob_hash, AllegatoModel.contenuto)
+                          .where(AllegatoModel.messaggio_id.in_({m.get_id() for m in messaggi}) &
+                                 AllegatoModel.messaggio_timestamp.between(messaggi[0].timestamp(), messaggi[-1].timestamp()))
+                          .order_by(SQL('rowid'))
+                          .tuples())
+        for msg_id, timestamp, tipo, mime_type, filename, blob_hash, contenuto in righe_allegati:
+            if (msg_id, timestamp) not in allegati_per_messaggio:
+                continue  # allegato di un messaggio di un'altra chat
+            allegati_per_messaggio[(msg_id, timestamp)].append(Allegato(
+                tipo=tipo,
+                # gli allegati salvati prima dei blob hanno ancora il contenuto nella tabella
+                contenuto=contenuto,
+                mime_type=mime_type,
+                filename=filename,
+                caricatore=partial(cls._leggi_contenuto, tipo, blob_hash) if blob_hash else None,
+                impronta=blob_hash
             ))
         
         return messaggi
     
+    @classmethod
+    def _leggi_contenuto(cls, tipo: str, impronta: str) -> str:
+        # Allegato vuole il contenuto in base64 per i file binari e in chiaro per i file di testo
+        return cls._bytes_in_contenuto(tipo, cls._leggi_blob(impronta))
+    
     @classmethod
     def cancella_chat(cls, provider: str, modello: str):
         """Cancella la cronologia di una chat"""
@@ -367,7 +631,8 @@ class ConfigurazioneDB:
             )
             chat.delete_instance(recursive=True)
         except ChatModel.DoesNotExist:
-            pass
+            return
+        cls.raccogli_blob_orfani()
     
     @classmethod
     def ritorna_chat_recenti(cls) -> list[tuple]:
@@ -637,8 +902,10 @@ class ConfigurazioneDB:
         cls.inizializza_db()
         
         # Elimina in ordine per rispettare le foreign keys
-        # 1. Elimina allegati
+        # 1. Elimina allegati e blob
         AllegatoModel.delete().execute()
+        BlobModel.delete().execute()
+        shutil.rmtree(cls.DIRECTORY_BLOB, ignore_errors=True)
         
         # 2. Elimina relazioni messaggio-chat
         MessaggioInChatModel.delete().execute()
@@ -654,6 +921,112 @@ class ConfigurazioneDB:
     
     # ==================== UTILITY ====================
     
+    @classmethod
+    def esporta_chat_ndjson(cls):
+        """
+        Generatore che esporta le chat in formato NDJSON, una riga (in bytes) alla volta:
+        un'intestazione, poi per ogni chat una riga "chat" seguita da una riga "messaggio" per ogni messaggio.
+        In memoria c'è sempre una sola chat (senza il contenuto degli allegati, letto un messaggio alla volta).
+        """
+        cls.inizializza_db()
+        yield cls._riga_ndjson({'export_date': datetime.now().isoformat(), 'export_type': cls.FORMATO_NDJSON})
+        for provider, modello in cls.ritorna_chat_recenti():
+            yield cls._riga_ndjson({'chat': {'provider': provider, 'modello': modello}})
+            for m in cls.carica_cronologia(provider, modello):
+                yield cls._riga_ndjson({'messaggio': {
+                    'id': m.get_id(),
+                    'ruolo': m.get_ruolo(),
+                    'testo': m.get_testo(),
+                    'timestamp': m.timestamp().isoformat() if isinstance(m.timestamp(), datetime) else m.timestamp(),
+                    'allegati': [
+                        {
+                            'tipo': a.tipo,
+                            'mime_type': a.mime_type,
+                            'filename': a.filename,
+                            'contenuto': a.contenuto
+                        }
+                        for a in m.get_allegati()
+                    ]
+                }})
+    
+    @classmethod
+    def esporta_chat_gzip(cls, destinazione):
+        """Scrive nel file (aperto in binario) destinazione l'esportazione NDJSON delle chat compressa con gzip."""
+        with gzip.GzipFile(fileobj=destinazione, mode='wb') as compresso:
+            for riga in cls.esporta_chat_ndjson():
+                compresso.write(riga)
+    
+    @staticmethod
+    def _riga_ndjson(dati: dict) -> bytes:
+        return (json.dumps(dati, ensure_ascii=False) + "\n").encode('utf-8')
+    
+    @classmethod
+    def importa_chat(cls, sorgente) -> int:
+        """
+        Importa le chat da un file (aperto in binario) esportato con esporta_chat_gzip/esporta_chat_ndjson,
+        compresso o no, oppure con il vecchio esporta_chat_json. Il formato NDJSON viene letto una riga alla
+        volta e scritto sul DB in transazioni da MESSAGGI_PER_TRANSAZIONE messaggi; i messaggi già presenti
+        vengono saltati, quindi importare due volte lo stesso file non crea doppioni.
+        
+        Returns:
+            Numero di messaggi letti
+        """
+        cls.inizializza_db()
+        if sorgente.read(2) == b'\x1f\x8b':  # intestazione gzip
+            sorgente.seek(0)
+            sorgente = gzip.GzipFile(fileobj=sorgente, mode='rb')
+        else:
+            sorgente.seek(0)
+        
+        try:
+            intestazione = json.loads(sorgente.readline())
+        except ValueError:
+            intestazione = None
+        if not isinstance(intestazione, dict) or intestazione.get('export_type') != cls.FORMATO_NDJSON:
+            # vecchio formato: un unico documento JSON indentato
+            sorgente.seek(0)
+            return cls.importa_chat_json(sorgente.read().decode('utf-8'))
+        
+        chat, lotto, letti = None, [], 0
+        for riga in sorgente:
+            if not riga.strip():
+                continue
+            dati = json.loads(riga)
+            if 'chat' in dati:
+                cls._importa_lotto(chat, lotto)
+                chat, lotto = dati['chat'], []
+            elif 'messaggio' in dati and chat is not None:
+                lotto.append(cls._messaggio_da_dict(dati['messaggio']))
+                letti += 1
+                if len(lotto) >= cls.MESSAGGI_PER_TRANSAZIONE:
+                    cls._importa_lotto(chat, lotto)
+                    lotto = []
+        cls._importa_lotto(chat, lotto)
+        return letti
+    
+    @classmethod
+    def _importa_lotto(cls, chat: dict | None, messaggi: list[Messaggio]):
+        if chat is None or not messaggi:
+            return
+        with db.atomic():
+            cls._inserisci_messaggi(cls._ottieni_chat(chat['provider'], chat['modello']), messaggi)
+    
+    @staticmethod
+    def _messaggio_da_dict(msg_data: dict) -> Messaggio:
+        allegati = [Allegato(
+            tipo=all_data['tipo'],
+            contenuto=all_data['contenuto'],
+            mime_type=all_data.get('mime_type'),
+            filename=all_data.get('filename')
+        ) for all_data in msg_data.get('allegati', [])]
+        return Messaggio(
+            testo=msg_data['testo'],
+            ruolo=msg_data['ruolo'],
+            allegati=allegati,
+            timestamp=msg_data['timestamp'],
+            id=msg_data['id']
+        )
+    
     @classmethod
     def esporta_chat_json(cls) -> str:
         """Esporta solo le chat (cronologia messaggi) in formato JSON"""
@@ -695,49 +1068,27 @@ class ConfigurazioneDB:
         return json.dumps(data, indent=2, ensure_ascii=False)
     
     @classmethod
-    def importa_chat_json(cls, json_data: str):
+    def importa_chat_json(cls, json_data: str) -> int:
         """
         Importa le chat da un file JSON esportato.
         
         Args:
             json_data: Stringa JSON con i dati delle chat da importare
+        
+        Returns:
+            Numero di messaggi letti
         """
         cls.inizializza_db()
         data = json.loads(json_data)
         
+        letti = 0
         for chat in data.get('chats', []):
-            provider = chat['provider']
-            modello = chat['modello']
-            messaggi = []
-            
-            for msg_data in chat.get('messaggi', []):
-                allegati = []
-                for all_data in msg_data.get('allegati', []):
-                    contenuto = all_data['contenuto']
-                    tipo = all_data['tipo']
-                    
-                    # Il contenuto è già nel formato corretto dal JSON:
-                    # - base64 string per file binari
-                    # - testo plain per file di testo
-                    # Non decodificare, mantieni il formato originale
-                    
-                    allegati.append(Allegato(
-                        tipo=tipo,
-                        contenuto=contenuto,
-                        mime_type=all_data.get('mime_type'),
-                        filename=all_data.get('filename')
-                    ))
-                
-                messaggi.append(Messaggio(
-                    testo=msg_data['testo'],
-                    ruolo=msg_data['ruolo'],
-                    allegati=allegati,
-                    timestamp=msg_data['timestamp'],
-                    id=msg_data['id']
-                ))
-            
+            # Il contenuto degli allegati è già nel formato di Allegato: base64 per i file binari, testo per i file di testo
+            messaggi = [cls._messaggio_da_dict(msg_data) for msg_data in chat.get('messaggi', [])]
             if messaggi:
-                cls.salva_chat(provider, modello, messaggi)
+                cls.salva_chat(chat['provider'], chat['modello'], messaggi)
+            letti += len(messaggi)
+        return letti
     
     @classmethod
     def esporta_json(cls) -> str:
@@ -777,6 +1128,8 @@ class ConfigurazioneDB:
         """Elimina tutte le tabelle dal database"""
         cls.inizializza_db()
         BaseModel.drop_tables()
+        shutil.rmtree(cls.DIRECTORY_BLOB, ignore_errors=True)
+        cls._db_aggiornato = False
 
 
 # Made with Bob
\ No newline at end of file
@@ -0,0 +1,281 @@
+"""
+Benchmark di DAPABot.
+
+Uso (dalla directory principale del progetto):
+    uv run python -m src.bench startup [--ripetizioni N] [--output file.json]
+    uv run python -m src.bench mmr [--candidati N] [--dimensione D] [--k K] [--lambda L] [--ripetizioni N] [--output file.json]
+
+Il benchmark "startup" misura l'avvio a freddo, separatamente:
+- il costo di import di ogni modulo in src.providers.* e src.tools.*, ognuno in un
+  interprete nuovo così che i tempi non dipendano dall'ordine di import;
+- le fasi di bootstrap dell'applicazione eseguite da inizializza():
+  ConfigurazioneDB.inizializza_db(), Rag.init_vectorstore_cache(),
+  Loader.discover_tools(), Loader.discover_providers() e il bootstrap del manager MCP.
+Il benchmark "mmr" confronta la MMR vettorizzata del RAG (src.providers.rag_ricerca.mmr) con
+quella di langchain_chroma usata in precedenza, sugli stessi embedding casuali.
+Il risultato è un JSON da conservare per confrontare le release tra loro.
+"""
+
+import argparse, json, os, pkgutil, platform, statistics, subprocess, sys, time, tomllib
+from datetime import datetime
+from pathlib import Path
+
+# numero di dipendenze più pesanti da riportare per ogni modulo
+NUM_DIPENDENZE_PESANTI = 5
+
+# __import__ invece di importlib.import_module: solo il primo passa dal meccanismo di import
+# che registra i tempi di -X importtime anche per il modulo richiesto
+_CODICE_IMPORT = """
+import json, sys, time
+inizio = time.perf_counter()
+errore = None
+try:
+    __import__(sys.argv[1])
+except Exception as e:
+    errore = f"{type(e).__name__}: {e}"
+print(json.dumps({"secondi": time.perf_counter() - inizio, "errore": errore}))
+"""
+
+
+def _elenca_moduli() -> list[str]:
+    """Elenca i moduli dei package src.providers e src.tools senza importarli."""
+    radice = Path(__file__).parent
+    moduli = []
+    for package in ("providers", "tools"):
+        for _, nome, _ in pkgutil.iter_modules([str(radice / package)]):
+            moduli.append(f"src.{package}.{nome}")
+    return sorted(moduli)
+
+
+def _dipendenze_pesanti(stderr: str, modulo: str) -> list[dict]:
+    """
+    Estrae dall'output di "python -X importtime" le dipendenze dirette del modulo con il
+    tempo cumulativo più alto. Ogni riga ha il formato
+        "import time: <self us> | <cumulative us> | <indentazione><nome>"
+    e i moduli importati da un altro vengono stampati, più indentati, prima di esso.
+    """
+    dirette = []
+    for riga in stderr.splitlines():
+        if not riga.startswith("import time:") or "cumulative" in riga:
+            continue
+        try:
+            _, cumulativo, nome = riga[len("import time:"):].split("|")
+        except ValueError:
+            continue
+        livello = (len(nome) - len(nome.lstrip()) - 1) // 2
+        if livello == 1:
+            dirette.append({"modulo": nome.strip(), "secondi": int(cumulativo) / 1_000_000})
+        elif livello == 0:
+            if nome.strip() == modulo:
+                break
+            dirette = []
+    dirette.sort(key=lambda v: v["secondi"], reverse=True)
+    return dirette[:NUM_DIPENDENZE_PESANTI]
+
+
+def _esegui_import(modulo: str, importtime: bool = False) -> tuple[dict, str]:
+    """Importa il modulo in un interprete nuovo e ritorna (risultato, stderr)."""
+    comando = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", _CODICE_IMPORT, modulo]
+    processo = subprocess.run(comando, capture_output=True, text=True, cwd=Path(__file__).parent.parent)
+    try:
+        return json.loads(processo.stdout.strip().splitlines()[-1]), processo.stderr
+    except (IndexError, json.JSONDecodeError):
+        errore = processo.stderr.strip().splitlines()[-1] if processo.stderr.strip() else "nessun output"
+        return {"secondi": None, "errore": errore}, processo.stderr
+
+
+def misura_import(modulo: str, ripetizioni: int = 1) -> dict:
+    """
+    Misura il tempo di import di un modulo, con un interprete nuovo per ogni ripetizione.
+    Il dettaglio delle dipendenze viene raccolto con un'esecuzione in più, non conteggiata
+    nei tempi perché -X importtime rallenta leggermente l'import.
+    """
+    risultato, stderr = _esegui_import(modulo, importtime=True)
+    if risultato["errore"]:
+        return {"secondi_min": None, "secondi_mediana": None, "dipendenze_piu_pesanti": [], "errore": risultato["errore"]}
+    dipendenze = _dipendenze_pesanti(stderr, modulo)
+    tempi = []
+    for _ in range(ripetizioni):
+        risultato, _ = _esegui_import(modulo)
+        if risultato["errore"]:
+            break
+        tempi.append(risultato["secondi"])
+    return {
+        "secondi_min": min(tempi) if tempi else None,
+        "secondi_mediana": statistics.median(tempi) if tempi else None,
+        "dipendenze_piu_pesanti": dipendenze,
+        "errore": risultato["errore"]
+    }
+
+
+def _rss_mb() -> float | None:
+    """Ritorna il picco di memoria residente del processo in MB (non disponibile su Windows)."""
+    try:
+        import resource
+        picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # su macOS ru_maxrss è in byte, su Linux in KB
+        return round(picco / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        return None
+
+
+def _fase_db():
+    from src.ConfigurazioneDB import ConfigurazioneDB
+    ConfigurazioneDB.inizializza_db()
+
+
+def _fase_vectorstore():
+    from src.providers.rag import Rag
+    Rag.init_vectorstore_cache()
+
+
+def _fase_tools():
+    from src.tools.loader import Loader
+    return len(Loader.discover_tools())
+
+
+def _fase_providers():
+    from src.providers.loader import Loader
+    return len(Loader.discover_providers())
+
+
+def _fase_mcp():
+    from src.mcp.client import get_mcp_client_manager
+    manager = get_mcp_client_manager()
+    manager.carica_configurazioni_da_db()
+    return len(manager.get_server_names())
+
+
+# Le fasi vengono eseguite nello stesso ordine di inizializza() in gui_utils.py
+FASI = [
+    ("ConfigurazioneDB.inizializza_db", _fase_db),
+    ("Rag.init_vectorstore_cache", _fase_vectorstore),
+    ("tools.Loader.discover_tools", _fase_tools),
+    ("providers.Loader.discover_providers", _fase_providers),
+    ("mcp.bootstrap_manager", _fase_mcp),
+]
+
+
+def misura_fasi() -> list[dict]:
+    """
+    Esegue le fasi di bootstrap nel processo corrente, in ordine, misurandone la durata.
+    I tempi includono l'import dei moduli necessari a ciascuna fase: una fase che riusa
+    moduli già importati da quelle precedenti risulterà quindi più veloce.
+    """
+    risultati = []
+    for nome, fase in FASI:
+        inizio = time.perf_counter()
+        errore, elementi = None, None
+        try:
+            elementi = fase()
+        except Exception as e:
+            errore = f"{type(e).__name__}: {e}"
+        risultati.append({
+            "fase": nome,
+            "secondi": time.perf_counter() - inizio,
+            "elementi": elementi,
+            "rss_mb": _rss_mb(),
+            "errore": errore
+        })
+    return risultati
+
+
+def _versione() -> str:
+    try:
+        with open(Path(__file__).parent.parent / "pyproject.toml", "rb") as f:
+            return tomllib.load(f)["project"]["version"]
+    except Exception:
+        return ""
+
+
+def bench_startup(ripetizioni: int = 1) -> dict:
+    """Esegue il benchmark completo di avvio e ritorna il risultato come dizionario."""
+    moduli = {modulo: misura_import(modulo, ripetizioni) for modulo in _elenca_moduli()}
+    fasi = misura_fasi()
+    return {
+        "benchmark": "startup",
+        "versione": _versione(),
+        "data": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "piattaforma": platform.platform(),
+        "ripetizioni_import": ripetizioni,
+        "import_moduli": moduli,
+        "fasi": fasi,
+        "totale_fasi_secondi": sum(f["secondi"] for f in fasi)
+    }
+
+
+def _misura(funzione, ripetizioni: int) -> dict:
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        funzione()
+        tempi.append(time.perf_counter() - inizio)
+    return {"secondi_min": min(tempi), "secondi_mediana": statistics.median(tempi)}
+
+
+def bench_mmr(candidati: int = 200, dimensione: int = 384, k: int = 5, lambda_mult: float = 0.3,
+              ripetizioni: int = 20) -> dict:
+    """
+    Misura la MMR su `candidati` embedding casuali di `dimensione` componenti (384 come all-MiniLM-L6-v2).
+    Riporta anche se le due implementazioni scelgono gli stessi chunk.
+    """
+    import numpy as np
+    from langchain_chroma.vectorstores import maximal_marginal_relevance
+    from src.providers.rag_ricerca import mmr
+
+    generatore = np.random.default_rng(0)
+    embeddings = generatore.standard_normal((candidati, dimensione)).astype(np.float32)
+    query = generatore.standard_normal(dimensione).astype(np.float32)
+    lista = embeddings.tolist()  # langchain_chroma riceve la lista degli embedding letti da Chroma
+
+    vettorizzata = mmr(query, embeddings, k, lambda_mult)
+    precedente = maximal_marginal_relevance(query, lista, lambda_mult=lambda_mult, k=k)
+    return {
+        "benchmark": "mmr",
+        "versione": _versione(),
+        "data": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "piattaforma": platform.platform(),
+        "parametri": {"candidati": candidati, "dimensione": dimensione, "k": k, "lambda_mult": lambda_mult,
+                      "ripetizioni": ripetizioni},
+        "vettorizzata": _misura(lambda: mmr(query, embeddings, k, lambda_mult), ripetizioni),
+        "langchain_chroma": _misura(lambda: maximal_marginal_relevance(query, lista, lambda_mult=lambda_mult, k=k), ripetizioni),
+        "stessi_risultati": [int(i) for i in vettorizzata] == [int(i) for i in precedente]
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="dapabot bench", description="Benchmark di DAPABot")
+    sottocomandi = parser.add_subparsers(dest="comando", required=True)
+    startup = sottocomandi.add_parser("startup", help="Misura l'avvio a freddo e il costo di import dei moduli")
+    startup.add_argument("--ripetizioni", type=int, default=1,
+                         help="Numero di misure per ogni import (viene riportata anche la mediana)")
+    startup.add_argument("--output", default="", help="File JSON di destinazione (default: stdout)")
+    bench_mmr_parser = sottocomandi.add_parser("mmr", help="Confronta la MMR vettorizzata con quella di langchain_chroma")
+    bench_mmr_parser.add_argument("--candidati", type=int, default=200, help="Numero di embedding candidati")
+    bench_mmr_parser.add_argument("--dimensione", type=int, default=384, help="Dimensione degli embedding")
+    bench_mmr_parser.add_argument("--k", type=int, default=5, help="Numero di chunk da scegliere")
+    bench_mmr_parser.add_argument("--lambda", dest="lambda_mult", type=float, default=0.3, help="Peso della rilevanza (0-1)")
+    bench_mmr_parser.add_argument("--ripetizioni", type=int, default=20, help="Numero di misure per implementazione")
+    bench_mmr_parser.add_argument("--output", default="", help="File JSON di destinazione (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.comando == "startup":
+        risultato = bench_startup(ripetizioni=max(1, args.ripetizioni))
+    elif args.comando == "mmr":
+        risultato = bench_mmr(candidati=args.candidati, dimensione=args.dimensione, k=args.k,
+                              lambda_mult=args.lambda_mult, ripetizioni=max(1, args.ripetizioni))
+    testo = json.dumps(risultato, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(testo)
+    else:
+        print(testo)
+    return 0
+
+
+if __name__ == "__main__":
+    # Come in dapabot.py, la telemetria di mcp-use viene disabilitata prima di qualsiasi import
+    os.environ.setdefault("MCP_USE_ANONYMIZED_TELEMETRY", "false")
+    sys.exit(main())
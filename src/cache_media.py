@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from src.Allegato import Allegato
+import os, base64, hashlib, threading
+
+class CacheMedia():
+    """
+    Cache dei contenuti multimediali (immagini, audio e video) già decodificati da base64, condivisa da
+    tutto il processo. Streamlit ridisegna la chat ad ogni interazione con un widget: senza cache ogni
+    allegato verrebbe decodificato di nuovo ogni volta. La chiave è lo sha256 dei byte decodificati
+    (lo stesso dei blob del DB), così lo stesso file allegato in più messaggi o chat viene tenuto una
+    volta sola. Oltre il budget di memoria vengono eliminati i contenuti usati meno di recente (LRU).
+    """
+
+    # budget di RAM (in MB) per i contenuti decodificati, modificabile con una variabile d'ambiente
+    DEFAULT_BUDGET_RAM_MB = int(os.environ.get("DAPABOT_CACHE_MEDIA_MB", "256"))
+
+    # impronta -> byte decodificati
+    _contenuti: OrderedDict = OrderedDict()
+    _occupati = 0
+    _lock = threading.Lock()
+    _budget_ram = DEFAULT_BUDGET_RAM_MB * 1024 * 1024
+
+    @classmethod
+    def ottieni(cls, allegato: Allegato) -> bytes:
+        """Ritorna i byte dell'allegato, decodificandoli da base64 solo se non sono già in cache."""
+        impronta = allegato.impronta
+        if impronta is not None:
+            with cls._lock:
+                dati = cls._contenuti.get(impronta)
+                if dati is not None:
+                    cls._contenuti.move_to_end(impronta)
+                    return dati
+        dati = base64.b64decode(allegato.contenuto)
+        if impronta is None:
+            # gli allegati appena inviati non hanno ancora un'impronta: viene calcolata una volta sola
+            impronta = allegato.impronta = hashlib.sha256(dati).hexdigest()
+        with cls._lock:
+            if impronta not in cls._contenuti and len(dati) <= cls._budget_ram:
+                cls._contenuti[impronta] = dati
+                cls._occupati += len(dati)
+                while cls._occupati > cls._budget_ram:
+                    _, eliminato = cls._contenuti.popitem(last=False)
+                    cls._occupati -= len(eliminato)
+        return dati
+
+    @classmethod
+    def statistiche(cls) -> dict:
+        with cls._lock:
+            return {"contenuti": len(cls._contenuti), "memoria_mb": cls._occupati / (1024 * 1024), "budget_mb": cls._budget_ram // (1024 * 1024)}
+
+    @classmethod
+    def svuota(cls):
+        with cls._lock:
+            cls._contenuti.clear()
+            cls._occupati = 0
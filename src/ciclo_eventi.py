@@ -0,0 +1,130 @@
+"""
+Ciclo di eventi asyncio persistente condiviso da tutto il processo.
+
+asyncio.run() crea e distrugge un ciclo di eventi ad ogni chiamata: le sessioni dei client MCP,
+i pool di connessioni httpx e qualsiasi lavoro asincrono ancora in corso vengono chiusi insieme
+al ciclo. Qui il ciclo gira invece per tutta la vita del processo in un thread dedicato e la GUI
+(sincrona) vi esegue le coroutine con CicloEventi.esegui().
+
+Le funzioni di Streamlit vanno chiamate dal thread dello script, non da quello del ciclo: per
+questo le callback passate alle coroutine (stream_callback, status_container, ...) vanno
+avvolte con nel_thread_chiamante() o ProxyThreadChiamante. Le chiamate vengono accodate ed
+eseguite dal thread che sta aspettando in esegui().
+
+Il ciclo è uno solo per tutte le sessioni: le coroutine non devono mai eseguire lavoro sincrono
+lungo (RAG, parsing, chiamate bloccanti ai modelli) direttamente nel ciclo, altrimenti bloccano lo
+streaming delle altre sessioni e le sessioni MCP. Quel lavoro va eseguito con asyncio.to_thread(),
+che copia il contesto: anche dal thread di lavoro le chiamate vengono inoltrate al thread chiamante.
+"""
+
+from concurrent.futures import Future
+import asyncio, contextvars, functools, queue, threading, logging
+
+# coda delle chiamate da eseguire nel thread che ha chiamato esegui(), visibile alla coroutine in esecuzione
+_coda_chiamante: contextvars.ContextVar = contextvars.ContextVar("coda_chiamante", default=None)
+
+
+class CicloEventi():
+    # ogni quanti secondi il thread chiamante controlla se la coroutine è terminata
+    INTERVALLO_ATTESA = 0.05
+
+    _loop = None
+    _thread = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_loop(cls) -> asyncio.AbstractEventLoop:
+        """Ritorna il ciclo di eventi persistente, avviandolo al primo utilizzo."""
+        if cls._loop is None:
+            with cls._lock:
+                if cls._loop is None:
+                    loop = asyncio.new_event_loop()
+                    cls._thread = threading.Thread(target=loop.run_forever, name="ciclo-eventi", daemon=True)
+                    cls._thread.start()
+                    cls._loop = loop
+                    logging.info("[EVENTI] Avviato il ciclo di eventi persistente")
+        return cls._loop
+
+    @classmethod
+    def esegui(cls, coroutine, timeout: float | None = None):
+        """
+        Esegue la coroutine nel ciclo persistente e ne ritorna il risultato (o ne rilancia l'eccezione).
+        Mentre aspetta, il thread chiamante esegue le chiamate che la coroutine gli ha inoltrato
+        con nel_thread_chiamante(). Chiamato dal thread del ciclo esegue la coroutine direttamente
+        sarebbe un deadlock, quindi viene segnalato con un errore.
+        """
+        if threading.current_thread() is cls._thread:
+            raise RuntimeError("esegui() non può essere chiamato dal thread del ciclo di eventi")
+        coda = queue.Queue()
+        futuro = asyncio.run_coroutine_threadsafe(cls._con_coda(coroutine, coda), cls.get_loop())
+        try:
+            attesa = 0.0
+            while not futuro.done():
+                try:
+                    chiamata = coda.get(timeout=cls.INTERVALLO_ATTESA)
+                except queue.Empty:
+                    attesa += cls.INTERVALLO_ATTESA
+                    if timeout is not None and attesa >= timeout:
+                        raise TimeoutError(f"Coroutine non completata entro {timeout} secondi")
+                    continue
+                chiamata()
+            # chiamate accodate subito prima della fine della coroutine
+            while not coda.empty():
+                coda.get_nowait()()
+        except BaseException:
+            futuro.cancel()
+            raise
+        return futuro.result()
+
+    @staticmethod
+    async def _con_coda(coroutine, coda: queue.Queue):
+        # il task ha un suo contesto: la coda impostata qui è visibile solo a questa coroutine
+        _coda_chiamante.set(coda)
+        return await coroutine
+
+    @staticmethod
+    def nel_thread_chiamante(funzione, attendi: bool = False):
+        """
+        Avvolge funzione in modo che, chiamata da una coroutine avviata con esegui(), venga eseguita
+        nel thread che ha chiamato esegui(). Di default la chiamata viene solo accodata e ritorna None;
+        con attendi=True si resta in attesa del risultato: è consentito solo da un thread di lavoro
+        (asyncio.to_thread), perché nel thread del ciclo bloccherebbe tutte le sessioni.
+        Fuori da esegui() la funzione viene chiamata direttamente.
+        """
+        @functools.wraps(funzione)
+        def wrapper(*args, **kwargs):
+            coda = _coda_chiamante.get()
+            if coda is None:
+                return funzione(*args, **kwargs)
+            if not attendi:
+                coda.put(functools.partial(funzione, *args, **kwargs))
+                return None
+            if threading.current_thread() is CicloEventi._thread:
+                raise RuntimeError(f"{funzione.__name__}: attesa del thread chiamante dal ciclo di eventi, "
+                                   "eseguire la chiamata con asyncio.to_thread()")
+            risultato = Future()
+            def chiamata():
+                try:
+                    risultato.set_result(funzione(*args, **kwargs))
+                except BaseException as e:
+                    risultato.set_exception(e)
+            coda.put(chiamata)
+            return risultato.result()
+        return wrapper
+
+
+class ProxyThreadChiamante():
+    """
+    Inoltra al thread che ha chiamato CicloEventi.esegui() le chiamate ai metodi dell'oggetto avvolto
+    (ad esempio un container di Streamlit passato a una coroutine). Le chiamate vengono solo accodate:
+    il valore di ritorno dei metodi non è disponibile.
+    """
+
+    def __init__(self, oggetto):
+        self._oggetto = oggetto
+
+    def __getattr__(self, nome):
+        attributo = getattr(self._oggetto, nome)
+        if not callable(attributo):
+            return attributo
+        return CicloEventi.nel_thread_chiamante(attributo)
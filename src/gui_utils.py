@@ -1,21 +1,33 @@
 import streamlit as st
 import extra_streamlit_components as stx
 from pathlib import Path
+import os
 import re
-import base64
-import asyncio
+import tempfile
+import hashlib
+import json
 from datetime import datetime
 from src.Messaggio import Messaggio
 from src.ConfigurazioneDB import ConfigurazioneDB
+from src.ciclo_eventi import CicloEventi, ProxyThreadChiamante
+from src.cache_media import CacheMedia
 from src.providers.loader import Loader
 from src.providers.base import Provider
 from src.providers.rag import Rag
+from src.providers.embedding import RegistroEmbedding
+from src.providers.cache_embedding import CacheEmbedding
+from src.providers.rerank import Riordinatore
+from src.providers.corpora import Corpora
 from src.tools.loader import Loader as tools_loader
+from src.tools.installatore import InstallatorePacchetti
 from src.tools.gui_tools import mostra_dialog_tools_agent, _on_close_tools_dialog
 from src.mcp.gui_mcp import mostra_dialog_mcp
 from src.mcp.client import get_mcp_client_manager
 from src.mcp.gui_mcp_discovery import mostra_dialog_mcp_discovery
 
+# Turni della chat mostrati all'apertura e aggiunti ad ogni click su "Mostra messaggi precedenti"
+TURNI_PER_PAGINA = 20
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Bootstrap iniziale
 # ──────────────────────────────────────────────────────────────────────────────
@@ -36,7 +48,12 @@ def _costruisci_chiavi_di_sessione(nome: str) -> dict:
         'rag_enabled': f"rag_enabled_{nome}",
         'rag_topk': f"rag_topk_{nome}",
         'rag_model': f"rag_model_{nome}",
-        'rag_modalita': f"rag_modalita_ricerca_{nome}"
+        'rag_modalita': f"rag_modalita_ricerca_{nome}",
+        'rag_rerank': f"rag_rerank_{nome}",
+        'rag_budget_rerank': f"rag_budget_rerank_{nome}",
+        'rag_lambda_mmr': f"rag_lambda_mmr_{nome}",
+        'rag_fetch_k': f"rag_fetch_k_{nome}",
+        'rag_corpora': f"rag_corpora_{nome}"
     }
 
 
@@ -68,29 +85,38 @@ def _get_provider_defaults(provider: Provider, chiavi: dict) -> dict:
         chiavi['rag_enabled']: st.session_state.get(chiavi['rag_enabled']) or rag.get_attivo() or rag_conf.get("attivo", False),
         chiavi['rag_topk']: st.session_state.get(chiavi['rag_topk']) or rag.get_topk() or rag_conf.get("top_k", Rag.DEFAULT_TOPK),
         chiavi['rag_model']: st.session_state.get(chiavi['rag_model']) or rag.get_modello() or rag_conf.get("modello", Rag.DEFAULT_EMBEDDING_MODEL),
-        chiavi['rag_modalita']: st.session_state.get(chiavi['rag_modalita']) or rag.get_modalita_ricerca() or rag_conf.get("modalita_ricerca", Rag.AVAILABLE_SEARCH_MODALITIES[0])
+        chiavi['rag_modalita']: st.session_state.get(chiavi['rag_modalita']) or rag.get_modalita_ricerca() or rag_conf.get("modalita_ricerca", Rag.AVAILABLE_SEARCH_MODALITIES[0]),
+        chiavi['rag_rerank']: st.session_state.get(chiavi['rag_rerank']) or rag.get_rerank() or rag_conf.get("rerank", False),
+        chiavi['rag_budget_rerank']: st.session_state.get(chiavi['rag_budget_rerank']) or rag.get_budget_rerank_ms() or rag_conf.get("budget_rerank_ms", Riordinatore.DEFAULT_BUDGET_MS),
+        # lambda e fetch_k possono valere 0: non si usa "or" per non scartarli
+        chiavi['rag_lambda_mmr']: st.session_state.get(chiavi['rag_lambda_mmr'], rag.get_lambda_mmr()),
+        chiavi['rag_fetch_k']: st.session_state.get(chiavi['rag_fetch_k'], rag.get_fetch_k()),
+        chiavi['rag_corpora']: st.session_state.get(chiavi['rag_corpora']) or rag.get_corpora() or rag_conf.get("corpora", [])
     }
 
 def _inizializza_tools():
     """Inizializza e configura i tools disponibili.
-        I tools vengono caricati dinamicamente e
-        popolati con le configurazioni prese dal DB.
-        Vengono configurati SOLO i tool attivi per evitare errori di validazione.
+        Per l'elenco dei tools bastano i metadati letti dal sorgente dei moduli;
+        vengono importati, istanziati e popolati con le configurazioni prese dal DB
+        SOLO i tool attivi (anche per evitare errori di validazione).
     """
-    if "tools_instances" in st.session_state:
+    if "tools_disponibili" in st.session_state:
         return
         
-    st.session_state.tools_instances = tools_loader.discover_tools()
+    st.session_state.tools_disponibili = tools_loader.discover_tools()
     
     # Carica solo i tool attivi per evitare errori di validazione su tool disattivati
     tools_salvati = ConfigurazioneDB.carica_tools_attivi()
     
     for tool_config in tools_salvati:
         nome_tool = tool_config["nome_tool"]
-        if nome_tool not in st.session_state.tools_instances:
+        if nome_tool not in st.session_state.tools_disponibili:
+            continue
+        try:
+            instance = tools_loader.get_istanza(nome_tool)
+        except Exception as e:
+            st.toast(f"⚠️ Impossibile caricare il tool {nome_tool}: {e}", icon="⚠️")
             continue
-            
-        instance = st.session_state.tools_instances[nome_tool]
         configurazione = tool_config["configurazione"]
         
         for key, value in configurazione.items():
@@ -127,10 +153,6 @@ def inizializza():
     if "providers" not in st.session_state:
         st.session_state.providers = Loader.discover_providers()
     
-    # Carica i tools attivi nei provider dopo l'inizializzazione
-    # Questo assicura che i tool siano disponibili quando viene attivata la modalità agentica
-    _carica_tools_nei_provider()
-    
     # Inizializza tabbar
     if "tabbar_key" not in st.session_state:
         st.session_state["tabbar_key"] = f"tab_{datetime.now().timestamp()}"
@@ -143,6 +165,14 @@ def inizializza():
     if "autoload_chat_db" not in st.session_state:
         st.session_state["autoload_chat_db"] = False
     
+    # Inizializza checkbox per il salvataggio automatico delle chat sul DB
+    if "autosave_chat" not in st.session_state:
+        st.session_state["autosave_chat"] = False
+    
+    # Inizializza toggle per lo streaming delle risposte
+    if "streaming_risposte" not in st.session_state:
+        st.session_state["streaming_risposte"] = True
+    
     # Gestisce ripristino chat
     provider_da_ripristinare, modello_da_ripristinare = "", ""
     if st.session_state.get("ripristina_chat"):
@@ -150,10 +180,10 @@ def inizializza():
         st.session_state["provider_da_ripristinare"] = provider_da_ripristinare
         st.session_state["ripristina_chat"] = ""
     
-    # Inizializza ogni provider
-    for nome, provider in st.session_state.providers.items():
-        modello = modello_da_ripristinare if nome == provider_da_ripristinare else ""
-        _inizializza_provider(provider, modello)
+    # Inizializza solo il provider della chat da ripristinare: gli altri vengono inizializzati
+    # (e il loro modulo importato) quando la scheda viene selezionata in crea_sidebar()
+    if provider_da_ripristinare in st.session_state.providers:
+        _inizializza_provider(st.session_state.providers[provider_da_ripristinare], modello_da_ripristinare)
     
     return st.session_state.providers
 
@@ -164,9 +194,12 @@ def salva_configurazione(providers: dict[str, Provider]):
     """
     Salva la configurazione di TUTTI i provider leggendo nell'ordine:
     valore in sessione -> valore memorizzato nel provider -> valore nella configurazione -> valore di default
+    I provider mai caricati non possono avere modifiche e vengono saltati.
     """
     configurazioni = []
     for nome, provider in providers.items():
+        if not provider.caricato():
+            continue
         chiavi = _costruisci_chiavi_di_sessione(nome)
         defaults = _get_provider_defaults(provider, chiavi)
         
@@ -186,7 +219,12 @@ def salva_configurazione(providers: dict[str, Provider]):
                 "modello": defaults[chiavi['rag_model']],
                 "top_k": defaults[chiavi['rag_topk']],
                 "directory_allegati": directory_allegati,
-                "modalita_ricerca": defaults[chiavi['rag_modalita']]
+                "modalita_ricerca": defaults[chiavi['rag_modalita']],
+                "rerank": defaults[chiavi['rag_rerank']],
+                "budget_rerank_ms": defaults[chiavi['rag_budget_rerank']],
+                "lambda_mmr": defaults[chiavi['rag_lambda_mmr']],
+                "fetch_k": defaults[chiavi['rag_fetch_k']],
+                "corpora": defaults[chiavi['rag_corpora']]
             }
         )
         
@@ -198,7 +236,12 @@ def salva_configurazione(providers: dict[str, Provider]):
                 attivo=defaults[chiavi['rag_enabled']],
                 topk=defaults[chiavi['rag_topk']],
                 modello=defaults[chiavi['rag_model']],
-                modalita_ricerca=defaults[chiavi['rag_modalita']]
+                modalita_ricerca=defaults[chiavi['rag_modalita']],
+                rerank=defaults[chiavi['rag_rerank']],
+                budget_rerank_ms=defaults[chiavi['rag_budget_rerank']],
+                lambda_mmr=defaults[chiavi['rag_lambda_mmr']],
+                fetch_k=defaults[chiavi['rag_fetch_k']],
+                corpora=defaults[chiavi['rag_corpora']]
             )
         except Exception:
             pass  # Non bloccare il salvataggio su errori runtime
@@ -212,64 +255,78 @@ def salva_configurazione(providers: dict[str, Provider]):
 # ──────────────────────────────────────────────────────────────────────────────
 # Funzione helper per caricare tools nei provider
 # ──────────────────────────────────────────────────────────────────────────────
-def _carica_tools_nei_provider(provider_name: str | None = None):
+def _impronta_tools() -> str:
     """
-    Carica i tools configurati nei provider e crea l'agent.
-    Include anche i tools dai server MCP se il toggle MCP è attivo.
-    
-    Args:
-        provider_name: Nome del provider in cui caricare i tools.
-                      Se None, carica in tutti i provider.
+    Calcola l'impronta di tutto ciò da cui dipendono i tools dell'agent: tools attivi con la
+    loro configurazione, stato delle installazioni delle loro dipendenze, toggle MCP e
+    configurazione dei server MCP attivi. Finché l'impronta non cambia i tools già assemblati
+    sono ancora validi e non serve ricrearli.
+    """
+    tools_attivi = sorted(ConfigurazioneDB.carica_tools_attivi(), key=lambda t: t["nome_tool"])
+    mcp_enabled = st.session_state.get("mcp_enabled", False)
+    dati = {
+        "tools": tools_attivi,
+        "pronti": [InstallatorePacchetti.pronto(t["nome_tool"]) for t in tools_attivi],
+        "mcp_enabled": mcp_enabled,
+        "mcp": ConfigurazioneDB.carica_mcp_servers_attivi() if mcp_enabled else []
+    }
+    return hashlib.sha256(json.dumps(dati, sort_keys=True, default=str).encode()).hexdigest()
+
+def _assembla_tools() -> tuple[list, list[str]]:
+    """
+    Crea i tools di LangChain dei tools attivi (get_tool()) e, se il toggle è attivo, dei server MCP.
     
     Returns:
-        dict: Dizionario con 'success' (bool), 'tools_count' (int), 'providers_count' (int), 'errors' (list)
+        tuple: (lista dei tools, lista degli errori)
     """
-    risultato = {
-        'success': False,
-        'tools_count': 0,
-        'providers_count': 0,
-        'errors': []
-    }
+    tools_to_use, errori = [], []
     
     # Ottieni solo i tools attivi dal database
     tools_config = ConfigurazioneDB.carica_tools_attivi()
     
-    # Prepara la lista dei tools da passare ai provider
-    tools_to_use = []
+    # Metadati dei tools disponibili: i moduli vengono importati solo per i tools attivi
+    tools_disponibili = st.session_state.get("tools_disponibili", {})
     
-    # Se ci sono tools attivi, caricali
-    if tools_config:
-        # Ottieni le istanze dei tools già caricate
-        all_tools_instances = st.session_state.get("tools_instances", {})
-        if not all_tools_instances:
-            return risultato
+    for tool_dict in tools_config:
+        tool_name = tool_dict.get("nome_tool")
+        if tool_name not in tools_disponibili:
+            continue
+        try:
+            tool_instance = tools_loader.get_istanza(tool_name)
+        except Exception as e:
+            error_msg = f"Errore caricamento tool {tool_name}: {str(e)}"
+            errori.append(error_msg)
+            st.toast(f"⚠️ {error_msg}", icon="⚠️")
+            continue
         
-        for tool_dict in tools_config:
-            tool_name = tool_dict.get("nome_tool")
-            
-            if tool_name in all_tools_instances:
-                tool_instance = all_tools_instances[tool_name]
-                
-                # Riconfigura l'istanza del tool con i dati dal database
-                configurazione = tool_dict.get("configurazione", {})
-                for key, value in configurazione.items():
-                    if key == "_variabili_necessarie":
-                        tool_instance.set_variabili_necessarie(value)
-                    elif hasattr(tool_instance, key):
-                        setattr(tool_instance, key, value)
-                
-                # Ottieni i tools effettivi chiamando get_tool()
-                # Alcuni tools non richiedono configurazione, altri sì
-                # Se get_tool() fallisce, l'errore viene catturato e registrato
-                try:
-                    tools = tool_instance.get_tool() # torna una lista di tools
-                    tools_to_use.extend(tools)
-                except Exception as e:
-                    # Tool richiede configurazione o ha altri problemi
-                    # L'errore viene registrato ma non blocca il caricamento degli altri tools
-                    error_msg = f"Errore caricamento tool {tool_name}: {str(e)}"
-                    risultato['errors'].append(error_msg)
-                    st.toast(f"⚠️ {error_msg}", icon="⚠️")
+        # Salta i tools le cui dipendenze sono ancora in installazione (o non sono state installate)
+        if not InstallatorePacchetti.pronto(tool_name):
+            stato = InstallatorePacchetti.stato(tool_name)
+            error_msg = f"Tool {tool_name} non disponibile: installazione dipendenze {stato['stato'].replace('_', ' ')}"
+            errori.append(error_msg)
+            st.toast(f"⏳ {error_msg}", icon="⏳")
+            continue
+        
+        # Riconfigura l'istanza del tool con i dati dal database
+        configurazione = tool_dict.get("configurazione", {})
+        for key, value in configurazione.items():
+            if key == "_variabili_necessarie":
+                tool_instance.set_variabili_necessarie(value)
+            elif hasattr(tool_instance, key):
+                setattr(tool_instance, key, value)
+        
+        # Ottieni i tools effettivi chiamando get_tool()
+        # Alcuni tools non richiedono configurazione, altri sì
+        # Se get_tool() fallisce, l'errore viene catturato e registrato
+        try:
+            tools = tool_instance.get_tool() # torna una lista di tools
+            tools_to_use.extend(tools)
+        except Exception as e:
+            # Tool richiede configurazione o ha altri problemi
+            # L'errore viene registrato ma non blocca il caricamento degli altri tools
+            error_msg = f"Errore caricamento tool {tool_name}: {str(e)}"
+            errori.append(error_msg)
+            st.toast(f"⚠️ {error_msg}", icon="⚠️")
     
     # Carica tools, risorse e prompt MCP se il toggle è attivo
     if st.session_state.get("mcp_enabled", False):
@@ -277,13 +334,13 @@ def _carica_tools_nei_provider(provider_name: str | None = None):
             manager = get_mcp_client_manager()
             manager.carica_configurazioni_da_db()
             # Usa il nuovo metodo unificato che ritorna (tools, errors)
-            mcp_all_tools, mcp_errors = asyncio.run(manager.get_all_as_langchain_tools())
+            mcp_all_tools, mcp_errors = CicloEventi.esegui(manager.get_all_as_langchain_tools())
             
             # Aggiungi gli errori MCP alla lista degli errori
             if mcp_errors:
                 for error in mcp_errors:
                     error_msg = f"Errore MCP: {error}"
-                    risultato['errors'].append(error_msg)
+                    errori.append(error_msg)
                     st.toast(f"⚠️ {error_msg}", icon="⚠️")
             
             # Aggiungi i tools caricati (anche se ci sono errori parziali)
@@ -291,9 +348,43 @@ def _carica_tools_nei_provider(provider_name: str | None = None):
                 tools_to_use.extend(mcp_all_tools)
         except Exception as e:
             error_msg = f"Errore caricamento MCP (tools/risorse/prompt): {str(e)}"
-            risultato['errors'].append(error_msg)
+            errori.append(error_msg)
             st.toast(f"⚠️ {error_msg}", icon="⚠️")
     
+    return tools_to_use, errori
+
+def _carica_tools_nei_provider(provider_name: str | None = None, forza: bool = False):
+    """
+    Carica i tools configurati nei provider e crea l'agent.
+    Include anche i tools dai server MCP se il toggle MCP è attivo.
+    I tools vengono assemblati di nuovo solo se è cambiata la loro impronta (vedi _impronta_tools())
+    e l'agent viene ricreato solo se sono cambiati client o tools (vedi Provider._crea_agent()),
+    quindi la funzione può essere chiamata ad ogni rerun.
+    
+    Args:
+        provider_name: Nome del provider in cui caricare i tools.
+                      Se None, carica in tutti i provider.
+        forza: Se True assembla di nuovo i tools anche se l'impronta non è cambiata.
+    
+    Returns:
+        dict: Dizionario con 'success' (bool), 'tools_count' (int), 'providers_count' (int), 'errors' (list)
+    """
+    risultato = {
+        'success': False,
+        'tools_count': 0,
+        'providers_count': 0,
+        'errors': []
+    }
+    
+    impronta = _impronta_tools()
+    if forza or st.session_state.get("tools_impronta") != impronta:
+        tools_to_use, errori = _assembla_tools()
+        st.session_state["tools_assemblati"] = tools_to_use
+        st.session_state["tools_errori"] = errori
+        st.session_state["tools_impronta"] = impronta
+    tools_to_use = st.session_state["tools_assemblati"]
+    risultato['errors'].extend(st.session_state["tools_errori"])
+    
     # Passa i tools ai provider specificati (anche se la lista è vuota)
     providers = st.session_state.get("providers", {})
     providers_aggiornati = 0
@@ -303,8 +394,8 @@ def _carica_tools_nei_provider(provider_name: str | None = None):
         # Carica solo nel provider specificato
         providers_to_update = {provider_name: providers[provider_name]} if provider_name in providers else {}
     else:
-        # Carica in tutti i provider
-        providers_to_update = providers
+        # Carica in tutti i provider già caricati: gli altri ricevono i tools quando viene selezionata la loro scheda
+        providers_to_update = {nome: p for nome, p in providers.items() if p.caricato()}
     
     for provider in providers_to_update.values():
         # Aggiorna sempre i tools, anche se la lista è vuota
@@ -367,6 +458,33 @@ def mostra_dialog_vectorestores_globale():
     else:
         st.info("Nessun vector store presente.")
 
+    # Statistiche del registro dei motori di embedding
+    stat = RegistroEmbedding.statistiche()
+    st.caption(f"🧠 Motori di embedding in memoria: {stat['motori']} "
+               f"(locali: {stat['motori_locali']}, {stat['memoria_mb']} MB su {stat['budget_mb']} MB) · "
+               f"hit: {stat['hit']} · miss: {stat['miss']} · rimossi: {stat['evizioni']}")
+    stat_parsing = Rag.statistiche_cache_parsing()
+    st.caption(f"📑 Documenti nella cache del parsing: {stat_parsing['documenti']} ({stat_parsing['spazio_mb']} MB)")
+    stat_cache = CacheEmbedding.statistiche()
+    st.caption(f"🧮 Embedding dei chunk in cache: {stat_cache['embedding']} ({stat_cache['spazio_mb']} MB) · "
+               f"riusati: {stat_cache['hit']} · calcolati: {stat_cache['miss']}")
+
+    # Modalità di archiviazione dei nuovi vectorstore (passando a quella consolidata si migrano gli esistenti)
+    descrizioni = {Rag.ARCHIVIAZIONE_SEPARATA: "Una directory per file",
+                   Rag.ARCHIVIAZIONE_CONSOLIDATA: "Una collection per modello"}
+    archiviazione = st.radio("🗄️ Archiviazione dei vector store", Rag.MODALITA_ARCHIVIAZIONE,
+                             index=Rag.MODALITA_ARCHIVIAZIONE.index(Rag.get_archiviazione()),
+                             format_func=descrizioni.get, horizontal=True,
+                             help="Con una collection per modello tutti i file usano un solo client Chroma e vengono "
+                                  "distinti dai metadati: i file di una base di conoscenza vengono cercati con una "
+                                  "sola query invece che con una per file. Selezionandola, i vector store esistenti "
+                                  "vengono migrati.")
+    if archiviazione != Rag.get_archiviazione():
+        with st.spinner("Migrazione dei vector store in corso..."):
+            migrati = Rag.set_archiviazione(archiviazione)
+        st.toast(f"Archiviazione aggiornata ({migrati} vector store migrati)", icon="🗄️")
+        st.rerun()
+
     st.divider()
 
     # =============================================
@@ -375,7 +493,9 @@ def mostra_dialog_vectorestores_globale():
     if st.button("Elimina tutto", type="primary"):
         for id_str, *_ in righe:
             Rag.delete_vectorstore(id_str)
-        st.success("Tutti i vector store sono stati rimossi.")
+        Rag.svuota_cache_parsing()
+        CacheEmbedding.svuota()
+        st.success("Tutti i vector store, la cache del parsing e quella degli embedding sono stati rimossi.")
         st.rerun()
 
     # =============================================
@@ -385,6 +505,74 @@ def mostra_dialog_vectorestores_globale():
         st.session_state["vs_dialog_global_open"] = False
         st.rerun()
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Dialog basi di conoscenza
+# ──────────────────────────────────────────────────────────────────────────────
+@st.dialog(
+    "📚 Basi di conoscenza",
+    width="medium",
+    dismissible=False,
+)
+def mostra_dialog_corpora(provider: Provider):
+    st.caption(f"L'indicizzazione usa il modello e il chunker RAG di {provider.nome()}: "
+               "vengono analizzati solo i file nuovi o modificati")
+
+    corpora = Corpora.elenco()
+    if corpora:
+        for idx, (nome, corpus) in enumerate(corpora.items()):
+            col1, col2, col3 = st.columns([7, 1, 1])
+            with col1:
+                st.markdown(f"**{nome}** · {corpus['numero_file']} file · "
+                            f"aggiornata: {corpus['aggiornato'].replace('T', ' ') or 'mai'}")
+                st.caption(corpus["directory"])
+            with col2:
+                if st.button("🔄", key=f"reindex_corpus_{idx}", help="Aggiorna l'indice"):
+                    try:
+                        with st.spinner(f"Indicizzazione di {nome} in corso..."):
+                            esito = provider.get_rag().indicizza_corpus(nome)
+                        st.toast(f"{nome}: {esito['modificati']} file nuovi o modificati, {esito['rimossi']} rimossi, "
+                                 f"{esito['vectorstore_creati']} vector store creati", icon="📚")
+                        if esito["errori"]:
+                            st.warning(f"File non analizzabili: {', '.join(esito['errori'])}")
+                    except Exception as e:
+                        st.error(f"Errore nell'indicizzazione di {nome}: {e}")
+            with col3:
+                if st.button("❌", key=f"del_corpus_{idx}", help="Elimina la base di conoscenza (non i file)"):
+                    Corpora.elimina(nome)
+                    st.toast(f"Eliminata: {nome}", icon="🗑️")
+                    st.rerun()
+    else:
+        st.info("Nessuna base di conoscenza presente.")
+
+    st.divider()
+
+    # =============================================
+    # Creazione di una nuova base di conoscenza
+    # =============================================
+    with st.form("form_nuovo_corpus", clear_on_submit=True):
+        nome = st.text_input("Nome")
+        directory = st.text_input("Directory", value=provider.get_rag().get_upload_dir(),
+                                  help="I file della directory e delle sottodirectory vengono indicizzati")
+        if st.form_submit_button("Crea e indicizza"):
+            try:
+                Corpora.crea(nome, directory)
+                with st.spinner(f"Indicizzazione di {nome.strip()} in corso..."):
+                    esito = provider.get_rag().indicizza_corpus(nome.strip())
+                st.toast(f"{nome.strip()}: {esito['file']} file indicizzati", icon="📚")
+                if esito["errori"]:
+                    st.warning(f"File non analizzabili: {', '.join(esito['errori'])}")
+                else:
+                    st.rerun()
+            except Exception as e:
+                st.error(str(e))
+
+    # =============================================
+    # Pulsante "Chiudi"
+    # =============================================
+    if st.button("Chiudi"):
+        st.session_state["corpora_dialog_open"] = False
+        st.rerun()
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Manuale Utente
 # ──────────────────────────────────────────────────────────────────────────────
@@ -463,6 +651,8 @@ def crea_sidebar(providers: dict[str, Provider]):
             default=st.session_state["provider_da_ripristinare"]
         provider_scelto = stx.tab_bar(data=schede, key=st.session_state["tabbar_key"], default=default)
         provider: Provider = providers[provider_scelto]
+        # Al primo accesso alla scheda viene importato il modulo del provider
+        _inizializza_provider(provider)
 
         # Chiavi per il provider corrente
         apikey_key                  = f"api_key_{provider_scelto}"
@@ -472,6 +662,11 @@ def crea_sidebar(providers: dict[str, Provider]):
         rag_topk_key                = f"rag_topk_{provider_scelto}"
         rag_model_key               = f"rag_model_{provider_scelto}"
         rag_modalita_ricerca_key    = f"rag_modalita_ricerca_{provider_scelto}"
+        rag_rerank_key              = f"rag_rerank_{provider_scelto}"
+        rag_budget_rerank_key       = f"rag_budget_rerank_{provider_scelto}"
+        rag_lambda_mmr_key          = f"rag_lambda_mmr_{provider_scelto}"
+        rag_fetch_k_key             = f"rag_fetch_k_{provider_scelto}"
+        rag_corpora_key             = f"rag_corpora_{provider_scelto}"
         sysmsg_key                  = f"system_msg_{provider_scelto}"
 
         # Opzioni correnti
@@ -515,6 +710,11 @@ def crea_sidebar(providers: dict[str, Provider]):
             value=st.session_state[provider_scelto][sysmsg_key],
             on_change=sincronizza_sessione, args=(sysmsg_key,)
         )
+        
+        # Toggle: streaming delle risposte (vale per tutti i provider)
+        st.toggle("⚡ Streaming delle risposte", key="streaming_risposte",
+            help="Mostra la risposta del modello mentre viene generata invece di attenderla per intera"
+        )
 
         # ──────────────────────────────────────────────────────────────────────────────
         # Sezione Chat
@@ -547,12 +747,28 @@ def crea_sidebar(providers: dict[str, Provider]):
                     st.selectbox("📂 Riapri chat recente:", options=chat_recenti, key="ripristina_chat", on_change=on_ripristina_chat)
                 else:
                     st.caption("📂 Nessuna chat recente")
-                col1, col2 = st.columns(2)
+                col1, col2, col3 = st.columns(3)
                 with col1:
                     st.checkbox("Elenca chat su DB", key="chat_db_key", help="Se abilitato elenca le chat memorizzate su disco nella lista qui sopra", label_visibility="visible")
                 with col2:
                     if st.checkbox("Autocaricamento dal DB", key="autoload_chat_db", help="Se abilitato carica automaticamente la cronologia delle chat dal disco (se presenti)", label_visibility="visible"):
                         provider.carica_chat_da_db()
+                with col3:
+                    st.checkbox("Salvataggio automatico", key="autosave_chat", help="Se abilitato salva sul DB i nuovi messaggi della chat al termine di ogni risposta", label_visibility="visible")
+            # BUDGET DEL CONTESTO (per provider e modello, perché dipende dalla finestra di contesto del modello)
+            if modello_scelto:
+                with st.container(border=True):
+                    budget_key = f"budget_contesto_{provider_scelto}_{modello_scelto}"
+                    if budget_key not in st.session_state:
+                        st.session_state[budget_key] = provider.get_gestore_contesto(modello_scelto).get_budget()
+                    budget = st.number_input("📏 Budget del contesto (token)", min_value=1000, step=1000, key=budget_key,
+                        help="Token massimi della cronologia inviata al modello: oltre questo limite i messaggi più vecchi vengono riassunti "
+                             "e gli allegati già inviati sostituiti da un segnaposto")
+                    provider.set_budget_contesto(budget, modello_scelto)
+                    statistiche = provider.get_gestore_contesto(modello_scelto).statistiche()
+                    if statistiche["token_ultimo_invio"]:
+                        st.caption(f"ℹ️ Ultimo invio: ~{statistiche['token_ultimo_invio']} token, "
+                                   f"{statistiche['messaggi_riassunti']} messaggi riassunti")
             colonna1, colonna2, colonna3 = st.columns(3, border=True)
             with colonna1:# PULSANTI DI SALVATAGGIO CHAT
                 with st.popover("💾 Salva..."):
@@ -591,28 +807,37 @@ def crea_sidebar(providers: dict[str, Provider]):
                     col1, col2 = st.columns(2, border=True)
                     with col1:
                         st.subheader("Esporta")
-                        ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") # genera la stringa di data/ora
-                        filename = f"storico_{ts}.json"
+                        # L'esportazione viene generata solo su richiesta, in un file temporaneo compresso
                         try:
-                            json_data = ConfigurazioneDB.esporta_chat_json()
-                            st.download_button(
-                                label="⬇️ Esporta tutte le chat",
-                                data=json_data,
-                                file_name=filename,
-                                mime="application/json"
-                            )
-                            st.caption("ℹ️ Scarica solo le chat in formato JSON")
+                            if st.button("📦 Prepara esportazione", use_container_width=True):
+                                _elimina_esportazione()
+                                ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") # genera la stringa di data/ora
+                                with st.spinner("Esportazione in corso..."):
+                                    with tempfile.NamedTemporaryFile(suffix=".ndjson.gz", delete=False) as destinazione:
+                                        ConfigurazioneDB.esporta_chat_gzip(destinazione)
+                                st.session_state["esportazione_chat"] = {"percorso": destinazione.name, "filename": f"storico_{ts}.ndjson.gz"}
+                            esportazione = st.session_state.get("esportazione_chat")
+                            if esportazione and os.path.exists(esportazione["percorso"]):
+                                with open(esportazione["percorso"], "rb") as file_esportazione:
+                                    st.download_button(
+                                        label="⬇️ Esporta tutte le chat",
+                                        data=file_esportazione,
+                                        file_name=esportazione["filename"],
+                                        mime="application/gzip",
+                                        on_click=_elimina_esportazione
+                                    )
+                            st.caption("ℹ️ Scarica solo le chat, in formato NDJSON compresso con gzip")
                         except Exception as e:
                             st.exception(e)
                     with col2:
                         st.subheader("Importa")
-                        # Importa DB JSON
+                        # Importa le chat (NDJSON, anche compresso, o il vecchio formato JSON) un blocco di messaggi alla volta
                         try:
-                            json_file = st.file_uploader("📥 Seleziona JSON da importare", type=["json"])
-                            if json_file and st.button("📥 Importa chat"):
-                                text = json_file.read().decode("utf-8")
-                                ConfigurazioneDB.importa_chat_json(text)
-                                st.success("Chat importate", icon="✅")
+                            file_chat = st.file_uploader("📥 Seleziona il file da importare", type=["gz", "ndjson", "json"])
+                            if file_chat and st.button("📥 Importa chat"):
+                                with st.spinner("Importazione in corso..."):
+                                    importati = ConfigurazioneDB.importa_chat(file_chat)
+                                st.success(f"Chat importate ({importati} messaggi)", icon="✅")
                                 st.rerun()
                         except Exception as e:
                             st.exception(e)
@@ -638,6 +863,8 @@ def crea_sidebar(providers: dict[str, Provider]):
                                 with st.empty():
                                     with st.status(label="Svuotamento in corso...", expanded=True):
                                         for nome_p, prov in providers.items():
+                                            if not prov.caricato():
+                                                continue
                                             modello = prov.get_modello_scelto()
                                             if modello:
                                                 st.write(f"Provider: {nome_p}, modello: {modello}...")
@@ -767,6 +994,39 @@ def crea_sidebar(providers: dict[str, Provider]):
                 on_change=sincronizza_sessione, args=(rag_modalita_ricerca_key,)
             )
 
+            # Parametri della MMR (mostrati solo quando serve, i valori restano nella sessione del provider)
+            lambda_mmr = st.session_state[provider_scelto][rag_lambda_mmr_key]
+            fetch_k = st.session_state[provider_scelto][rag_fetch_k_key]
+            if modalita_ricerca == "mmr":
+                lambda_mmr = st.slider("⚖️ Rilevanza / diversità (lambda)", min_value=0.0, max_value=1.0, step=0.05,
+                    key=rag_lambda_mmr_key, value=float(lambda_mmr),
+                    help="1 sceglie solo i chunk più simili al prompt, 0 solo i più diversi tra loro",
+                    on_change=sincronizza_sessione, args=(rag_lambda_mmr_key,)
+                )
+                fetch_k = st.number_input("🪣 Candidati totali (fetch_k)", min_value=0, step=5,
+                    key=rag_fetch_k_key, value=int(fetch_k),
+                    help="Chunk più simili al prompt, fra tutti i file, tra cui la MMR sceglie i Top K "
+                         "(0 = automatico: max(Top K × 4, 20))",
+                    on_change=sincronizza_sessione, args=(rag_fetch_k_key,)
+                )
+
+            # Riordino dei chunk con il cross-encoder
+            rerank = st.toggle("🏅 Riordina con cross-encoder", key=rag_rerank_key,
+                value=st.session_state[provider_scelto][rag_rerank_key],
+                help=f"Cerca {Rag.FATTORE_CANDIDATI_RERANK} volte i chunk richiesti e tiene i migliori secondo "
+                     f"{Riordinatore.DEFAULT_MODELLO} (eseguito in locale su CPU)",
+                on_change=sincronizza_sessione, args=(rag_rerank_key,)
+            )
+            if rerank and not Riordinatore.pronto():
+                Riordinatore.precarica()
+                st.caption("⏳ Caricamento del cross-encoder in corso: fino ad allora si usa l'ordine della ricerca")
+            budget_rerank = st.number_input("⏱️ Tempo massimo per il riordino (ms)", min_value=100, step=100,
+                key=rag_budget_rerank_key, disabled=not rerank,
+                value=st.session_state[provider_scelto][rag_budget_rerank_key],
+                help="Se il riordino dura di più viene interrotto e si usano i chunk nell'ordine della ricerca",
+                on_change=sincronizza_sessione, args=(rag_budget_rerank_key,)
+            )
+
             # Modello RAG
             if modelli_rag:
                 modello_rag = st.selectbox("🧩 Modello per il RAG", modelli_rag, key=rag_model_key,
@@ -777,9 +1037,22 @@ def crea_sidebar(providers: dict[str, Provider]):
                 st.warning("Nessun modello RAG disponibile.", icon="⚠️")
                 modello_rag=""
                 st.session_state[provider_scelto][rag_model_key]=""
-            # ---- Pulsante globale per aprire la finestra MODALE con TUTTI i vector store ----
-            if st.button("Cache...", key="btn_vs_global", help="Gestisci tutti i vector store di tutti i provider", icon="🗄️"):
-                st.session_state["vs_dialog_global_open"] = True
+            # Basi di conoscenza interrogate ad ogni messaggio, oltre agli allegati
+            nomi_corpora = list(Corpora.elenco())
+            corpora = st.multiselect("📚 Basi di conoscenza", nomi_corpora, key=rag_corpora_key,
+                default=[c for c in st.session_state[provider_scelto][rag_corpora_key] if c in nomi_corpora],
+                help="Directory indicizzate una volta sola e interrogate ad ogni messaggio senza allegare i file",
+                on_change=sincronizza_sessione, args=(rag_corpora_key,)
+            )
+
+            # ---- Pulsanti globali per aprire le finestre MODALI con TUTTI i vector store e le basi di conoscenza ----
+            col_cache, col_corpora = st.columns(2)
+            with col_cache:
+                if st.button("Cache...", key="btn_vs_global", help="Gestisci tutti i vector store di tutti i provider", icon="🗄️"):
+                    st.session_state["vs_dialog_global_open"] = True
+            with col_corpora:
+                if st.button("Basi...", key="btn_corpora", help="Crea, aggiorna ed elimina le basi di conoscenza", icon="📚"):
+                    st.session_state["corpora_dialog_open"] = True
 
         # Salva configurazione e gestione DB (in fondo alla sidebar)
         col_salva, col_db = st.columns(2)
@@ -800,8 +1073,13 @@ def crea_sidebar(providers: dict[str, Provider]):
         # Aggiorna provider runtime (usa i valori restituiti dai widget)
         try:
             provider.set_client(modello_scelto, api_key)
+            # Tools e agent vengono ricreati solo se è cambiata la loro configurazione, e solo per il provider in uso
+            if modalita_agentica:
+                _carica_tools_nei_provider(provider_name=provider_scelto)
             provider.set_modalita_agentica(modalita_agentica)
-            provider.set_rag(attivo=rag_abilitato, topk=topk, modello=modello_rag, modalita_ricerca=modalita_ricerca)
+            provider.set_rag(attivo=rag_abilitato, topk=topk, modello=modello_rag, modalita_ricerca=modalita_ricerca,
+                             rerank=rerank, budget_rerank_ms=budget_rerank, lambda_mmr=lambda_mmr, fetch_k=fetch_k,
+                             corpora=corpora)
         except Exception as e:
             st.toast(f"Errore nell'impostazione dei parametri: {e}", icon="⛔")
         
@@ -818,6 +1096,10 @@ def crea_sidebar(providers: dict[str, Provider]):
     if st.session_state.get("vs_dialog_global_open", False):
         mostra_dialog_vectorestores_globale()
     
+    # ---- Render della finestra modale basi di conoscenza ----
+    if st.session_state.get("corpora_dialog_open", False):
+        mostra_dialog_corpora(provider)
+    
     # ---- Render della finestra modale configurazione tools ----
     if st.session_state.get("tools_dialog_open", False):
         mostra_dialog_tools_agent()
@@ -867,19 +1149,114 @@ def generate_response(prompt_utente, messaggio_di_sistema, provider_scelto: Prov
     
     messaggi_da_inviare.append(messaggio_utente)
     
+    # Invia i messaggi mostrando la risposta mentre viene generata (anche in modalità agentica)
+    if st.session_state.get("streaming_risposte", False):
+        _invia_in_streaming(provider_scelto, messaggi_da_inviare)
     # Invia i messaggi con feedback visivo se modalità agentica è attiva
-    if provider_scelto.get_modalita_agentica():
+    elif provider_scelto.get_modalita_agentica():
         # Crea un container per il feedback con st.status()
         with st.status("🤖 Agent in azione...", expanded=True) as status:
-            # Passa il container di status al metodo invia_messaggi (ora asincrono)
-            asyncio.run(provider_scelto.invia_messaggi(messaggi_da_inviare, status_container=status))
+            # Passa il container di status al metodo invia_messaggi (ora asincrono), che lo usa dal thread del ciclo di eventi
+            CicloEventi.esegui(provider_scelto.invia_messaggi(messaggi_da_inviare, status_container=ProxyThreadChiamante(status)))
             # Aggiorna lo stato finale
             status.update(label="✅ Operazione completata!", state="complete")
     else:
         # Modalità normale senza feedback visivo (anche questa è asincrona ora)
-        asyncio.run(provider_scelto.invia_messaggi(messaggi_da_inviare))
+        CicloEventi.esegui(provider_scelto.invia_messaggi(messaggi_da_inviare))
+    
+    # Salvataggio automatico: vengono scritti sul DB solo i messaggi del turno appena concluso
+    if st.session_state.get("autosave_chat", False):
+        try:
+            ConfigurazioneDB.salva_chat(provider_scelto.nome(), provider_scelto.get_modello_scelto(), provider_scelto.get_cronologia_messaggi())
+        except Exception as e:
+            st.toast(f"⚠️ Salvataggio automatico della chat non riuscito: {e}")
+
+def _invia_in_streaming(provider: Provider, messaggi_da_inviare: list[Messaggio]):
+    """
+    Invia i messaggi mostrando la risposta mentre viene generata.
+    Il messaggio dell'utente e la risposta parziale vengono disegnati in due segnaposto che a fine
+    risposta vengono svuotati: da lì in poi la chat viene mostrata come sempre da mostra_cronologia_chat().
+    In modalità agentica tra i due c'è lo status con le chiamate ai tool, che invece rimane visibile.
+    """
+    segnaposto_utente = st.empty()
+    with segnaposto_utente.container():
+        for messaggio in messaggi_da_inviare:
+            if messaggio.get_ruolo() == "user" and messaggio.get_testo():
+                with st.chat_message("user"):
+                    st.markdown(messaggio.get_testo())
+    status = st.status("🤖 Agent in azione...", expanded=True) if provider.get_modalita_agentica() else None
+    segnaposto_risposta = st.empty()
+    with segnaposto_risposta.container():
+        with st.chat_message("assistant", avatar="src/img/testa.png"):
+            area_risposta = st.empty()
+    
+    def aggiorna_risposta(testo: str):
+        area_risposta.markdown(testo + " ▌")
     
-def mostra_cronologia_chat(cronologia: list[Messaggio]):    
+    try:
+        # Le callback disegnano con Streamlit: vengono eseguite in questo thread e non in quello del ciclo di eventi
+        CicloEventi.esegui(provider.invia_messaggi(
+            messaggi_da_inviare,
+            status_container=ProxyThreadChiamante(status) if status else None,
+            stream_callback=CicloEventi.nel_thread_chiamante(aggiorna_risposta)
+        ))
+    except Exception:
+        if status:
+            status.update(label="❌ Operazione non riuscita", state="error")
+        raise
+    if status:
+        status.update(label="✅ Operazione completata!", state="complete", expanded=False)
+    segnaposto_utente.empty()
+    segnaposto_risposta.empty()
+    # Le metriche vengono mostrate sotto la risposta da mostra_metriche_streaming()
+    st.session_state["metriche_ultima_risposta"] = provider.get_metriche_streaming()
+
+def mostra_metriche_streaming():
+    """Mostra le metriche dell'ultima risposta ricevuta in streaming (una sola volta)."""
+    metriche = st.session_state.pop("metriche_ultima_risposta", None)
+    if not metriche:
+        return
+    st.caption(
+        f"⏱️ Primo token in {metriche['ttft']:.2f}s · {metriche['token_al_secondo']:.1f} token/s · "
+        f"{metriche['token']} token in {metriche['durata']:.1f}s "
+        f"(media su {metriche['risposte']} risposte: {metriche['ttft_medio']:.2f}s, {metriche['token_al_secondo_medio']:.1f} token/s)"
+    )
+    
+def _elimina_esportazione():
+    """Elimina il file temporaneo dell'ultima esportazione delle chat (dopo il download o prima di prepararne una nuova)."""
+    esportazione = st.session_state.pop("esportazione_chat", None)
+    if esportazione and os.path.exists(esportazione["percorso"]):
+        os.remove(esportazione["percorso"])
+
+def _inizio_finestra(cronologia: list[Messaggio], turni: int) -> int:
+    """
+    Ritorna l'indice del primo messaggio degli ultimi `turni` turni della chat. Un turno inizia con un
+    messaggio dell'utente, preceduto dall'eventuale messaggio di sistema inviato insieme.
+    """
+    contati = 0
+    for i in range(len(cronologia) - 1, -1, -1):
+        if cronologia[i].get_ruolo() == "user":
+            contati += 1
+            if contati == turni:
+                return i - 1 if i > 0 and cronologia[i - 1].get_ruolo() == "system" else i
+    return 0
+
+def mostra_cronologia_chat(cronologia: list[Messaggio], chiave_finestra: str | None = None):
+    """
+    Mostra i messaggi della chat. Se viene passata chiave_finestra (una per ogni chat) vengono mostrati
+    solo gli ultimi TURNI_PER_PAGINA turni e un pulsante per mostrarne altrettanti dei precedenti:
+    Streamlit ridisegna tutta la chat ad ogni interazione con un widget.
+    Immagini, audio e video vengono decodificati da base64 una sola volta grazie a CacheMedia.
+    """
+    if chiave_finestra is not None:
+        chiave_turni = f"turni_visibili_{chiave_finestra}"
+        inizio = _inizio_finestra(cronologia, st.session_state.get(chiave_turni, TURNI_PER_PAGINA))
+        if inizio > 0:
+            def mostra_precedenti():
+                st.session_state[chiave_turni] = st.session_state.get(chiave_turni, TURNI_PER_PAGINA) + TURNI_PER_PAGINA
+            st.button(f"⬆️ Mostra messaggi precedenti ({inizio} nascosti)", key=f"mostra_precedenti_{chiave_finestra}",
+                      on_click=mostra_precedenti, use_container_width=True)
+            cronologia = cronologia[inizio:]
     for msg in cronologia:
         ruolo = msg.get_ruolo()
         testo = msg.get_testo()
@@ -894,13 +1271,11 @@ def mostra_cronologia_chat(cronologia: list[Messaggio]):
                 # Poi gli allegati
                 for allegato in allegati:
                     tipo = allegato.tipo
-                    contenuto = allegato.contenuto
                     
-                    # Per contenuti multimediali, decodifica base64 in bytes per Streamlit
+                    # Per contenuti multimediali servono i bytes: il contenuto base64 viene decodificato solo se non è in cache
                     if tipo in ("image", "audio", "video"):
                         try:
-                            # Il contenuto è una stringa base64, decodificala
-                            contenuto_bytes = base64.b64decode(contenuto)
+                            contenuto_bytes = CacheMedia.ottieni(allegato)
                             if tipo == "image":
                                 st.image(contenuto_bytes)
                             elif tipo == "audio":
@@ -910,11 +1285,12 @@ def mostra_cronologia_chat(cronologia: list[Messaggio]):
                         except Exception as e:
                             st.error(f"Errore nella visualizzazione di {tipo}: {e}")
                     elif tipo == "text":
-                        st.write(contenuto)
+                        st.write(allegato.contenuto)
                     elif tipo == "text-plain":
-                        st.text(contenuto)
+                        st.text(allegato.contenuto)
                     elif tipo == "url":
                         # Gestisci URL: mostra link cliccabile
+                        contenuto = allegato.contenuto
                         filename = allegato.filename if hasattr(allegato, 'filename') else contenuto.split('/')[-1]
                         st.markdown(f"🔗 [Scarica: {filename}]({contenuto})")
                     elif tipo == "file":
@@ -13,6 +13,7 @@ from mcp_use import MCPClient
 from langchain_core.tools import BaseTool
 from src.ConfigurazioneDB import ConfigurazioneDB
 from src.mcp.langchain_adapter import MCPLangChainAdapter
+from src.ciclo_eventi import CicloEventi
 
 # Configura un handler per catturare i log di mcp-use
 class MCPErrorHandler(logging.Handler):
@@ -109,6 +110,7 @@ class MCPClientManager:
         if old_config_json != new_config_json:
             self._server_configs = new_server_configs
             # Resetta il client per forzare la riconnessione con le nuove configurazioni
+            self._chiudi_sessioni(self._client)
             self._client = None
             self._adapter = None
             self._all_tools_cache = []
@@ -266,6 +268,7 @@ class MCPClientManager:
         """
         try:
             # Resetta il client
+            self._chiudi_sessioni(self._client)
             self._client = None
             self._adapter = None
             self._all_tools_cache = []
@@ -274,6 +277,19 @@ class MCPClientManager:
             # Marca il riavvio come completato
             self._restart_in_progress = False
     
+    def _chiudi_sessioni(self, client: Optional[MCPClient]) -> None:
+        """
+        Chiude in background le sessioni di un client che non verrà più usato.
+        Il ciclo di eventi è persistente, quindi le sessioni (e i processi dei server locali)
+        non vengono più chiuse insieme al ciclo come accadeva con asyncio.run().
+        """
+        if client is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(client.close_all_sessions(), CicloEventi.get_loop())
+        except Exception as e:
+            logging.warning(f"[MCP] Errore nella chiusura delle sessioni: {e}")
+    
     def reset(self) -> None:
         """
         Resetta il client e ricarica le configurazioni.
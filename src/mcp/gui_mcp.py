@@ -74,7 +74,7 @@ def _on_close_mcp_dialog():
         from src.gui_utils import _carica_tools_nei_provider
         
         provider_scelto = st.session_state["provider_scelto"]
-        risultato = _carica_tools_nei_provider(provider_name=provider_scelto)
+        risultato = _carica_tools_nei_provider(provider_name=provider_scelto, forza=True)
 
 
 @st.dialog(
@@ -4,10 +4,10 @@ Implementa un dialog con tabs per esplorare cosa offre ogni server MCP prima di
 """
 
 import streamlit as st
-import asyncio
 from typing import Any, Optional
 from src.mcp.client import get_mcp_client_manager
 from src.ConfigurazioneDB import ConfigurazioneDB
+from src.ciclo_eventi import CicloEventi
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -369,7 +369,7 @@ def mostra_dialog_mcp_discovery():
             if selected_server not in st.session_state.mcp_preview_data:
                 with st.spinner(f"Caricamento preview per {selected_server}..."):
                     try:
-                        preview_data = asyncio.run(_load_preview_data(selected_server))
+                        preview_data = CicloEventi.esegui(_load_preview_data(selected_server))
                         st.session_state.mcp_preview_data[selected_server] = preview_data
                     except Exception as e:
                         st.error(f"Errore nel caricamento preview: {e}")
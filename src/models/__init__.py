@@ -9,6 +9,7 @@ from .modello import ModelloModel
 from .chat import ChatModel
 from .messaggio import MessaggioModel
 from .allegato import AllegatoModel
+from .blob import BlobModel
 from .messaggio_in_chat import MessaggioInChatModel
 from .tool import ToolModel
 from .mcp_server import MCPServerModel
@@ -22,6 +23,7 @@ __all__ = [
     'ChatModel',
     'MessaggioModel',
     'AllegatoModel',
+    'BlobModel',
     'MessaggioInChatModel',
     'ToolModel',
     'MCPServerModel',
@@ -15,13 +15,15 @@ class AllegatoModel(BaseModel):
     messaggio_timestamp = DateTimeField()
     tipo = CharField(max_length=50)  # image, video, audio, text, file
     mime_type = CharField(max_length=100, null=True)
-    contenuto = TextField()  # Base64 per binari, testo per text/plain
+    contenuto = TextField(default='')  # solo allegati salvati prima dei blob: base64 per binari, testo per text/plain
+    blob_hash = CharField(max_length=64, null=True)  # sha256 del contenuto in BlobModel
     filename = CharField(max_length=500, null=True)
     
     class Meta:
         table_name = 'allegato'
         indexes = (
             (('messaggio_id', 'messaggio_timestamp'), False),  # Indice per foreign key
+            (('blob_hash',), False),  # Indice per i riferimenti ai blob
         )
 
 # Made with Bob
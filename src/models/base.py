@@ -28,12 +28,12 @@ class BaseModel(Model):
             # Importa tutti i modelli
             from . import (
                 ProviderModel, ConfigurazioneRagModel, ModelloModel,
-                ChatModel, MessaggioModel, AllegatoModel,
+                ChatModel, MessaggioModel, AllegatoModel, BlobModel,
                 MessaggioInChatModel, ToolModel, MCPServerModel
             )
             models = [
                 ProviderModel, ConfigurazioneRagModel, ModelloModel,
-                ChatModel, MessaggioModel, AllegatoModel,
+                ChatModel, MessaggioModel, AllegatoModel, BlobModel,
                 MessaggioInChatModel, ToolModel, MCPServerModel
             ]
         
@@ -45,11 +45,11 @@ class BaseModel(Model):
         if models is None:
             from . import (
                 ProviderModel, ConfigurazioneRagModel, ModelloModel,
-                ChatModel, MessaggioModel, AllegatoModel,
+                ChatModel, MessaggioModel, AllegatoModel, BlobModel,
                 MessaggioInChatModel, ToolModel, MCPServerModel
             )
             models = [
-                MCPServerModel, ToolModel, MessaggioInChatModel, AllegatoModel,
+                MCPServerModel, ToolModel, MessaggioInChatModel, BlobModel, AllegatoModel,
                 MessaggioModel, ChatModel, ModelloModel,
                 ConfigurazioneRagModel, ProviderModel
             ]
@@ -0,0 +1,22 @@
+"""
+Modello per i contenuti degli allegati, indirizzati per hash
+"""
+
+from peewee import CharField, IntegerField, BlobField
+from .base import BaseModel
+
+
+class BlobModel(BaseModel):
+    """
+    Contenuto binario di un allegato, identificato dal suo sha256: lo stesso file allegato in più
+    messaggi o in più chat viene memorizzato una sola volta. I contenuti piccoli stanno nella tabella,
+    quelli grandi in un file su disco (percorso). riferimenti conta gli allegati che lo usano.
+    """
+    hash = CharField(primary_key=True, max_length=64)  # sha256 esadecimale del contenuto
+    dimensione = IntegerField()
+    contenuto = BlobField(null=True)   # byte grezzi, se il blob è nel database
+    percorso = CharField(max_length=500, null=True)  # file con i byte grezzi, se il blob è su disco
+    riferimenti = IntegerField(default=0)
+    
+    class Meta:
+        table_name = 'blob'
@@ -2,7 +2,8 @@
 Modello per la configurazione RAG di ogni provider
 """
 
-from peewee import CharField, IntegerField, BooleanField, ForeignKeyField
+from peewee import CharField, IntegerField, BooleanField, FloatField, TextField, ForeignKeyField
+import json
 from .base import BaseModel
 from .provider import ProviderModel
 
@@ -17,6 +18,11 @@ class ConfigurazioneRagModel(BaseModel):
     top_k = IntegerField(default=5)
     directory_allegati = CharField(max_length=500, default='uploads')
     modalita_ricerca = CharField(max_length=50, default='similarity')
+    rerank = BooleanField(default=False)
+    budget_rerank_ms = IntegerField(default=1500)
+    lambda_mmr = FloatField(default=0.3)
+    fetch_k = IntegerField(default=0)  # 0 = automatico
+    corpora = TextField(default='[]')  # JSON array con i nomi delle basi di conoscenza interrogate
     
     class Meta:
         table_name = 'configurazione_rag'
@@ -29,6 +35,11 @@ class ConfigurazioneRagModel(BaseModel):
             'top_k': self.top_k,
             'directory_allegati': self.directory_allegati,
             'modalita_ricerca': self.modalita_ricerca,
+            'rerank': self.rerank,
+            'budget_rerank_ms': self.budget_rerank_ms,
+            'lambda_mmr': self.lambda_mmr,
+            'fetch_k': self.fetch_k,
+            'corpora': json.loads(self.corpora) if self.corpora else [],
         }
 
 # Made with Bob
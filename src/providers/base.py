@@ -8,9 +8,15 @@ from src.Messaggio import Messaggio
 from src.Allegato import Allegato
 from src.ConfigurazioneDB import ConfigurazioneDB
 from src.providers.rag import Rag
-import base64, validators
+from src.providers.contesto import GestoreContesto
+from src.ciclo_eventi import CicloEventi, ProxyThreadChiamante
+import asyncio, base64, validators, time
 
 class Provider(ABC):
+
+    # aggiornamenti al secondo della risposta mostrata durante lo streaming: ogni aggiornamento
+    # rielabora tutto il Markdown, quindi aggiornare ad ogni token peserebbe sulla CPU
+    STREAMING_FPS = 10
       
     def __init__(self, nome, base_url, prefisso_token=""):
         self._nome=nome
@@ -22,9 +28,12 @@ class Provider(ABC):
         self._client=None
         self._modalita_agentica = False # indica se la modalità agentica è attivata o no
         self._agent = None   # l'agent
+        self._firma_agent = None  # (client, tools) con cui è stato creato l'agent
         self._tools = []  # i tools per l'agent
         self._cronologia_messaggi = {} # dizionario che associa un modello alla sua cronologia dei messaggi
         self._modello_scelto = ""
+        self._metriche_streaming = {} # dizionario che associa un modello alle metriche delle risposte in streaming
+        self._gestori_contesto = {} # dizionario che associa un modello al gestore della sua finestra di contesto
         self._motore_di_embedding=None
         self.set_disponibile(False) # mi dice se il provider è raggiungibile via rete o temporaneamente irragiungibile
         self._rag : Rag = Rag()
@@ -43,40 +52,55 @@ class Provider(ABC):
                 topk=rag_config.get("top_k", 5),
                 modello=rag_config.get("modello"),
                 upload_dir=rag_config.get("directory_allegati", "uploads"),
-                modalita_ricerca=rag_config.get("modalita_ricerca", "similarity")
+                modalita_ricerca=rag_config.get("modalita_ricerca", "similarity"),
+                rerank=rag_config.get("rerank", False),
+                budget_rerank_ms=rag_config.get("budget_rerank_ms"),
+                lambda_mmr=rag_config.get("lambda_mmr"),
+                fetch_k=rag_config.get("fetch_k"),
+                corpora=rag_config.get("corpora", [])
             )
 
     """
         Ritorna una lista di tuple (m0, m1) in cui m0 è un messaggio in formato Langchain (quindi un'istanza 
         di HumanMessage, AIMessage,...) mentre m1 è un'istanza della classe Messaggio, usata per mostrare 
-        il contenuto sulla GUI e per i salvataggi sul DB
+        il contenuto sulla GUI e per i salvataggi sul DB.
+        Per i messaggi caricati dal DB m0 è None: viene costruito da _completa_cronologia() solo quando la
+        cronologia viene inviata al modello, così riaprire una chat non legge il contenuto degli allegati.
     """
     def _carica_cronologia_da_disco(self, modello) -> list[tuple]:
-        # ricostruisco la cronologia prendendo i messaggi dal database e ricostruendo l'equivalente messaggio in formato Langchain
-        messaggi_su_disco = ConfigurazioneDB.carica_cronologia(self._nome, modello)
-        tuple_da_ritornare=[]
-        for m in messaggi_su_disco:            
-            match m.get_ruolo():
-                case "system":
-                    tuple_da_ritornare.append((SystemMessage(content=m.get_testo()), m))
-                case "user"|"ai"|"assistant":
-                    blocchi=[{"type": "text", "text": m.get_testo()}]
-                    for allegato in m.get_allegati():
-                        contenuto = allegato.contenuto
-                        tipo      = allegato.tipo
-                        mime_type = allegato.mime_type
-                        filename  = allegato.filename                        
-                        if tipo in ("image", "video", "audio"):
-                            blocchi.append({"type": tipo, "mime_type": mime_type, "base64": contenuto})
-                        elif mime_type=="text/plain":
-                            blocchi.append({"type": "text-plain", "mime_type": mime_type, "text": contenuto})
-                        else:
-                            blocchi.append({"type": "file", "mime_type": mime_type, "base64": contenuto, "filename": filename})
-                    if m.get_ruolo()=="user":
-                        tuple_da_ritornare.append((HumanMessage(content_blocks=blocchi), m))
-                    else: # m.get_ruolo()=="ai" o "assistant"
-                        tuple_da_ritornare.append((AIMessage(content_blocks=blocchi), m))
-        return tuple_da_ritornare
+        return [(None, m) for m in ConfigurazioneDB.carica_cronologia(self._nome, modello)]
+
+    def _completa_cronologia(self, cronologia: list[tuple]):
+        # ricostruisco l'equivalente in formato Langchain dei messaggi caricati dal database
+        for i, (m0, m1) in enumerate(cronologia):
+            if m0 is None:
+                cronologia[i] = (self._messaggio_langchain(m1), m1)
+
+    def _messaggio_langchain(self, m: Messaggio):
+        if m.get_ruolo()=="system":
+            return SystemMessage(content=m.get_testo())
+        blocchi=[{"type": "text", "text": m.get_testo()}]
+        for allegato in m.get_allegati():
+            if not allegato.caricato():
+                # i messaggi caricati dal DB sono tutti turni passati, di cui GestoreContesto invia solo un
+                # segnaposto al posto degli allegati: basta costruirlo dai metadati, senza leggere il blob
+                multimediale = allegato.tipo in ("image", "video", "audio")
+                blocchi.append(GestoreContesto.segnaposto_allegato(allegato.mime_type or allegato.tipo,
+                                                                   "" if multimediale else allegato.filename or ""))
+                continue
+            contenuto = allegato.contenuto
+            tipo      = allegato.tipo
+            mime_type = allegato.mime_type
+            filename  = allegato.filename                        
+            if tipo in ("image", "video", "audio"):
+                blocchi.append({"type": tipo, "mime_type": mime_type, "base64": contenuto})
+            elif mime_type=="text/plain":
+                blocchi.append({"type": "text-plain", "mime_type": mime_type, "text": contenuto})
+            else:
+                blocchi.append({"type": "file", "mime_type": mime_type, "base64": contenuto, "filename": filename})
+        if m.get_ruolo()=="user":
+            return HumanMessage(content_blocks=blocchi)
+        return AIMessage(content_blocks=blocchi) # m.get_ruolo()=="ai" o "assistant"
 
     def to_dict(self):
         return {
@@ -89,7 +113,12 @@ class Provider(ABC):
                 "modello": self._rag.get_modello(),
                 "top_k": self._rag.get_topk(),
                 "directory_allegati": self._rag.get_upload_dir(),
-                "modalita_ricerca": self._rag.get_modalita_ricerca()
+                "modalita_ricerca": self._rag.get_modalita_ricerca(),
+                "rerank": self._rag.get_rerank(),
+                "budget_rerank_ms": self._rag.get_budget_rerank_ms(),
+                "lambda_mmr": self._rag.get_lambda_mmr(),
+                "fetch_k": self._rag.get_fetch_k(),
+                "corpora": self._rag.get_corpora()
             }
         }
         
@@ -138,15 +167,26 @@ class Provider(ABC):
         """
         self._tools = tools
     
+    def _agent_aggiornato(self) -> bool:
+        """Ritorna True se l'agent esistente è stato creato con il client e i tools attuali."""
+        if self._agent is None or self._firma_agent is None:
+            return False
+        client, tools = self._firma_agent
+        # confronto per identità: gli oggetti vengono ricreati solo quando cambia la configurazione
+        return client is self._client and len(tools) == len(self._tools) and all(a is b for a, b in zip(tools, self._tools))
+
     def _crea_agent(self):
-        """Crea l'agent """
+        """Crea l'agent, a meno che quello esistente non usi già lo stesso client e gli stessi tools."""
         if not self._client:
             raise Exception("Client LLM non inizializzato.")
+        if self._agent_aggiornato():
+            return
         try:
             self._agent = create_agent(
                 model=self._client,
                 tools=self._tools,
             )
+            self._firma_agent = (self._client, list(self._tools))
         except ImportError as e:
             raise Exception(f"LangChain agents non disponibile: {e}. Assicurati di avere langchain-agents e langgraph installati.")
         except Exception as e:
@@ -162,12 +202,17 @@ class Provider(ABC):
         return self._base_url
     
     # Abilita o disabilita l'uso del RAG
-    def set_rag(self, attivo: bool = False, topk: int = 3, modello: str = "", upload_dir="uploads/", modalita_ricerca=Rag.AVAILABLE_SEARCH_MODALITIES[0], status_callback=None):
+    def set_rag(self, attivo: bool = False, topk: int = 3, modello: str = "", upload_dir="uploads/", modalita_ricerca=Rag.AVAILABLE_SEARCH_MODALITIES[0], status_callback=None,
+                rerank: bool = False, budget_rerank_ms: int | None = None, lambda_mmr: float | None = None, fetch_k: int | None = None,
+                corpora: list[str] | None = None):
         self._rag.set_attivo(attivo)
         self._rag.set_topk(topk)
         self._rag.set_modello(modello)
         self._rag.set_upload_dir(upload_dir)
         self._rag.set_modalita_ricerca(modalita_ricerca)
+        self._rag.set_rerank(rerank, budget_rerank_ms)
+        self._rag.set_parametri_mmr(lambda_mmr, fetch_k)
+        self._rag.set_corpora(corpora)
         if status_callback:
             self._rag._status_callback = status_callback
         
@@ -212,7 +257,7 @@ class Provider(ABC):
             self._client=None
             raise Exception(errore)
     
-    async def invia_messaggi(self, messaggi: list[Messaggio], status_container=None):
+    async def invia_messaggi(self, messaggi: list[Messaggio], status_container=None, stream_callback=None):
         """
         Invia i messaggi al modello multimodale e aggiorna la cronologia.
         Versione asincrona per supportare streaming in tempo reale dei tool MCP.
@@ -220,6 +265,8 @@ class Provider(ABC):
         Args:
             messaggi: Lista di messaggi da inviare.
             status_container: Container Streamlit per mostrare il feedback (opzionale).
+            stream_callback: Funzione chiamata con il testo ricevuto fino a quel momento mentre la risposta
+                             viene generata (opzionale). Senza callback la risposta viene attesa per intero.
         """
         if not self._modello_scelto:
             raise Exception("Client non inizializzato. Inserisci un'API KEY valida e scegli un modello.")
@@ -239,7 +286,9 @@ class Provider(ABC):
                         blocchi=[{"type": "text", "text": m.get_testo()}]
                         if self._rag.get_attivo(): # sostituisco i file allegati con il testo tornato dal VectorDB
                             self._rag.set_prompt(m)
-                            allegati_rag: list[Allegato] = self.rag()
+                            # RAG sincrono e lento (parsing, embedding, riordino): in un thread di lavoro
+                            # per non bloccare il ciclo di eventi condiviso da tutte le sessioni
+                            allegati_rag: list[Allegato] = await asyncio.to_thread(self.rag)
                             contenuti_rag="\n---\n".join(allegato.contenuto for allegato in allegati_rag)
                             blocchi.append({"type": "text", "text": preambolo_rag})
                             blocchi.append({"type": "text", "text": contenuti_rag})
@@ -257,8 +306,9 @@ class Provider(ABC):
                     case _:
                         pass
 
-            cronologia_precedente=[messaggio for messaggio, _ in cronologia_modello]
-            cronologia_completa = cronologia_precedente + messaggi_da_inviare
+            await asyncio.to_thread(self._completa_cronologia, cronologia_modello)
+            # la cronologia viene ridotta entro il budget di token del modello (allegati già inviati e turni vecchi riassunti)
+            cronologia_completa = await self.get_gestore_contesto().prepara(cronologia_modello, messaggi_da_inviare, self._client)
             
             # Crea il prompt template
             prompt = ChatPromptTemplate.from_messages([*cronologia_completa])
@@ -277,49 +327,53 @@ class Provider(ABC):
                     
                     status_container.write("🧠 Analisi del problema in corso...")
                 
-                # Usa streaming asincrono per aggiornamenti in tempo reale
-                risposta_completa = None
+                if stream_callback:
+                    # Risposta finale token per token, chiamate ai tool con la loro durata
+                    testo_risposta = await self._esegui_agent_in_streaming(cronologia_completa, status_container, stream_callback)
+                else:
+                    # Usa streaming asincrono per aggiornamenti in tempo reale
+                    risposta_completa = None
                 
-                async for chunk in self._agent.astream({"messages": cronologia_completa}):
-                    if "messages" in chunk:
-                        for msg in chunk["messages"]:
-                            # Verifica se il messaggio contiene tool calls
-                            if hasattr(msg, 'tool_calls') and msg.tool_calls:
-                                for tool_call in msg.tool_calls:
-                                    tool_name = tool_call.get('name', 'Unknown')
-                                    # Mostra ogni chiamata al tool (anche se ripetuta)
+                    async for chunk in self._agent.astream({"messages": cronologia_completa}):
+                        if "messages" in chunk:
+                            for msg in chunk["messages"]:
+                                # Verifica se il messaggio contiene tool calls
+                                if hasattr(msg, 'tool_calls') and msg.tool_calls:
+                                    for tool_call in msg.tool_calls:
+                                        tool_name = tool_call.get('name', 'Unknown')
+                                        # Mostra ogni chiamata al tool (anche se ripetuta)
+                                        if status_container:
+                                            status_container.write(f"🔧 Utilizzo tool: **{tool_name}**")
+                                # Verifica se è una risposta di un tool
+                                elif hasattr(msg, 'type') and msg.type == 'tool':
                                     if status_container:
-                                        status_container.write(f"🔧 Utilizzo tool: **{tool_name}**")
-                            # Verifica se è una risposta di un tool
-                            elif hasattr(msg, 'type') and msg.type == 'tool':
-                                if status_container:
-                                    status_container.write(f"✅ Tool completato")
+                                        status_container.write(f"✅ Tool completato")
                     
-                    # Salva l'ultimo chunk come risposta completa
-                    risposta_completa = chunk
+                        # Salva l'ultimo chunk come risposta completa
+                        risposta_completa = chunk
                 
-                # Estrae l'ultimo messaggio dell'agent (risposta finale)
-                if not risposta_completa:
-                    raise Exception("L'agent non ha prodotto nessuna risposta. Verifica che l'agent sia configurato correttamente e che i tool siano disponibili.")
+                    # Estrae l'ultimo messaggio dell'agent (risposta finale)
+                    if not risposta_completa:
+                        raise Exception("L'agent non ha prodotto nessuna risposta. Verifica che l'agent sia configurato correttamente e che i tool siano disponibili.")
                 
-                # Gestisce diversi formati di risposta dall'agent
-                # Formato 1: {'messages': [...]}
-                # Formato 2: {'model': {'messages': [...]}}
-                messages_list = None
-                if "messages" in risposta_completa:
-                    messages_list = risposta_completa["messages"]
-                elif "model" in risposta_completa and isinstance(risposta_completa["model"], dict):
-                    if "messages" in risposta_completa["model"]:
-                        messages_list = risposta_completa["model"]["messages"]
+                    # Gestisce diversi formati di risposta dall'agent
+                    # Formato 1: {'messages': [...]}
+                    # Formato 2: {'model': {'messages': [...]}}
+                    messages_list = None
+                    if "messages" in risposta_completa:
+                        messages_list = risposta_completa["messages"]
+                    elif "model" in risposta_completa and isinstance(risposta_completa["model"], dict):
+                        if "messages" in risposta_completa["model"]:
+                            messages_list = risposta_completa["model"]["messages"]
                 
-                if not messages_list:
-                    raise Exception(f"Formato risposta agent non valido. Chunk ricevuto: {risposta_completa}")
+                    if not messages_list:
+                        raise Exception(f"Formato risposta agent non valido. Chunk ricevuto: {risposta_completa}")
                 
-                if not messages_list:
-                    raise Exception("L'agent ha prodotto una risposta vuota. Verifica la configurazione del modello e dei tool.")
+                    if not messages_list:
+                        raise Exception("L'agent ha prodotto una risposta vuota. Verifica la configurazione del modello e dei tool.")
                 
-                ultimo_messaggio = messages_list[-1]
-                testo_risposta = getattr(ultimo_messaggio, "content", "")
+                    ultimo_messaggio = messages_list[-1]
+                    testo_risposta = getattr(ultimo_messaggio, "content", "")
                 
                 # Se il contenuto è vuoto o solo spazi, è normale quando l'agent usa solo tool
                 if not testo_risposta or not testo_risposta.strip():
@@ -335,7 +389,10 @@ class Provider(ABC):
             else:
                 # Modalità normale (codice esistente)
                 base_chain = prompt | self._client
-                risposta = base_chain.invoke({})
+                if stream_callback:
+                    risposta = await self._ricevi_in_streaming(base_chain, stream_callback)
+                else:
+                    risposta = await base_chain.ainvoke({})
                 testo_risposta = getattr(risposta, "content", risposta)
                 allegati_risposta = getattr(risposta, "content_blocks", [])
                 m = AIMessage(content=testo_risposta, content_blocks=allegati_risposta)
@@ -351,6 +408,134 @@ class Provider(ABC):
         except Exception as errore:
             raise Exception(f"Errore nell'invio del messaggio: {errore}")
             
+    async def _ricevi_in_streaming(self, catena, stream_callback):
+        """
+        Riceve la risposta un token alla volta e passa a stream_callback il testo accumulato,
+        al massimo STREAMING_FPS volte al secondo più un'ultima volta a risposta completa.
+        Registra il tempo al primo token e i token al secondo del modello scelto.
+        Ritorna il messaggio completo, ottenuto sommando i chunk ricevuti.
+        """
+        intervallo = 1 / self.STREAMING_FPS
+        inizio = time.perf_counter()
+        ultimo_aggiornamento = 0.0
+        primo_token = None
+        risposta = None
+        testo = ""
+        chunk_ricevuti = 0
+        async for chunk in catena.astream({}):
+            risposta = chunk if risposta is None else risposta + chunk
+            pezzo = chunk.text
+            if not pezzo:
+                continue
+            chunk_ricevuti += 1
+            if primo_token is None:
+                primo_token = time.perf_counter() - inizio
+            testo += pezzo
+            ora = time.perf_counter()
+            if ora - ultimo_aggiornamento >= intervallo:
+                stream_callback(testo)
+                ultimo_aggiornamento = ora
+        if risposta is None:
+            raise Exception("Il modello non ha prodotto nessuna risposta.")
+        stream_callback(testo)
+        # se il provider non riporta l'utilizzo, ogni chunk di testo vale circa un token
+        utilizzo = getattr(risposta, "usage_metadata", None) or {}
+        self._registra_metriche_streaming(primo_token, utilizzo.get("output_tokens") or chunk_ricevuti, time.perf_counter() - inizio)
+        return risposta
+
+    async def _esegui_agent_in_streaming(self, cronologia_completa, status_container, stream_callback) -> str:
+        """
+        Esegue l'agent consumandone gli eventi (astream_events v2) invece dei soli passi completi:
+        - i token del modello vengono passati a stream_callback (al massimo STREAMING_FPS volte al secondo);
+          il testo viene azzerato quando parte un tool, perché quello generato fino a lì non era la risposta finale;
+        - l'inizio e la fine di ogni tool, con la durata, vengono scritti nello status_container.
+        Ritorna il testo dell'ultima risposta del modello senza chiamate a tool, cioè la risposta finale.
+        """
+        intervallo = 1 / self.STREAMING_FPS
+        inizio = time.perf_counter()
+        ultimo_aggiornamento = 0.0
+        primo_token = None
+        testo = ""
+        chunk_ricevuti = 0
+        risposta_finale = None
+        inizio_tools = {}  # run_id -> istante di avvio del tool
+        async for evento in self._agent.astream_events({"messages": cronologia_completa}, version="v2"):
+            tipo = evento["event"]
+            # i modelli chiamati dentro ai tool non fanno parte della risposta dell'agent
+            if tipo.startswith("on_chat_model") and evento.get("metadata", {}).get("langgraph_node") == "tools":
+                continue
+            match tipo:
+                case "on_chat_model_stream":
+                    pezzo = evento["data"]["chunk"].text
+                    if not pezzo:
+                        continue
+                    chunk_ricevuti += 1
+                    if primo_token is None:
+                        primo_token = time.perf_counter() - inizio
+                    testo += pezzo
+                    ora = time.perf_counter()
+                    if ora - ultimo_aggiornamento >= intervallo:
+                        stream_callback(testo)
+                        ultimo_aggiornamento = ora
+                case "on_chat_model_end":
+                    output = evento["data"].get("output")
+                    if output is not None and not getattr(output, "tool_calls", None):
+                        risposta_finale = output
+                case "on_tool_start":
+                    inizio_tools[evento["run_id"]] = time.perf_counter()
+                    testo = ""
+                    stream_callback(testo)
+                    if status_container:
+                        status_container.write(f"🔧 Utilizzo tool: **{evento['name']}**")
+                case "on_tool_end" | "on_tool_error":
+                    durata_tool = time.perf_counter() - inizio_tools.pop(evento["run_id"], time.perf_counter())
+                    if status_container:
+                        if tipo == "on_tool_end":
+                            status_container.write(f"✅ Tool **{evento['name']}** completato in {durata_tool:.2f}s")
+                        else:
+                            status_container.write(f"❌ Tool **{evento['name']}** fallito dopo {durata_tool:.2f}s: {evento['data'].get('error')}")
+        if risposta_finale is None and not testo:
+            raise Exception("L'agent non ha prodotto nessuna risposta. Verifica che l'agent sia configurato correttamente e che i tool siano disponibili.")
+        testo_risposta = risposta_finale.text if risposta_finale is not None else testo
+        stream_callback(testo_risposta)
+        utilizzo = getattr(risposta_finale, "usage_metadata", None) or {}
+        self._registra_metriche_streaming(primo_token, utilizzo.get("output_tokens") or chunk_ricevuti, time.perf_counter() - inizio)
+        return testo_risposta
+
+    def _registra_metriche_streaming(self, primo_token, token, durata):
+        metriche = self._metriche_streaming.setdefault(self._modello_scelto, {"risposte": 0, "ttft_medio": 0.0, "token_al_secondo_medio": 0.0})
+        # i token al secondo si misurano sulla sola generazione, escludendo l'attesa del primo token
+        generazione = durata - (primo_token or 0)
+        token_al_secondo = token / generazione if generazione > 0 else 0.0
+        n = metriche["risposte"] + 1
+        metriche.update({
+            "risposte": n,
+            "ttft": primo_token or 0.0,
+            "token": token,
+            "token_al_secondo": token_al_secondo,
+            "durata": durata,
+            "ttft_medio": metriche["ttft_medio"] + ((primo_token or 0.0) - metriche["ttft_medio"]) / n,
+            "token_al_secondo_medio": metriche["token_al_secondo_medio"] + (token_al_secondo - metriche["token_al_secondo_medio"]) / n
+        })
+
+    def get_metriche_streaming(self, modello=None) -> dict:
+        """
+        Ritorna le metriche delle risposte in streaming del modello (di default quello scelto):
+        ttft (secondi al primo token), token, token_al_secondo e durata dell'ultima risposta,
+        più il numero di risposte e le medie di ttft e token al secondo.
+        """
+        return dict(self._metriche_streaming.get(modello or self._modello_scelto, {}))
+
+    def get_gestore_contesto(self, modello=None) -> GestoreContesto:
+        """Ritorna il gestore della finestra di contesto del modello (di default quello scelto), creandolo se manca."""
+        modello = modello or self._modello_scelto
+        if modello not in self._gestori_contesto:
+            self._gestori_contesto[modello] = GestoreContesto()
+        return self._gestori_contesto[modello]
+
+    def set_budget_contesto(self, budget_token: int, modello=None):
+        self.get_gestore_contesto(modello).set_budget(budget_token)
+
     # converte un messaggio di Langchain (AIMessage, SystemMessage, HumanMessage,...) in un'istanza della classe Messaggio
     def _converti_messaggio(self, m):
         ruolo=m.type
@@ -433,8 +618,11 @@ class Provider(ABC):
         """
         import streamlit as st
         
-        # Crea un container per i messaggi di stato
-        status_container = st.status("🔄 Elaborazione RAG in corso...", expanded=True)
+        # Crea un container per i messaggi di stato. Il RAG viene eseguito da invia_messaggi() in un thread
+        # di lavoro: le chiamate a Streamlit vanno fatte nel thread dello script, che st.status crea qui
+        # mentre il thread di lavoro (non il ciclo di eventi) ne aspetta il risultato
+        crea_status = CicloEventi.nel_thread_chiamante(st.status, attendi=True)
+        status_container = ProxyThreadChiamante(crea_status("🔄 Elaborazione RAG in corso...", expanded=True))
         
         def status_callback(message: str):
             """Callback per mostrare i messaggi di stato durante il RAG."""
@@ -0,0 +1,211 @@
+import numpy as np
+import os, json, logging, hashlib, threading, shutil
+
+class CacheEmbedding():
+    """
+    Cache su disco degli embedding dei chunk, condivisa da tutte le collection.
+    Ogni embedding è identificato da (motore, endpoint, modello, sha256 del testo del chunk): lo stesso
+    testo caricato di nuovo con un altro chunker, o presente in più documenti (intestazioni, licenze,
+    pagine ripetute), viene calcolato una sola volta. L'endpoint distingue i provider compatibili con
+    OpenAI che servono modelli diversi con lo stesso nome.
+    Per ogni modello c'è una directory con due file:
+    - vettori.f32: gli embedding in float32, una riga dopo l'altra, a cui si aggiungono solo righe in coda;
+    - indice.jsonl: la dimensione dei vettori (prima riga) e una riga [sha256 del testo, numero di riga]
+      per ogni embedding, anch'esso scritto solo in coda.
+    I vettori vengono letti con numpy.memmap, senza caricare tutto il file in RAM. Quando i vettori di un
+    modello superano MAX_SPAZIO_MB vengono tenuti solo i più recenti (metà del limite).
+    """
+
+    DIRECTORY = os.path.join("vectorstore_cache", "embeddings")
+    FILE_VETTORI = "vettori.f32"
+    FILE_INDICE = "indice.jsonl"
+    # indice delle versioni precedenti (un unico JSON riscritto ad ogni aggiunta), convertito al primo utilizzo
+    FILE_INDICE_JSON = "indice.json"
+    # spazio massimo (in MB) dei vettori di ogni modello, modificabile con una variabile d'ambiente
+    MAX_SPAZIO_MB = int(os.environ.get("DAPABOT_CACHE_EMBEDDING_MB", "1024"))
+
+    # directory del modello -> {"dimensione": int, "righe": {sha256: riga}, "mappa": np.memmap | None}
+    _modelli = {}
+    _lock = threading.Lock()
+    _hit = 0
+    _miss = 0
+
+    @classmethod
+    def embed_documents(cls, motore, modello: str, testi: list[str]) -> list[list[float]]:
+        """
+        Ritorna gli embedding dei testi nello stesso ordine, chiedendo al motore solo quelli
+        che non sono già nella cache (e una sola volta per i testi ripetuti).
+        """
+        if not testi:
+            return []
+        directory = cls._directory_modello(motore, modello)
+        impronte = [hashlib.sha256(testo.encode("utf-8")).hexdigest() for testo in testi]
+        with cls._lock:
+            dati = cls._carica(directory)
+            # i vettori trovati vengono copiati subito: la compattazione (anche di un altro thread)
+            # può eliminare le loro righe prima che il risultato venga costruito
+            trovati, mancanti = {}, {}
+            for impronta, testo in zip(impronte, testi):
+                if impronta in dati["righe"]:
+                    if impronta not in trovati:
+                        trovati[impronta] = dati["mappa"][dati["righe"][impronta]].tolist()
+                elif impronta not in mancanti:
+                    mancanti[impronta] = testo
+        calcolati = motore.embed_documents(list(mancanti.values())) if mancanti else []
+        with cls._lock:
+            dati = cls._carica(directory)
+            if calcolati:
+                try:
+                    cls._aggiungi(directory, dati, dict(zip(mancanti, calcolati)))
+                except Exception as e:
+                    # la cache non deve mai bloccare il RAG: gli embedding appena calcolati vengono comunque usati
+                    logging.warning(f"[RAG] Impossibile salvare gli embedding nella cache: {e}")
+            nuovi = dict(zip(mancanti, calcolati))
+            cls._hit += len(testi) - len(mancanti)
+            cls._miss += len(mancanti)
+        return [list(nuovi[impronta]) if impronta in nuovi else list(trovati[impronta]) for impronta in impronte]
+
+    @classmethod
+    def statistiche(cls) -> dict:
+        """Ritorna hit/miss della sessione, il numero di embedding salvati e lo spazio occupato su disco (in MB)."""
+        embedding, spazio = 0, 0
+        if os.path.isdir(cls.DIRECTORY):
+            for nome in os.listdir(cls.DIRECTORY):
+                vettori = os.path.join(cls.DIRECTORY, nome, cls.FILE_VETTORI)
+                indice = os.path.join(cls.DIRECTORY, nome, cls.FILE_INDICE)
+                if os.path.exists(vettori):
+                    spazio += os.path.getsize(vettori)
+                if os.path.exists(indice):
+                    spazio += os.path.getsize(indice)
+                    try:
+                        with open(indice, "r", encoding="utf-8") as f:
+                            embedding += max(0, sum(1 for _ in f) - 1)  # la prima riga è l'intestazione
+                    except Exception:
+                        pass
+        return {"hit": cls._hit, "miss": cls._miss, "embedding": embedding, "spazio_mb": round(spazio / (1024 * 1024), 1)}
+
+    @classmethod
+    def svuota(cls):
+        """Elimina tutti gli embedding salvati."""
+        with cls._lock:
+            cls._modelli.clear()
+            shutil.rmtree(cls.DIRECTORY, ignore_errors=True)
+
+    @classmethod
+    def _directory_modello(cls, motore, modello: str) -> str:
+        identita = f"{type(motore).__name__}|{modello}"
+        # i motori remoti (es. OpenAIEmbeddings) hanno un endpoint; quelli locali no e mantengono la directory di prima
+        endpoint = getattr(motore, "openai_api_base", None) or getattr(motore, "base_url", None)
+        if isinstance(endpoint, str) and endpoint:
+            identita += f"|{endpoint.rstrip('/')}"
+        nome = hashlib.sha1(identita.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(cls.DIRECTORY, nome)
+
+    @classmethod
+    def _carica(cls, directory: str) -> dict:
+        """Ritorna i dati del modello, leggendo l'indice da disco al primo utilizzo."""
+        dati = cls._modelli.get(directory)
+        if dati is not None:
+            return dati
+        dati = {"dimensione": 0, "righe": {}, "mappa": None}
+        try:
+            if not os.path.exists(os.path.join(directory, cls.FILE_INDICE)):
+                cls._converti_indice_json(directory)
+            with open(os.path.join(directory, cls.FILE_INDICE), "r", encoding="utf-8") as f:
+                dati["dimensione"] = json.loads(f.readline())["dimensione"]
+                righe = {}
+                for riga in f:
+                    try:
+                        impronta, numero = json.loads(riga)
+                    except ValueError:
+                        continue  # riga scritta a metà (es. processo interrotto)
+                    righe[impronta] = numero
+            # scarto le righe che non sono nel file dei vettori (es. file troncato)
+            righe_su_disco = cls._righe_su_disco(directory, dati["dimensione"])
+            dati["righe"] = {k: v for k, v in righe.items() if v < righe_su_disco}
+            cls._mappa(directory, dati)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"[RAG] Cache degli embedding illeggibile in {directory}, verrà ricreata: {e}")
+            dati = {"dimensione": 0, "righe": {}, "mappa": None}
+        cls._modelli[directory] = dati
+        return dati
+
+    @classmethod
+    def _converti_indice_json(cls, directory: str):
+        """Converte l'indice delle versioni precedenti (indice.json) nel formato a righe."""
+        percorso = os.path.join(directory, cls.FILE_INDICE_JSON)
+        if not os.path.exists(percorso):
+            return
+        with open(percorso, "r", encoding="utf-8") as f:
+            salvato = json.load(f)
+        cls._riscrivi_indice(directory, salvato["dimensione"], salvato["righe"])
+        os.remove(percorso)
+
+    @classmethod
+    def _riscrivi_indice(cls, directory: str, dimensione: int, righe: dict):
+        percorso = os.path.join(directory, cls.FILE_INDICE)
+        with open(f"{percorso}.tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"dimensione": dimensione}) + "\n")
+            f.writelines(json.dumps([impronta, numero]) + "\n" for impronta, numero in righe.items())
+        os.replace(f"{percorso}.tmp", percorso)
+
+    @classmethod
+    def _aggiungi(cls, directory: str, dati: dict, vettori: dict):
+        """Aggiunge in coda al file dei vettori quelli nuovi e in coda all'indice le loro righe."""
+        matrice = np.asarray(list(vettori.values()), dtype=np.float32)
+        if not dati["dimensione"]:
+            dati["dimensione"] = matrice.shape[1]
+        elif matrice.shape[1] != dati["dimensione"]:
+            raise ValueError(f"dimensione degli embedding cambiata: {matrice.shape[1]} invece di {dati['dimensione']}")
+        os.makedirs(directory, exist_ok=True)
+        percorso_indice = os.path.join(directory, cls.FILE_INDICE)
+        if not dati["righe"] or not os.path.exists(percorso_indice):
+            # cache nuova (o ricreata): l'indice riparte dall'intestazione e i vettori dalla prima riga
+            cls._riscrivi_indice(directory, dati["dimensione"], {})
+            prima_riga = 0
+        else:
+            # le nuove righe partono dalla fine del file: eventuali righe scritte senza indice vengono solo ignorate
+            prima_riga = cls._righe_su_disco(directory, dati["dimensione"])
+        with open(os.path.join(directory, cls.FILE_VETTORI), "ab") as f:
+            f.truncate(prima_riga * dati["dimensione"] * 4)
+            f.write(matrice.tobytes())
+        nuove = {impronta: prima_riga + posizione for posizione, impronta in enumerate(vettori)}
+        # l'indice viene scritto dopo i vettori: non punta mai a righe inesistenti
+        with open(percorso_indice, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps([impronta, numero]) + "\n" for impronta, numero in nuove.items())
+        dati["righe"].update(nuove)
+        cls._mappa(directory, dati)
+        if (prima_riga + len(nuove)) * dati["dimensione"] * 4 > cls.MAX_SPAZIO_MB * 1024 * 1024:
+            cls._compatta(directory, dati)
+
+    @classmethod
+    def _compatta(cls, directory: str, dati: dict):
+        """Tiene solo gli embedding aggiunti più di recente, fino a metà di MAX_SPAZIO_MB."""
+        da_tenere = max(1, int(cls.MAX_SPAZIO_MB * 1024 * 1024) // 2 // (dati["dimensione"] * 4))
+        recenti = sorted(dati["righe"].items(), key=lambda voce: voce[1])[-da_tenere:]
+        matrice = np.asarray(dati["mappa"][[numero for _, numero in recenti]], dtype=np.float32)
+        percorso = os.path.join(directory, cls.FILE_VETTORI)
+        with open(f"{percorso}.tmp", "wb") as f:
+            f.write(matrice.tobytes())
+        # la mappa va chiusa prima di sostituire il file (su Windows un file mappato non si può sostituire)
+        dati["mappa"] = None
+        os.replace(f"{percorso}.tmp", percorso)
+        dati["righe"] = {impronta: posizione for posizione, (impronta, _) in enumerate(recenti)}
+        cls._riscrivi_indice(directory, dati["dimensione"], dati["righe"])
+        cls._mappa(directory, dati)
+        logging.info(f"[RAG] Cache degli embedding in {directory} ridotta a {len(recenti)} embedding")
+
+    @classmethod
+    def _mappa(cls, directory: str, dati: dict):
+        righe = cls._righe_su_disco(directory, dati["dimensione"])
+        dati["mappa"] = np.memmap(os.path.join(directory, cls.FILE_VETTORI), dtype=np.float32, mode="r",
+                                  shape=(righe, dati["dimensione"])) if righe else None
+
+    @classmethod
+    def _righe_su_disco(cls, directory: str, dimensione: int) -> int:
+        percorso = os.path.join(directory, cls.FILE_VETTORI)
+        if not dimensione or not os.path.exists(percorso):
+            return 0
+        return os.path.getsize(percorso) // (dimensione * 4)
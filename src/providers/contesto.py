@@ -0,0 +1,156 @@
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AIMessage
+from langchain_core.messages.utils import count_tokens_approximately
+import logging
+
+class GestoreContesto():
+    """
+    Decide quali messaggi della cronologia di un modello inviare ad ogni turno, restando entro un
+    budget di token invece di inviare sempre tutta la cronologia:
+    - tiene un solo messaggio di sistema (il più recente), invece di uno per ogni turno;
+    - negli allegati dei turni passati sostituisce immagini, audio, video e file con un segnaposto
+      testuale: il modello li ha già visti quando sono stati inviati;
+    - se il budget viene superato, riassume i turni più vecchi e li sostituisce con il riassunto.
+    Il riassunto è incrementale (ogni volta vengono riassunti solo i turni nuovi insieme al
+    riassunto precedente) e ha un'isteresi: quando si supera il budget si taglia fino a scendere
+    a SOGLIA_DOPO_RIASSUNTO del budget, così il riassunto non viene rifatto ad ogni messaggio.
+    Un'istanza per ogni modello, perché il budget dipende dalla finestra di contesto del modello.
+    """
+
+    DEFAULT_BUDGET_TOKEN = 16000
+    # frazione del budget occupata dalla cronologia dopo un riassunto
+    SOGLIA_DOPO_RIASSUNTO = 0.6
+    # token massimi del riassunto (passati al modello come indicazione)
+    MAX_TOKEN_RIASSUNTO = 600
+    # caratteri per messaggio usati dal riassunto estrattivo (quando il modello non risponde)
+    CARATTERI_RIASSUNTO_ESTRATTIVO = 200
+    TIPI_ALLEGATO = ("image", "audio", "video", "file", "text-plain")
+
+    def __init__(self, budget_token: int = DEFAULT_BUDGET_TOKEN):
+        self._budget_token = budget_token
+        self._riassunto = ""
+        self._indice_taglio = 0       # numero di messaggi della cronologia coperti dal riassunto
+        self._primo_messaggio = None  # per accorgersi che la cronologia è stata svuotata o ricaricata
+        self._token_ultimo_invio = 0
+
+    def set_budget(self, budget_token: int):
+        if budget_token <= 0:
+            raise ValueError(f"Budget di token non valido: {budget_token}")
+        self._budget_token = budget_token
+
+    def get_budget(self) -> int:
+        return self._budget_token
+
+    def get_riassunto(self) -> str:
+        return self._riassunto
+
+    def statistiche(self) -> dict:
+        return {
+            "budget": self._budget_token,
+            "token_ultimo_invio": self._token_ultimo_invio,
+            "messaggi_riassunti": self._indice_taglio
+        }
+
+    def reset(self):
+        self._riassunto = ""
+        self._indice_taglio = 0
+        self._primo_messaggio = None
+
+    async def prepara(self, cronologia: list[tuple], nuovi: list[BaseMessage], client=None) -> list[BaseMessage]:
+        """
+        Ritorna i messaggi da inviare al modello: cronologia (lista di tuple (messaggio Langchain, Messaggio))
+        ridotta entro il budget, seguita dai nuovi messaggi, che vengono sempre inviati per intero.
+        client è il modello usato per il riassunto; se manca o fallisce il riassunto è estrattivo.
+        """
+        precedenti = [m for m, _ in cronologia]
+        if not precedenti or precedenti[0] is not self._primo_messaggio or len(precedenti) < self._indice_taglio:
+            self.reset()
+            self._primo_messaggio = precedenti[0] if precedenti else None
+
+        # Un solo messaggio di sistema: quello del turno corrente o, se manca, il più recente della cronologia
+        sistema = next((m for m in reversed(nuovi) if isinstance(m, SystemMessage)), None) \
+            or next((m for m in reversed(precedenti) if isinstance(m, SystemMessage)), None)
+        nuovi = [m for m in nuovi if not isinstance(m, SystemMessage)]
+        storici = [(i, self._senza_allegati(m)) for i, m in enumerate(precedenti) if not isinstance(m, SystemMessage)]
+
+        fissi = count_tokens_approximately(nuovi) + (count_tokens_approximately([sistema]) if sistema else 0)
+        da_inviare = [m for i, m in storici if i >= self._indice_taglio]
+        if fissi + self._token_riassunto() + count_tokens_approximately(da_inviare) > self._budget_token:
+            # Isteresi: taglio fino a scendere sotto la soglia, iniziando sempre da un messaggio dell'utente
+            obiettivo = int(self._budget_token * self.SOGLIA_DOPO_RIASSUNTO) - fissi - self.MAX_TOKEN_RIASSUNTO
+            nuovo_taglio = self._indice_taglio
+            for posizione, (i, m) in enumerate(storici):
+                if i < self._indice_taglio or not isinstance(m, HumanMessage):
+                    continue
+                nuovo_taglio = i
+                if count_tokens_approximately([m for _, m in storici[posizione:]]) <= obiettivo:
+                    break
+            else:
+                nuovo_taglio = len(precedenti)  # nemmeno l'ultimo turno rientra: si riassume tutto
+            await self._aggiorna_riassunto([m for i, m in storici if self._indice_taglio <= i < nuovo_taglio], client)
+            self._indice_taglio = nuovo_taglio
+            da_inviare = [m for i, m in storici if i >= self._indice_taglio]
+
+        testata = []
+        if sistema or self._riassunto:
+            testo_sistema = sistema.text if sistema else ""
+            if self._riassunto:
+                testo_sistema += f"\n\nRiassunto della parte precedente della conversazione:\n{self._riassunto}"
+            testata = [SystemMessage(content=testo_sistema.strip())]
+        messaggi = testata + da_inviare + nuovi
+        self._token_ultimo_invio = count_tokens_approximately(messaggi)
+        return messaggi
+
+    def _token_riassunto(self) -> int:
+        return count_tokens_approximately([SystemMessage(content=self._riassunto)]) if self._riassunto else 0
+
+    def _senza_allegati(self, messaggio: BaseMessage) -> BaseMessage:
+        """Ritorna il messaggio con gli allegati multimediali sostituiti da un segnaposto testuale."""
+        if isinstance(messaggio.content, str):
+            return messaggio
+        blocchi, sostituiti = [], False
+        for blocco in messaggio.content_blocks:
+            if blocco.get("type") in self.TIPI_ALLEGATO:
+                nome = blocco.get("filename") or blocco.get("extras", {}).get("filename", "")
+                blocchi.append(self.segnaposto_allegato(blocco.get("mime_type", blocco["type"]), nome))
+                sostituiti = True
+            else:
+                blocchi.append(blocco)
+        if not sostituiti:
+            return messaggio
+        return type(messaggio)(content_blocks=blocchi)
+
+    @staticmethod
+    def segnaposto_allegato(mime_type: str, filename: str = "") -> dict:
+        """Blocco di testo che prende il posto di un allegato già inviato in un turno passato."""
+        descrizione = " ".join(x for x in (mime_type, filename) if x)
+        return {"type": "text", "text": f"[allegato {descrizione} già inviato in precedenza]"}
+
+    async def _aggiorna_riassunto(self, messaggi: list[BaseMessage], client):
+        if not messaggi:
+            return
+        trascrizione = "\n".join(f"{self._etichetta(m)}: {m.text}" for m in messaggi)
+        if client is not None:
+            try:
+                risposta = await client.ainvoke([
+                    SystemMessage(content=(
+                        "Aggiorna il riassunto di una conversazione con i nuovi messaggi. Mantieni fatti, decisioni, "
+                        "nomi, numeri e richieste ancora aperte; scrivi nella lingua della conversazione, in al massimo "
+                        f"{self.MAX_TOKEN_RIASSUNTO // 2} parole. Rispondi solo con il riassunto."
+                    )),
+                    HumanMessage(content=f"Riassunto attuale:\n{self._riassunto or '(vuoto)'}\n\nNuovi messaggi:\n{trascrizione}")
+                ])
+                if risposta.text.strip():
+                    self._riassunto = risposta.text.strip()
+                    return
+            except Exception as e:
+                logging.warning(f"[CONTESTO] Riassunto con il modello non riuscito, uso quello estrattivo: {e}")
+        # Riassunto estrattivo: l'inizio di ogni messaggio, entro il limite del riassunto
+        righe = [r for r in self._riassunto.splitlines() if r]
+        righe += [f"- {self._etichetta(m)}: {' '.join(m.text.split())[:self.CARATTERI_RIASSUNTO_ESTRATTIVO]}" for m in messaggi]
+        while len(righe) > 1 and count_tokens_approximately([SystemMessage(content="\n".join(righe))]) > self.MAX_TOKEN_RIASSUNTO:
+            righe.pop(0)
+        self._riassunto = "\n".join(righe)
+
+    @staticmethod
+    def _etichetta(messaggio: BaseMessage) -> str:
+        return "Utente" if isinstance(messaggio, HumanMessage) else "Assistente" if isinstance(messaggio, AIMessage) else messaggio.type
@@ -0,0 +1,133 @@
+from datetime import datetime
+import os, json, logging, hashlib, mimetypes, threading
+
+class Corpora():
+    """
+    Basi di conoscenza con nome. Ogni corpus è una directory i cui file vengono indicizzati una volta sola
+    e poi interrogati dal RAG ad ogni messaggio, senza doverli allegare di nuovo.
+    Per ogni corpus viene salvato in corpora.json l'elenco dei file con data di modifica, dimensione e
+    sha256: alla reindicizzazione vengono riletti solo i file con data o dimensione cambiate e analizzati
+    di nuovo solo quelli il cui contenuto (sha256) è davvero diverso.
+    I vectorstore dei file sono quelli della cache globale (la chiave è lo sha256 del file), quindi un file
+    già allegato in una chat, o presente in un altro corpus, non viene indicizzato di nuovo.
+    Con l'archiviazione separata ogni file del corpus costa una query (e un client Chroma aperto) ad ogni
+    messaggio; con quella consolidata i file vengono cercati con una query sola (vedi Rag._raggruppa_sorgenti).
+    """
+
+    FILE = os.path.join("vectorstore_cache", "corpora.json")
+    # estensioni dei file indicizzati (quelle gestite da Docling e i file di testo)
+    ESTENSIONI = (".pdf", ".docx", ".pptx", ".xlsx", ".html", ".htm", ".md", ".csv", ".txt", ".adoc", ".asciidoc",
+                  ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp")
+    DIMENSIONE_BLOCCO_HASH = 1024 * 1024
+
+    # nome -> {"directory": str, "aggiornato": str, "file": {percorso relativo: {"mtime", "dimensione", "sha256", "mimetype"}}}
+    _corpora = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def _carica(cls) -> dict:
+        if cls._corpora is None:
+            cls._corpora = {}
+            try:
+                with open(cls.FILE, "r", encoding="utf-8") as f:
+                    cls._corpora = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.warning(f"[RAG] Elenco dei corpora illeggibile: {e}")
+        return cls._corpora
+
+    @classmethod
+    def _salva(cls):
+        os.makedirs(os.path.dirname(cls.FILE), exist_ok=True)
+        with open(f"{cls.FILE}.tmp", "w", encoding="utf-8") as f:
+            json.dump(cls._corpora, f, indent=2, ensure_ascii=False)
+        os.replace(f"{cls.FILE}.tmp", cls.FILE)
+
+    @classmethod
+    def elenco(cls) -> dict:
+        """Ritorna i corpora come {nome: {"directory": str, "aggiornato": str, "numero_file": int}}."""
+        with cls._lock:
+            return {nome: {"directory": c["directory"], "aggiornato": c.get("aggiornato", ""), "numero_file": len(c["file"])}
+                    for nome, c in sorted(cls._carica().items())}
+
+    @classmethod
+    def get(cls, nome: str) -> dict | None:
+        with cls._lock:
+            corpus = cls._carica().get(nome)
+            return {**corpus, "file": dict(corpus["file"])} if corpus else None
+
+    @classmethod
+    def crea(cls, nome: str, directory: str):
+        """Crea un corpus vuoto: i file vengono aggiunti dalla prima indicizzazione."""
+        nome = (nome or "").strip()
+        if not nome:
+            raise ValueError("Il nome del corpus non può essere vuoto")
+        if not os.path.isdir(directory):
+            raise ValueError(f"La directory '{directory}' non esiste")
+        with cls._lock:
+            if nome in cls._carica():
+                raise ValueError(f"Esiste già un corpus con nome '{nome}'")
+            cls._corpora[nome] = {"directory": os.path.abspath(directory), "aggiornato": "", "file": {}}
+            cls._salva()
+        logging.info(f"[RAG] Creato il corpus '{nome}' su {directory}")
+
+    @classmethod
+    def elimina(cls, nome: str):
+        """Elimina il corpus (non i file della directory né i vectorstore, che restano nella cache globale)."""
+        with cls._lock:
+            if cls._carica().pop(nome, None) is not None:
+                cls._salva()
+
+    @classmethod
+    def scansiona(cls, nome: str) -> tuple[dict, list[str], list[str]]:
+        """
+        Confronta la directory del corpus con l'elenco salvato. Ritorna (file, modificati, rimossi):
+        il nuovo elenco dei file, i percorsi relativi dei file nuovi o con contenuto cambiato e quelli
+        dei file non più presenti. Lo sha256 viene calcolato solo se data di modifica o dimensione sono cambiate.
+        """
+        corpus = cls.get(nome)
+        if corpus is None:
+            raise ValueError(f"Corpus '{nome}' inesistente")
+        directory, precedenti = corpus["directory"], corpus["file"]
+        if not os.path.isdir(directory):
+            raise ValueError(f"La directory del corpus '{nome}' non esiste più: {directory}")
+        file, modificati = {}, []
+        for radice, cartelle, nomi_file in os.walk(directory):
+            cartelle[:] = sorted(c for c in cartelle if not c.startswith("."))
+            for nome_file in sorted(nomi_file):
+                if nome_file.startswith(".") or os.path.splitext(nome_file)[1].lower() not in cls.ESTENSIONI:
+                    continue
+                percorso = os.path.join(radice, nome_file)
+                relativo = os.path.relpath(percorso, directory)
+                stato = os.stat(percorso)
+                voce = precedenti.get(relativo)
+                if voce and voce["mtime"] == stato.st_mtime and voce["dimensione"] == stato.st_size:
+                    file[relativo] = voce
+                    continue
+                sha256 = cls._sha256(percorso)
+                if not voce or voce["sha256"] != sha256:
+                    modificati.append(relativo)
+                file[relativo] = {"mtime": stato.st_mtime, "dimensione": stato.st_size, "sha256": sha256,
+                                  "mimetype": mimetypes.guess_type(percorso)[0] or "application/octet-stream"}
+        rimossi = [relativo for relativo in precedenti if relativo not in file]
+        return file, modificati, rimossi
+
+    @classmethod
+    def aggiorna(cls, nome: str, file: dict):
+        """Salva il nuovo elenco dei file del corpus dopo un'indicizzazione riuscita."""
+        with cls._lock:
+            corpus = cls._carica().get(nome)
+            if corpus is None:
+                return
+            corpus["file"] = file
+            corpus["aggiornato"] = datetime.now().isoformat(timespec="seconds")
+            cls._salva()
+
+    @classmethod
+    def _sha256(cls, percorso: str) -> str:
+        impronta = hashlib.sha256()
+        with open(percorso, "rb") as f:
+            for blocco in iter(lambda: f.read(cls.DIMENSIONE_BLOCCO_HASH), b""):
+                impronta.update(blocco)
+        return impronta.hexdigest()
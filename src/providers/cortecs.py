@@ -1,4 +1,5 @@
 from src.providers.base import Provider
+from src.providers.embedding import RegistroEmbedding
 from langchain_openai import ChatOpenAI
 from langchain_openai import OpenAIEmbeddings
 import requests, re
@@ -129,7 +130,8 @@ class CortecsProvider(Provider):
         """
         if self._rag.get_modello():
             self._rag.set_motore_di_embedding(
-                OpenAIEmbeddings(model=self._rag.get_modello(),
+                RegistroEmbedding.ottieni(OpenAIEmbeddings, self._rag.get_modello(), self._base_url,
+                                model=self._rag.get_modello(),
                                 base_url=self._base_url,
                                 api_key=self._api_key))
             # per openrouter si usa il tokenizer di default: gpt2
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import os, logging, threading, hashlib, gc
+
+class RegistroEmbedding():
+    """
+    Registro dei motori di embedding condiviso da tutto il processo.
+    Ogni motore è identificato dalla tupla (classe del motore, nome del modello, base_url):
+    chi chiede lo stesso motore più volte riceve sempre la stessa istanza invece di crearne
+    una nuova ad ogni messaggio (per i modelli locali significa ricaricare i pesi ogni volta).
+    I modelli locali (es. sentence-transformers) occupano RAM, quindi il registro mantiene un
+    budget di memoria e, se viene superato, elimina quelli usati meno di recente (LRU).
+    I motori remoti (es. OpenAIEmbeddings) sono leggeri e ne viene solo limitato il numero.
+    """
+
+    # budget di RAM (in MB) per i modelli di embedding locali, modificabile con una variabile d'ambiente
+    DEFAULT_BUDGET_RAM_MB = int(os.environ.get("DAPABOT_EMBEDDING_RAM_MB", "2048"))
+    # numero massimo di motori remoti tenuti in memoria
+    MAX_MOTORI_REMOTI = 16
+
+    # chiave -> {"motore": ..., "firma": str, "memoria": int, "locale": bool}
+    _motori: OrderedDict = OrderedDict()
+    _lock = threading.RLock()
+    _budget_ram = DEFAULT_BUDGET_RAM_MB * 1024 * 1024
+    _hit = 0
+    _miss = 0
+    _evizioni = 0
+    # funzioni chiamate con il motore eliminato, per permettere a chi lo referenzia di rilasciarlo
+    _callback_evizione = []
+
+    @classmethod
+    def ottieni(cls, classe_motore, modello: str, base_url: str | None = None, **parametri):
+        """
+        Ritorna il motore di embedding condiviso per (classe_motore, modello, base_url),
+        creandolo con classe_motore(**parametri) se non è già presente nel registro.
+        Se i parametri sono cambiati (es. una nuova API key) il motore viene ricreato.
+        """
+        chiave = (classe_motore.__name__, modello, base_url or "")
+        firma = cls._firma_parametri(parametri)
+        with cls._lock:
+            voce = cls._motori.get(chiave)
+            if voce is not None and voce["firma"] == firma:
+                cls._hit += 1
+                cls._motori.move_to_end(chiave)
+                return voce["motore"]
+            cls._miss += 1
+            # un motore ricreato perché sono cambiati i parametri non è un'evizione
+            rimossi = cls._elimina(chiave, evizione=False) if voce is not None else 0
+            del voce
+            motore = classe_motore(**parametri)
+            memoria = cls._stima_memoria(motore)
+            cls._motori[chiave] = {
+                "motore": motore,
+                "firma": firma,
+                "memoria": memoria,
+                "locale": memoria > 0
+            }
+            rimossi += cls._applica_limiti(chiave)
+        cls._libera_memoria(rimossi)
+        return motore
+
+    @classmethod
+    def set_budget_ram(cls, megabyte: int):
+        """Imposta il budget di RAM (in MB) per i modelli locali ed elimina quelli in eccesso."""
+        if megabyte <= 0:
+            raise ValueError(f"Budget di RAM non valido: {megabyte}")
+        with cls._lock:
+            cls._budget_ram = megabyte * 1024 * 1024
+            rimossi = cls._applica_limiti()
+        cls._libera_memoria(rimossi)
+
+    @classmethod
+    def get_budget_ram(cls) -> int:
+        """Ritorna il budget di RAM in MB."""
+        return cls._budget_ram // (1024 * 1024)
+
+    @classmethod
+    def registra_callback_evizione(cls, callback):
+        """Registra una funzione che riceve il motore ogni volta che ne viene eliminato uno."""
+        with cls._lock:
+            if callback not in cls._callback_evizione:
+                cls._callback_evizione.append(callback)
+
+    @classmethod
+    def statistiche(cls) -> dict:
+        """Ritorna i contatori di hit/miss/evizioni e l'occupazione attuale del registro."""
+        with cls._lock:
+            return {
+                "hit": cls._hit,
+                "miss": cls._miss,
+                "evizioni": cls._evizioni,
+                "motori": len(cls._motori),
+                "motori_locali": sum(1 for v in cls._motori.values() if v["locale"]),
+                "memoria_mb": round(cls._memoria_locale() / (1024 * 1024), 1),
+                "budget_mb": cls.get_budget_ram()
+            }
+
+    @classmethod
+    def svuota(cls):
+        """Elimina tutti i motori dal registro."""
+        with cls._lock:
+            rimossi = sum(cls._elimina(chiave, evizione=False) for chiave in list(cls._motori))
+        cls._libera_memoria(rimossi)
+
+    @classmethod
+    def _memoria_locale(cls) -> int:
+        return sum(v["memoria"] for v in cls._motori.values() if v["locale"])
+
+    @classmethod
+    def _applica_limiti(cls, chiave_protetta=None) -> int:
+        """
+        Elimina i motori usati meno di recente finché non si rientra nei limiti e ritorna quanti ne ha eliminati.
+        Il motore appena richiesto (chiave_protetta) non viene mai eliminato, anche se da solo
+        supera il budget: altrimenti non sarebbe possibile usare modelli più grandi del budget.
+        """
+        rimossi = 0
+        # Modelli locali: budget di RAM
+        for chiave in [k for k, v in cls._motori.items() if v["locale"]]:
+            if cls._memoria_locale() <= cls._budget_ram:
+                break
+            if chiave != chiave_protetta:
+                rimossi += cls._elimina(chiave)
+        # Motori remoti: numero massimo
+        remoti = [k for k, v in cls._motori.items() if not v["locale"]]
+        for chiave in remoti[:max(0, len(remoti) - cls.MAX_MOTORI_REMOTI)]:
+            if chiave != chiave_protetta:
+                rimossi += cls._elimina(chiave)
+        return rimossi
+
+    @classmethod
+    def _elimina(cls, chiave, evizione: bool = True) -> int:
+        """
+        Toglie il motore dal registro e ritorna 1 se c'era. Vengono contate come evizioni solo le
+        eliminazioni decise dall'LRU; la memoria va liberata dal chiamante con _libera_memoria,
+        dopo aver rilasciato il lock.
+        """
+        voce = cls._motori.pop(chiave, None)
+        if voce is None:
+            return 0
+        if evizione:
+            cls._evizioni += 1
+        logging.info(f"[EMBEDDING] Rimosso dal registro: {chiave}")
+        for callback in list(cls._callback_evizione):
+            try:
+                callback(voce["motore"])
+            except Exception as e:
+                logging.warning(f"[EMBEDDING] Errore callback evizione: {e}")
+        return 1
+
+    @staticmethod
+    def _libera_memoria(rimossi: int):
+        # gc.collect() è lento con modelli grandi: va fatto fuori dal lock per non bloccare gli altri ottieni()
+        if rimossi:
+            gc.collect()
+
+    @staticmethod
+    def _firma_parametri(parametri: dict) -> str:
+        # Non memorizzo i parametri in chiaro (possono contenere API key), solo il loro hash
+        testo = repr(sorted((k, repr(v)) for k, v in parametri.items()))
+        return hashlib.sha256(testo.encode()).hexdigest()
+
+    @staticmethod
+    def _stima_memoria(motore) -> int:
+        """
+        Stima la RAM occupata dai pesi di un modello locale (in byte).
+        HuggingFaceEmbeddings conserva il SentenceTransformer nell'attributo _client;
+        per i motori remoti non ci sono pesi in memoria e la stima è 0.
+        """
+        modello = getattr(motore, "_client", None)
+        parametri = getattr(modello, "parameters", None)
+        if not callable(parametri):
+            return 0
+        try:
+            return sum(p.numel() * p.element_size() for p in parametri())
+        except Exception:
+            return 0
@@ -1,4 +1,5 @@
 from src.providers.base import Provider
+from src.providers.embedding import RegistroEmbedding
 from langchain_openai import ChatOpenAI
 from huggingface_hub import list_models
 from langchain_huggingface import HuggingFaceEmbeddings
@@ -53,7 +54,9 @@ class HuggingfaceProvider(Provider):
         Usa il metodo centralizzato _esegui_rag_con_feedback() per il feedback visivo.
         """
         if self._rag.get_modello():
-            self._rag.set_motore_di_embedding(HuggingFaceEmbeddings(model_name=self._rag.get_modello()))
+            self._rag.set_motore_di_embedding(
+                RegistroEmbedding.ottieni(HuggingFaceEmbeddings, self._rag.get_modello(),
+                                          model_name=self._rag.get_modello()))
             # per hugging face i tokenizer hanno lo stesso nome del modello di embedding
             self._rag.set_tokenizer(self._rag.get_modello())
         
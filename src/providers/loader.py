@@ -1,24 +1,132 @@
+import ast
 import importlib
 import pkgutil
+import threading
+import logging
+from pathlib import Path
 import src.providers
-from src.providers.base import Provider
+
+class ProviderLazy():
+    """
+    Segnaposto di un provider registrato solo con i metadati leggeri (nome, prefisso del token e base_url).
+    Il modulo del provider, con i suoi SDK (replicate, playwright, huggingface_hub, ...), viene importato
+    e la classe istanziata solo al primo accesso a un attributo che non sia uno dei metadati, cioè quando
+    la sua scheda viene selezionata o ne viene creato il client. Da quel momento ogni attributo viene
+    letto e scritto direttamente sull'istanza vera.
+    """
+
+    # attributi del segnaposto: tutti gli altri vengono letti e scritti sull'istanza del provider
+    _ATTRIBUTI_SEGNAPOSTO = ("_nome_provider", "_prefisso", "_url", "_modulo", "_classe", "_istanza", "_lock_istanza")
+
+    def __init__(self, nome, prefisso_token, base_url, modulo, classe):
+        self._nome_provider = nome
+        self._prefisso = prefisso_token
+        self._url = base_url
+        self._modulo = modulo
+        self._classe = classe
+        self._istanza = None
+        self._lock_istanza = threading.Lock()
+
+    def nome(self):
+        return self._nome_provider
+
+    def prefisso_token(self):
+        return self._prefisso
+
+    def get_prefisso_token(self):
+        return self._prefisso
+
+    def get_baseurl(self):
+        return self._istanza.get_baseurl() if self._istanza is not None else self._url
+
+    def caricato(self) -> bool:
+        """Ritorna True se il modulo del provider è già stato importato e la classe istanziata."""
+        return self._istanza is not None
+
+    def get_lista_modelli_con_chat(self):
+        # un provider mai usato non può avere chat in memoria
+        return self._istanza.get_lista_modelli_con_chat() if self._istanza is not None else []
+
+    def istanza(self):
+        """Importa il modulo del provider e lo istanzia (una sola volta)."""
+        if self._istanza is None:
+            with self._lock_istanza:
+                if self._istanza is None:
+                    modulo = importlib.import_module(f"{src.providers.__name__}.{self._modulo}")
+                    self._istanza = getattr(modulo, self._classe)()
+                    logging.info(f"[PROVIDERS] Caricato il provider {self._nome_provider}")
+        return self._istanza
+
+    def __getattr__(self, attributo):
+        # chiamato solo per gli attributi non definiti nel segnaposto
+        if attributo.startswith("__") or attributo in ("_istanza", "_lock_istanza"):
+            raise AttributeError(attributo)
+        return getattr(self.istanza(), attributo)
+
+    def __setattr__(self, attributo, valore):
+        # senza inoltro la scrittura finirebbe sul segnaposto e l'istanza non la vedrebbe mai
+        if attributo in self._ATTRIBUTI_SEGNAPOSTO:
+            object.__setattr__(self, attributo, valore)
+        else:
+            setattr(self.istanza(), attributo, valore)
+
+    def __repr__(self):
+        return f"ProviderLazy({self._nome_provider!r}, caricato={self.caricato()})"
+
 
 class Loader():
     _caricamento_effettuato=False
     _moduli={}
-    
+
     @staticmethod
     def discover_providers():
-        # importa tutti i moduli del package providers
+        """
+        Registra tutti i provider del package providers leggendo dal sorgente di ogni modulo
+        i valori di default di nome, prefisso_token e base_url del costruttore.
+        I moduli senza sottoclassi di Provider (rag, embedding, loader, ...) non registrano niente.
+        Ritorna un dizionario nome -> ProviderLazy: nessun modulo viene importato.
+        """
         if not Loader._caricamento_effettuato:
             for _, module_name, _ in pkgutil.iter_modules(src.providers.__path__):
-                if module_name in ("base", "loader", "rag"):
-                    continue
-                importlib.import_module(f"{src.providers.__name__}.{module_name}")
+                for provider in Loader._leggi_metadati(module_name):
+                    if not provider.nome() in Loader._moduli:
+                        Loader._moduli[provider.nome()] = provider
             Loader._caricamento_effettuato=True
-            # istanzia tutte le sottoclassi concrete
-            for cls in Provider.__subclasses__():
-                instance = cls()
-                if not instance.nome() in Loader._moduli:
-                    Loader._moduli[instance.nome()] = instance
         return Loader._moduli
+
+    @staticmethod
+    def _leggi_metadati(module_name: str) -> list[ProviderLazy]:
+        """
+        Cerca nel modulo le classi che ereditano da Provider e ne legge i valori di default dei parametri
+        del costruttore. Se non sono valori letterali il modulo viene importato e le classi istanziate come in passato.
+        """
+        percorso = Path(src.providers.__path__[0]) / f"{module_name}.py"
+        try:
+            albero = ast.parse(percorso.read_text(encoding="utf-8"))
+            providers = []
+            for classe in albero.body:
+                if not (isinstance(classe, ast.ClassDef) and any(getattr(b, "id", None) == "Provider" for b in classe.bases)):
+                    continue
+                costruttore = next(n for n in classe.body if isinstance(n, ast.FunctionDef) and n.name == "__init__")
+                argomenti = costruttore.args.args[len(costruttore.args.args) - len(costruttore.args.defaults):]
+                default = {a.arg: ast.literal_eval(v) for a, v in zip(argomenti, costruttore.args.defaults)}
+                providers.append(ProviderLazy(
+                    nome=default["nome"],
+                    prefisso_token=default.get("prefisso_token", ""),
+                    base_url=default["base_url"],
+                    modulo=module_name,
+                    classe=classe.name
+                ))
+            return providers
+        except Exception as e:
+            logging.info(f"[PROVIDERS] Metadati di '{module_name}' non ricavabili dal sorgente ({e}): importo il modulo")
+            from src.providers.base import Provider
+            modulo = importlib.import_module(f"{src.providers.__name__}.{module_name}")
+            providers = []
+            for valore in vars(modulo).values():
+                if isinstance(valore, type) and issubclass(valore, Provider) and valore is not Provider and valore.__module__ == modulo.__name__:
+                    provider = ProviderLazy(nome="", prefisso_token="", base_url="", modulo=module_name, classe=valore.__name__)
+                    istanza = provider.istanza()
+                    provider._nome_provider, provider._prefisso, provider._url = istanza.nome(), istanza.prefisso_token(), istanza.get_baseurl()
+                    providers.append(provider)
+            return providers
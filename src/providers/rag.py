@@ -3,9 +3,26 @@ from docling.chunking import HybridChunker
 from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
+import chromadb
 from src.Messaggio import Messaggio
 from src.Allegato import Allegato
-import os, logging, hashlib, json, shutil, gc, time
+from src.providers.embedding import RegistroEmbedding
+from src.providers.cache_embedding import CacheEmbedding
+from src.providers.rag_ricerca import IndiceBM25, fondi_punteggi, mmr
+from src.providers.rerank import Riordinatore
+from src.providers.corpora import Corpora
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from collections import OrderedDict
+import os, logging, hashlib, json, shutil, gc, time, uuid, threading, multiprocessing
+
+def _analizza_documento(percorso: str, mimetype: str, parametri_chunker: dict) -> list[Document]:
+    """
+    Parsing e suddivisione in chunk di un documento. È una funzione del modulo (e non un metodo) perché
+    viene eseguita nei processi del pool di Rag.run(): riceve solo dati serializzabili e ricrea il chunker.
+    """
+    return Rag._suddividi_documento(percorso, mimetype, Rag._crea_chunker(**parametri_chunker))
 
 class Rag():
 
@@ -16,16 +33,57 @@ class Rag():
     DEFAULT_VECTORSTORE_PATH = "vectorstore_cache/"  # dove vengono persistiti i vector store
     DEFAULT_VECTORSTORE_INDEX_FILE="index.json"
     DEFAULT_VECTORSTORE_INDEX_FILE_PATH = os.path.join(DEFAULT_VECTORSTORE_PATH, DEFAULT_VECTORSTORE_INDEX_FILE)
-    AVAILABLE_SEARCH_MODALITIES=["similarity", "mmr"]    
+    AVAILABLE_SEARCH_MODALITIES=["similarity", "mmr", "hybrid"]
+    # peso della ricerca vettoriale nella modalità "hybrid" (il resto va a BM25)
+    PESO_VETTORIALE_IBRIDO = 0.5
+    # con il riordino attivo la ricerca prende FATTORE_CANDIDATI_RERANK * top_k candidati per il cross-encoder
+    FATTORE_CANDIDATI_RERANK = 4
+    # parametri della MMR: peso della rilevanza rispetto alla diversità e candidati totali, fra tutti i file
+    # (con fetch_k = 0 i candidati sono max(top_k * 4, 20))
+    DEFAULT_LAMBDA_MMR = 0.3
+    DEFAULT_FETCH_K = 0
+    # directory di DEFAULT_VECTORSTORE_PATH che non contengono collection e non vanno toccate da _pulizia_orfani
+    DIRECTORY_PARSING = "parsing"
+    DIRECTORY_CONSOLIDATO = "consolidato"
+    DIRECTORY_RISERVATE = (DIRECTORY_PARSING, DIRECTORY_CONSOLIDATO, os.path.basename(CacheEmbedding.DIRECTORY),
+                           os.path.basename(IndiceBM25.DIRECTORY))
+    # modalità di archiviazione dei nuovi vectorstore:
+    # - separata: una directory, un client Chroma e una collection per ogni file;
+    # - consolidata: un unico client con una collection per modello di embedding, in cui i file
+    #   sono distinti dai metadati file_id e chunker e vengono interrogati con un filtro.
+    ARCHIVIAZIONE_SEPARATA = "separata"
+    ARCHIVIAZIONE_CONSOLIDATA = "consolidata"
+    MODALITA_ARCHIVIAZIONE = [ARCHIVIAZIONE_SEPARATA, ARCHIVIAZIONE_CONSOLIDATA]
+    DEFAULT_IMPOSTAZIONI_FILE_PATH = os.path.join(DEFAULT_VECTORSTORE_PATH, "impostazioni.json")
+    # numero massimo di documenti analizzati tenuti nella cache del parsing (vengono eliminati i meno usati)
+    MAX_DOCUMENTI_PARSING = 500
+    # processi usati per il parsing con Docling degli allegati, modificabile con una variabile d'ambiente
+    MAX_PROCESSI_PARSING = int(os.environ.get("DAPABOT_RAG_PROCESSI", "2"))
+    # numero di chunk di cui vengono calcolati gli embedding (e scritti nel vectorstore) in una volta
+    DIMENSIONE_LOTTO_EMBEDDING = 256
     # cache dei vectorstore per file già elaborati
     _cache_vectorstores: dict[tuple, Chroma] = {}
     # indice su disco della cache dei vectorstore
     _indice_vectorstores: dict[tuple, dict[str, str]] = {}
+    # archiviazione consolidata: client Chroma unico e collection aperte (nome collection -> Chroma)
+    _client_consolidato = None
+    _vectorstore_consolidati: dict[str, Chroma] = {}
+    _archiviazione = None  # letta da DEFAULT_IMPOSTAZIONI_FILE_PATH al primo utilizzo
+    # indici BM25 già caricati per la ricerca ibrida (chiave del vectorstore -> IndiceBM25), i meno usati
+    # di recente vengono scartati oltre MAX_INDICI_BM25 e ricaricati da disco se servono di nuovo
+    MAX_INDICI_BM25 = 64
+    _cache_bm25: OrderedDict[str, IndiceBM25] = OrderedDict()
+    _lock_bm25 = threading.Lock()
 
     _pulizia_fatta = False  # esegue la pulizia solo una volta per processo
+    # pool di processi per il parsing, creato al primo RAG con più file da analizzare
+    _pool_parsing = None
+    _lock_pool = threading.Lock()
 
     def __init__(self, attivo=False, modello=None, upload_dir=None, topk=None,
-                 motore_di_embedding=None, tokenizer="", modalita_ricerca="similarity", status_callback=None):
+                 motore_di_embedding=None, tokenizer="", modalita_ricerca="similarity", status_callback=None,
+                 rerank=False, budget_rerank_ms=Riordinatore.DEFAULT_BUDGET_MS,
+                 lambda_mmr=DEFAULT_LAMBDA_MMR, fetch_k=DEFAULT_FETCH_K, corpora=None):
         # Silenzia i log di sentence-transformers
         logging.getLogger("sentence_transformers").setLevel(logging.ERROR)
         logging.getLogger("sentence_transformers.SentenceTransformer").setLevel(logging.ERROR)
@@ -38,6 +96,9 @@ class Rag():
         self.set_tokenizer(tokenizer)
         self.init_vectorstore_cache() # inizializza la cache e la directory per la persistenza dei vectorstores
         self.set_modalita_ricerca(modalita_ricerca)
+        self.set_rerank(rerank, budget_rerank_ms)
+        self.set_parametri_mmr(lambda_mmr, fetch_k)
+        self.set_corpora(corpora)
         self._status_callback = status_callback  # Callback per feedback visivo
 
     def to_dict(self):
@@ -46,10 +107,15 @@ class Rag():
             "directory_allegati": self._upload_dir,
             "top_k": self._topk,
             "directory_vectorstores": Rag.DEFAULT_VECTORSTORE_PATH,
-            "modalita_ricerca": self._modalita_ricerca
+            "modalita_ricerca": self._modalita_ricerca,
+            "rerank": self._rerank,
+            "budget_rerank_ms": self._budget_rerank_ms,
+            "lambda_mmr": self._lambda_mmr,
+            "fetch_k": self._fetch_k,
+            "corpora": list(self._corpora)
         }
 
-    # Per ora il rag supporta solo 2 modalità di ricerca: mmr e similarity
+    # modalità di ricerca supportate: similarity, mmr e hybrid (vettoriale + BM25)
     def set_modalita_ricerca(self, modalita_ricerca):
         if modalita_ricerca not in Rag.AVAILABLE_SEARCH_MODALITIES:
             raise ValueError(f"Modalità di ricerca non valida: {modalita_ricerca}")
@@ -58,6 +124,46 @@ class Rag():
     def get_modalita_ricerca(self):
         return self._modalita_ricerca
 
+    # Abilita il riordino dei chunk trovati con un cross-encoder, entro budget_ms millisecondi.
+    # Il modello viene caricato in background subito, non al primo messaggio
+    def set_rerank(self, attivo=False, budget_ms=None):
+        self._rerank = bool(attivo)
+        if self._rerank:
+            Riordinatore.precarica()
+        self._budget_rerank_ms = Riordinatore.DEFAULT_BUDGET_MS
+        if budget_ms is not None:
+            if budget_ms <= 0:
+                raise ValueError(f"Budget di tempo per il riordino non valido: {budget_ms}")
+            self._budget_rerank_ms = int(budget_ms)
+
+    def get_rerank(self):
+        return self._rerank
+
+    def get_budget_rerank_ms(self):
+        return self._budget_rerank_ms
+
+    # lambda_mmr: tra 0 (solo diversità) e 1 (solo rilevanza); fetch_k: candidati totali (0 = automatico)
+    def set_parametri_mmr(self, lambda_mmr=None, fetch_k=None):
+        self._lambda_mmr = Rag.DEFAULT_LAMBDA_MMR if lambda_mmr is None else float(lambda_mmr)
+        if not 0 <= self._lambda_mmr <= 1:
+            raise ValueError(f"lambda della MMR non valido: {lambda_mmr}")
+        self._fetch_k = int(fetch_k or Rag.DEFAULT_FETCH_K)
+        if self._fetch_k < 0:
+            raise ValueError(f"fetch_k non valido: {fetch_k}")
+
+    def get_lambda_mmr(self):
+        return self._lambda_mmr
+
+    def get_fetch_k(self):
+        return self._fetch_k
+
+    # le basi di conoscenza (vedi Corpora) interrogate ad ogni messaggio insieme agli allegati
+    def set_corpora(self, corpora=None):
+        self._corpora = list(corpora or [])
+
+    def get_corpora(self):
+        return self._corpora
+
     @classmethod
     def _pulizia_orfani(cls) -> None:
         """
@@ -83,7 +189,7 @@ class Rag():
                 percorso = os.path.join(cls.DEFAULT_VECTORSTORE_PATH, nome)
                 if not os.path.isdir(percorso):
                     continue
-                if nome not in attese:
+                if nome not in attese and nome not in cls.DIRECTORY_RISERVATE:
                     try:
                         shutil.rmtree(percorso)
                         logging.info(f"[RAG] Rimossa directory orfana: {percorso}")
@@ -120,14 +226,19 @@ class Rag():
     # max_tokens: lunghezza massima del chunk
     # overlap: quanti caratteri saranno sovrapposti tra 2 tokens consecutivi
     def set_tokenizer(self, tokenizer, max_tokens=1000, overlap=150):
-        self._chunker=HybridChunker()
+        # i parametri servono anche per ricreare il chunker nei processi del pool di parsing
+        self._parametri_chunker = {"tokenizer": tokenizer, "max_tokens": max_tokens, "overlap": overlap}
+        self._chunker = Rag._crea_chunker(**self._parametri_chunker)
+
+    @staticmethod
+    def _crea_chunker(tokenizer, max_tokens, overlap) -> HybridChunker:
         if tokenizer!="" and tokenizer:
             if max_tokens > 0 and overlap > 0:
-                self._chunker = HybridChunker(tokenizer=tokenizer,
-                                            max_tokens=max_tokens,
-                                            overlap=overlap)
-            else:
-                self._chunker = HybridChunker(tokenizer=tokenizer)
+                return HybridChunker(tokenizer=tokenizer,
+                                     max_tokens=max_tokens,
+                                     overlap=overlap)
+            return HybridChunker(tokenizer=tokenizer)
+        return HybridChunker()
 
     def set_attivo(self, attivo=False):
         self._attivo=attivo
@@ -135,12 +246,39 @@ class Rag():
     def get_attivo(self):
         return self._attivo
 
-    # Imposta il motore per generare gli embedding
+    # Imposta il motore per generare gli embedding. Se non viene specificato nessun motore
+    # verrà usato quello di default, che però non viene istanziato qui ma solo al primo run()
     def set_motore_di_embedding(self, motore_di_embedding):
-        if motore_di_embedding:
-            self._motore_di_embedding=motore_di_embedding
-        else:
-            self._motore_di_embedding=Rag.DEFAULT_EMBEDDING_ENGINE(model_name=Rag.DEFAULT_EMBEDDING_MODEL)
+        self._motore_di_embedding=motore_di_embedding or None
+
+    def get_motore_di_embedding(self):
+        if self._motore_di_embedding is None:
+            return Rag._get_motore_di_default()
+        return self._motore_di_embedding
+
+    @classmethod
+    def _get_motore_di_default(cls):
+        """
+        Ritorna il motore di embedding di default creandolo alla prima richiesta.
+        Il motore (un modello sentence-transformers caricato in RAM) è unico per tutto il processo
+        ed è gestito da RegistroEmbedding: prima ne veniva creato uno per ogni provider già durante
+        la discovery dei provider.
+        """
+        return RegistroEmbedding.ottieni(cls.DEFAULT_EMBEDDING_ENGINE, cls.DEFAULT_EMBEDDING_MODEL,
+                                         model_name=cls.DEFAULT_EMBEDDING_MODEL)
+
+    @classmethod
+    def _rilascia_vectorstores_del_motore(cls, motore):
+        """
+        Callback di RegistroEmbedding: quando un motore viene eliminato dal registro, toglie dalla
+        cache RAM i vectorstore che lo usano, altrimenti il modello resterebbe comunque in memoria.
+        """
+        for key, vectorstore in list(cls._cache_vectorstores.items()):
+            if getattr(vectorstore, "_embedding_function", None) is motore:
+                cls._cache_vectorstores.pop(key, None)
+        for nome, vectorstore in list(cls._vectorstore_consolidati.items()):
+            if getattr(vectorstore, "_embedding_function", None) is motore:
+                cls._vectorstore_consolidati.pop(nome, None)
 
     def set_modello(self, modello):
         self._modello=Rag.DEFAULT_EMBEDDING_MODEL
@@ -178,10 +316,14 @@ class Rag():
                 logging.warning(f"[RAG] Errore callback status: {e}")
 
     def _filtra_metadati_complessi(self, save_path, mimetype):
+        return Rag._suddividi_documento(save_path, mimetype, self._chunker)
+
+    @staticmethod
+    def _suddividi_documento(save_path, mimetype, chunker) -> list[Document]:
         clean_splits = []
         # Docling non supporta i file in testo semplice, quindi devo gestirli separatamente
         if mimetype!="text/plain":
-            loader = DoclingLoader(file_path=save_path, chunker=self._chunker)
+            loader = DoclingLoader(file_path=save_path, chunker=chunker)
             splits=loader.load()
             for item in splits:
                 # DoclingLoader può restituire Document o tuple, normalizziamo tutto
@@ -250,8 +392,12 @@ class Rag():
             return Rag._cache_vectorstores[key]
 
         # 2) Prova dall'indice (collection_name già noto)
-        vs = Rag.get_indice().get(key)  # dict {"collection_name": str, "label": str}
+        vs = Rag.get_indice().get(key)  # dict {"collection_name": str, "label": str[, "archivio": str]}
         collection_name = vs.get("collection_name") if vs else None
+        if collection_name and vs.get("archivio") == Rag.ARCHIVIAZIONE_CONSOLIDATA:
+            vectorstore = self._apri_consolidato(collection_name)
+            Rag._cache_vectorstores[key] = vectorstore
+            return vectorstore
         if collection_name:
             # ✅ cartella dedicata per la collection
             collection_dir = os.path.join(Rag.DEFAULT_VECTORSTORE_PATH, collection_name)
@@ -259,7 +405,7 @@ class Rag():
             try:
                 vectorstore = Chroma(
                     collection_name=collection_name,
-                    embedding_function=self._motore_di_embedding,
+                    embedding_function=self.get_motore_di_embedding(),
                     persist_directory=collection_dir,  # per-collection
                 )
             except Exception as e:
@@ -291,36 +437,288 @@ class Rag():
 
             return vectorstore
 
-        # 3) Non esiste nell’indice: crea una nuova collection
-        splits = self._filtra_metadati_complessi(path, tipo)
-        collection_name = self._genera_nome_collezione(vectorstore_id)
+        # 3) Non esiste nell’indice: crea una nuova collection (rifacendo il parsing solo se non è in cache)
+        firma = self._firma_parsing(vectorstore_id[0])
+        splits = Rag._leggi_parsing(firma)
+        if splits is None:
+            splits = self._filtra_metadati_complessi(path, tipo)
+            Rag._salva_parsing(firma, splits)
+        vectorstore = self._crea_vectorstore(vectorstore_id, splits, self._calcola_embeddings(splits))
+        try:
+            Rag.salva_indice_vectorstores()
+        except Exception as e:
+            logging.warning(f"Non riesco a salvare l'indice dei vector store: {e}")
+
+        return vectorstore
 
-        # ✅ cartella dedicata per la collection
-        collection_dir = os.path.join(Rag.DEFAULT_VECTORSTORE_PATH, collection_name)
-        os.makedirs(collection_dir, exist_ok=True)
+    def _firma_parsing(self, file_id: str) -> str:
+        """
+        Chiave della cache del parsing: dipende solo dal contenuto del file e dal chunker (compreso il tokenizer),
+        non dal modello di embedding, così cambiando modello i chunk vengono ricalcolati solo negli embedding.
+        """
+        parametri = json.dumps(self._parametri_chunker, sort_keys=True, default=str)
+        return hashlib.sha256(f"{file_id}|{type(self._chunker).__name__}|{parametri}".encode()).hexdigest()
 
+    @classmethod
+    def _percorso_parsing(cls, firma: str) -> str:
+        return os.path.join(cls.DEFAULT_VECTORSTORE_PATH, cls.DIRECTORY_PARSING, f"{firma}.json")
+
+    @classmethod
+    def _leggi_parsing(cls, firma: str) -> list[Document] | None:
+        """Ritorna i chunk salvati nella cache del parsing, o None se il documento non è mai stato analizzato."""
+        percorso = cls._percorso_parsing(firma)
+        try:
+            with open(percorso, "r", encoding="utf-8") as f:
+                chunk = json.load(f)
+            os.utime(percorso)  # la data di modifica indica l'ultimo utilizzo
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"[RAG] Cache del parsing illeggibile ({percorso}): {e}")
+            return None
+        return [Document(page_content=c["page_content"], metadata=c["metadata"]) for c in chunk]
+
+    @classmethod
+    def _salva_parsing(cls, firma: str, splits: list[Document]):
+        """Salva i chunk nella cache del parsing ed elimina i documenti usati meno di recente oltre MAX_DOCUMENTI_PARSING."""
+        percorso = cls._percorso_parsing(firma)
         try:
-            vectorstore = Chroma.from_documents(
-                splits,
-                self._motore_di_embedding,
-                collection_name=collection_name,
-                persist_directory=collection_dir
-            )
+            os.makedirs(os.path.dirname(percorso), exist_ok=True)
+            temporaneo = f"{percorso}.tmp"
+            with open(temporaneo, "w", encoding="utf-8") as f:
+                json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in splits], f, ensure_ascii=False)
+            os.replace(temporaneo, percorso)  # chi legge non vede mai un file scritto a metà
+            salvati = sorted((os.path.join(os.path.dirname(percorso), nome) for nome in os.listdir(os.path.dirname(percorso))),
+                             key=os.path.getmtime)
+            for vecchio in salvati[:max(0, len(salvati) - cls.MAX_DOCUMENTI_PARSING)]:
+                os.remove(vecchio)
+        except Exception as e:
+            logging.warning(f"[RAG] Impossibile salvare la cache del parsing: {e}")
+
+    @classmethod
+    def statistiche_cache_parsing(cls) -> dict:
+        """Ritorna il numero di documenti nella cache del parsing e lo spazio che occupano su disco (in MB)."""
+        directory = os.path.join(cls.DEFAULT_VECTORSTORE_PATH, cls.DIRECTORY_PARSING)
+        file = [os.path.join(directory, nome) for nome in os.listdir(directory)] if os.path.isdir(directory) else []
+        return {"documenti": len(file), "spazio_mb": round(sum(os.path.getsize(f) for f in file) / (1024 * 1024), 1)}
+
+    @classmethod
+    def svuota_cache_parsing(cls):
+        shutil.rmtree(os.path.join(cls.DEFAULT_VECTORSTORE_PATH, cls.DIRECTORY_PARSING), ignore_errors=True)
+
+    def _crea_vectorstore(self, vectorstore_id: tuple, splits: list[Document], embeddings: list[list[float]]) -> Chroma:
+        """
+        Crea la collection di un file a partire dai chunk e dai loro embedding già calcolati, la mette
+        nella cache RAM e la aggiunge all'indice (che il chiamante deve poi salvare su disco).
+        Con l'archiviazione consolidata i chunk vengono invece aggiunti alla collection del modello.
+        """
+        key = json.dumps(vectorstore_id, ensure_ascii=False)
+        voce = {}
+        try:
+            if Rag.get_archiviazione() == Rag.ARCHIVIAZIONE_CONSOLIDATA:
+                collection_name = Rag._nome_collezione_consolidata(vectorstore_id[1], vectorstore_id[2])
+                vectorstore = self._apri_consolidato(collection_name)
+                # elimina gli eventuali chunk di un'elaborazione interrotta dello stesso file
+                vectorstore._collection.delete(where=Rag._filtro_file(vectorstore_id))
+                metadati = [{**doc.metadata, "file_id": vectorstore_id[0], "chunker": vectorstore_id[3]} for doc in splits]
+                voce["archivio"] = Rag.ARCHIVIAZIONE_CONSOLIDATA
+            else:
+                collection_name = self._genera_nome_collezione(vectorstore_id)
+                # ✅ cartella dedicata per la collection
+                collection_dir = os.path.join(Rag.DEFAULT_VECTORSTORE_PATH, collection_name)
+                os.makedirs(collection_dir, exist_ok=True)
+                vectorstore = Chroma(
+                    collection_name=collection_name,
+                    embedding_function=self.get_motore_di_embedding(),
+                    persist_directory=collection_dir
+                )
+                metadati = [doc.metadata for doc in splits]
+            # scrittura diretta nella collection: gli embedding sono già stati calcolati
+            Rag._aggiungi_chunk(vectorstore._collection, [str(uuid.uuid4()) for _ in splits], embeddings,
+                                [doc.page_content for doc in splits], metadati)
         except Exception as e:
             raise Exception(f"Errore creazione collection '{collection_name}': {e}")
 
         Rag._cache_vectorstores[key] = vectorstore
+        # Indice lessicale per la ricerca ibrida, costruito ora che i chunk sono già in memoria
+        try:
+            indice_bm25 = IndiceBM25([doc.page_content for doc in splits], [doc.metadata for doc in splits])
+            Rag._memorizza_indice_bm25(key, indice_bm25)
+            indice_bm25.salva(key)
+        except Exception as e:
+            logging.warning(f"[RAG] Impossibile salvare l'indice BM25 di '{collection_name}': {e}")
 
         # Calcolo label utente (basename del file) dai metadati
         label = Rag._estrai_label_da_splits(splits)
-        Rag.get_indice()[key] = {"collection_name": collection_name, "label": label}
-        try:
-            Rag.salva_indice_vectorstores()
-        except Exception as e:
-            logging.warning(f"Non riesco a salvare l'indice dei vector store: {e}")
+        Rag.get_indice()[key] = {"collection_name": collection_name, "label": label, **voce}
+        return vectorstore
+
+    @classmethod
+    def _get_indice_bm25(cls, key: str, vectorstore: Chroma, filtro: dict | None) -> IndiceBM25:
+        """
+        Ritorna l'indice BM25 del vectorstore. Per le collection create prima della ricerca ibrida
+        l'indice viene costruito una volta dai chunk salvati nella collection.
+        """
+        indice = cls._cache_bm25.get(key) or IndiceBM25.carica(key)
+        if indice is None:
+            dati = vectorstore._collection.get(where=filtro, include=["documents", "metadatas"])
+            indice = IndiceBM25(dati["documents"], [m or {} for m in dati["metadatas"]])
+            try:
+                indice.salva(key)
+            except Exception as e:
+                logging.warning(f"[RAG] Impossibile salvare l'indice BM25: {e}")
+        cls._memorizza_indice_bm25(key, indice)
+        return indice
+
+    @classmethod
+    def _memorizza_indice_bm25(cls, key: str, indice: IndiceBM25):
+        """Mette l'indice in cima alla cache BM25 e scarta i meno usati di recente oltre MAX_INDICI_BM25."""
+        with cls._lock_bm25:
+            cls._cache_bm25[key] = indice
+            cls._cache_bm25.move_to_end(key)
+            while len(cls._cache_bm25) > cls.MAX_INDICI_BM25:
+                cls._cache_bm25.popitem(last=False)
+
+    @staticmethod
+    def _aggiungi_chunk(collection, ids, embeddings, documenti, metadati):
+        """Aggiunge i chunk alla collection a lotti di DIMENSIONE_LOTTO_EMBEDDING."""
+        # Chroma non accetta metadati a None (es. "page" dei file senza pagine): per lui equivalgono a un metadato assente
+        metadati = [{k: v for k, v in (m or {}).items() if v is not None} for m in metadati]
+        for inizio in range(0, len(ids), Rag.DIMENSIONE_LOTTO_EMBEDDING):
+            fine = inizio + Rag.DIMENSIONE_LOTTO_EMBEDDING
+            collection.add(ids=ids[inizio:fine], embeddings=embeddings[inizio:fine],
+                           documents=documenti[inizio:fine], metadatas=metadati[inizio:fine])
+
+    @classmethod
+    def get_archiviazione(cls) -> str:
+        """Ritorna la modalità di archiviazione dei nuovi vectorstore (separata di default)."""
+        if cls._archiviazione is None:
+            cls._archiviazione = cls.ARCHIVIAZIONE_SEPARATA
+            try:
+                with open(cls.DEFAULT_IMPOSTAZIONI_FILE_PATH, "r", encoding="utf-8") as f:
+                    modo = json.load(f).get("archiviazione")
+                if modo in cls.MODALITA_ARCHIVIAZIONE:
+                    cls._archiviazione = modo
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.warning(f"[RAG] Impostazioni dei vector store illeggibili: {e}")
+        return cls._archiviazione
 
+    @classmethod
+    def set_archiviazione(cls, modo: str) -> int:
+        """
+        Imposta la modalità di archiviazione dei nuovi vectorstore. Passando a quella consolidata vengono
+        migrati anche quelli esistenti; ritorna il numero di vectorstore migrati.
+        I vectorstore consolidati restano tali anche tornando all'archiviazione separata.
+        """
+        if modo not in cls.MODALITA_ARCHIVIAZIONE:
+            raise ValueError(f"Modalità di archiviazione non valida: {modo}")
+        os.makedirs(cls.DEFAULT_VECTORSTORE_PATH, exist_ok=True)
+        with open(cls.DEFAULT_IMPOSTAZIONI_FILE_PATH, "w", encoding="utf-8") as f:
+            json.dump({"archiviazione": modo}, f, indent=2)
+        cls._archiviazione = modo
+        if modo == cls.ARCHIVIAZIONE_CONSOLIDATA:
+            return cls.migra_in_consolidato()
+        return 0
+
+    @classmethod
+    def _get_client_consolidato(cls):
+        """Ritorna il client Chroma dell'archiviazione consolidata, unico per tutto il processo."""
+        if cls._client_consolidato is None:
+            cls._client_consolidato = chromadb.PersistentClient(
+                path=os.path.join(cls.DEFAULT_VECTORSTORE_PATH, cls.DIRECTORY_CONSOLIDATO))
+        return cls._client_consolidato
+
+    def _apri_consolidato(self, collection_name: str) -> Chroma:
+        """Ritorna la collection consolidata del modello, aperta una sola volta e condivisa da tutti i file."""
+        motore = self.get_motore_di_embedding()
+        vectorstore = Rag._vectorstore_consolidati.get(collection_name)
+        if vectorstore is None or getattr(vectorstore, "_embedding_function", None) is not motore:
+            vectorstore = Chroma(client=Rag._get_client_consolidato(), collection_name=collection_name,
+                                 embedding_function=motore)
+            Rag._vectorstore_consolidati[collection_name] = vectorstore
         return vectorstore
 
+    @staticmethod
+    def _nome_collezione_consolidata(engine_name: str, model_name: str) -> str:
+        # il nome di una collection Chroma è limitato a 63 caratteri alfanumerici
+        return "rag_" + hashlib.sha256(f"{engine_name}|{model_name}".encode()).hexdigest()[:32]
+
+    @staticmethod
+    def _filtro_file(vectorstore_id) -> dict:
+        """Filtro sui metadati che seleziona i chunk di un file nella collection consolidata."""
+        file_id, _engine, _model, chunker_sig = vectorstore_id
+        return {"$and": [{"file_id": file_id}, {"chunker": chunker_sig}]}
+
+    @staticmethod
+    def _raggruppa_sorgenti(sorgenti: list[tuple]) -> list[tuple]:
+        """
+        Raggruppa le sorgenti (chiave, vectorstore, filtro) in tuple (vectorstore, filtro), una per query:
+        i file della stessa collection consolidata (e dello stesso chunker) vengono cercati con una sola query
+        filtrata su tutti i loro file_id, mentre ogni collection separata resta una query a sé.
+        """
+        gruppi = {}
+        for key, vectorstore, filtro in sorgenti:
+            if filtro is None:
+                gruppi[(id(vectorstore), None)] = (vectorstore, [])
+                continue
+            file_id, _engine, _model, chunker_sig = json.loads(key)
+            gruppi.setdefault((id(vectorstore), chunker_sig), (vectorstore, []))[1].append(file_id)
+        query = []
+        for (_, chunker_sig), (vectorstore, file_ids) in gruppi.items():
+            if chunker_sig is None:
+                query.append((vectorstore, None))
+            elif len(file_ids) == 1:
+                query.append((vectorstore, {"$and": [{"file_id": file_ids[0]}, {"chunker": chunker_sig}]}))
+            else:
+                query.append((vectorstore, {"$and": [{"file_id": {"$in": file_ids}}, {"chunker": chunker_sig}]}))
+        return query
+
+    @classmethod
+    def _filtro_ricerca(cls, key: str) -> dict | None:
+        """Ritorna il filtro da usare nelle ricerche sul vectorstore, o None se il file ha una collection sua."""
+        voce = cls.get_indice().get(key) or {}
+        if voce.get("archivio") != cls.ARCHIVIAZIONE_CONSOLIDATA:
+            return None
+        return cls._filtro_file(json.loads(key))
+
+    @classmethod
+    def migra_in_consolidato(cls) -> int:
+        """
+        Sposta nell'archiviazione consolidata i vectorstore salvati in una directory per file, copiando
+        chunk, metadati ed embedding senza ricalcolarli, ed elimina le vecchie directory.
+        Ritorna il numero di vectorstore migrati.
+        """
+        migrati = 0
+        for key, voce in list(cls.get_indice().items()):
+            collection_name = voce.get("collection_name")
+            if voce.get("archivio") == cls.ARCHIVIAZIONE_CONSOLIDATA or not collection_name:
+                continue
+            collection_dir = os.path.join(cls.DEFAULT_VECTORSTORE_PATH, collection_name)
+            try:
+                vectorstore_id = json.loads(key)
+                cls._cache_vectorstores.pop(key, None)
+                sorgente = Chroma(collection_name=collection_name, persist_directory=collection_dir)
+                dati = sorgente._collection.get(include=["documents", "metadatas", "embeddings"])
+                del sorgente
+                gc.collect()
+                nome_consolidato = cls._nome_collezione_consolidata(vectorstore_id[1], vectorstore_id[2])
+                destinazione = Chroma(client=cls._get_client_consolidato(), collection_name=nome_consolidato)._collection
+                destinazione.delete(where=cls._filtro_file(vectorstore_id))
+                metadati = [{**(m or {}), "file_id": vectorstore_id[0], "chunker": vectorstore_id[3]} for m in dati["metadatas"]]
+                cls._aggiungi_chunk(destinazione, dati["ids"], dati["embeddings"], dati["documents"], metadati)
+                cls.get_indice()[key] = {"collection_name": nome_consolidato, "label": voce.get("label", ""),
+                                         "archivio": cls.ARCHIVIAZIONE_CONSOLIDATA}
+                # salvo l'indice prima di eliminare la directory: i chunk non restano mai senza una voce
+                cls.salva_indice_vectorstores()
+                cls._elimina_collection_separata(collection_name)
+                migrati += 1
+            except Exception as e:
+                logging.warning(f"[RAG] Migrazione di '{collection_name}' nell'archivio consolidato non riuscita: {e}")
+        logging.info(f"[RAG] Migrati {migrati} vector store nell'archivio consolidato")
+        return migrati
+
     #Cancella la collection dal DB Chroma e aggiorna indice/cache.
     @classmethod
     def delete_vectorstore(cls, vectorstore_id_str: str) -> bool:
@@ -331,33 +729,22 @@ class Rag():
         collection_name = entry.get("collection_name")
         if not collection_name:
             return False
-        collection_dir = os.path.join(cls.DEFAULT_VECTORSTORE_PATH, collection_name)
         try:
             # 1) Rimuove il vectorstore dalla cache in RAM
             vectorstore = cls._cache_vectorstores.pop(vectorstore_id_str, None)
             if vectorstore is not None:
                 del vectorstore
                 gc.collect()
-
-            # 2) Apre un client "pulito" solo per il delete logico
-            vectorstore = Chroma(
-                collection_name=collection_name,
-                persist_directory=collection_dir,
-            )
-
-            client = getattr(vectorstore, "_client", None)
-            if client is None:
-                raise RuntimeError("Client interno Chroma non disponibile.")
-
-            # Cancellazione logica sul DB
-            client.delete_collection(name=collection_name)
-            # 3) Distruggi TUTTO
-            del client
-            del vectorstore
-            gc.collect()
-            # 4) Cancello anche dal disco
-            shutil.rmtree(collection_dir, ignore_errors=False)
-            # 5) Aggiorna indice
+            with cls._lock_bm25:
+                cls._cache_bm25.pop(vectorstore_id_str, None)
+            IndiceBM25.elimina(vectorstore_id_str)
+            if entry.get("archivio") == cls.ARCHIVIAZIONE_CONSOLIDATA:
+                # 2) Nella collection consolidata si eliminano solo i chunk del file
+                Chroma(client=cls._get_client_consolidato(), collection_name=collection_name)._collection.delete(
+                    where=cls._filtro_file(json.loads(vectorstore_id_str)))
+            else:
+                cls._elimina_collection_separata(collection_name)
+            # 3) Aggiorna indice
             cls.get_indice().pop(vectorstore_id_str, None)
         except Exception as e:
             logging.warning(f"Errore cancellazione collection '{collection_name}': {e}")
@@ -367,6 +754,29 @@ class Rag():
             logging.warning(f"Non riesco a salvare l'indice dopo delete: {e}")
         return True
 
+    @classmethod
+    def _elimina_collection_separata(cls, collection_name: str):
+        """Cancella una collection archiviata nella sua directory, insieme alla directory."""
+        collection_dir = os.path.join(cls.DEFAULT_VECTORSTORE_PATH, collection_name)
+        # Apre un client "pulito" solo per il delete logico
+        vectorstore = Chroma(
+            collection_name=collection_name,
+            persist_directory=collection_dir,
+        )
+
+        client = getattr(vectorstore, "_client", None)
+        if client is None:
+            raise RuntimeError("Client interno Chroma non disponibile.")
+
+        # Cancellazione logica sul DB
+        client.delete_collection(name=collection_name)
+        # Distruggi TUTTO
+        del client
+        del vectorstore
+        gc.collect()
+        # Cancello anche dal disco
+        shutil.rmtree(collection_dir, ignore_errors=False)
+
     @staticmethod
     def _estrai_label_da_splits(splits) -> str:
         """
@@ -382,120 +792,370 @@ class Rag():
                 continue
         return ""
 
+    def _recupero_chunk(self, sorgenti: list[tuple], vettore_query: list[float], modo) -> list[Document]:
+        """
+        Ritorna i top-k chunk più rilevanti fra tutti i file. Con il riordino attivo la ricerca prende
+        FATTORE_CANDIDATI_RERANK volte più candidati e il cross-encoder tiene i migliori k; se supera il
+        budget di tempo (o non è disponibile) si tengono i primi k trovati dalla ricerca.
+        """
+        if not self._rerank:
+            return self._cerca_candidati(sorgenti, vettore_query, modo, self._topk)
+        if not Riordinatore.pronto():
+            # il modello viene caricato in background: questo messaggio non lo aspetta
+            Riordinatore.precarica()
+            self._notify_status("⏳ Riordino saltato: cross-encoder ancora in caricamento")
+            return self._cerca_candidati(sorgenti, vettore_query, modo, self._topk)
+        candidati = self._cerca_candidati(sorgenti, vettore_query, modo, self._topk * Rag.FATTORE_CANDIDATI_RERANK)
+        self._notify_status(f"🏅 Riordino di {len(candidati)} chunk con il cross-encoder")
+        try:
+            riordinati = Riordinatore.riordina(self._prompt.get_testo(), candidati, self._topk, self._budget_rerank_ms)
+        except Exception as e:
+            logging.warning(f"[RAG] Riordino non riuscito: {e}")
+            riordinati = None
+        if riordinati is None:
+            self._notify_status(f"⏱️ Riordino saltato: tengo l'ordine della ricerca")
+            return candidati[:self._topk]
+        return riordinati
+
     # Inizialmente facevo una semplice similarity_search ma mi sono reso conto che con
     # query brevi o con chunk piccoli uscivano molti duplicati. Quindi ho deciso di
     # implementare anche una MMR (Maximal Marginal Relevance) seguita da una deduplica
     # dei doppioni per pagina.
-    def _recupero_chunk(self, vectorstore, modo):
+    def _cerca_candidati(self, sorgenti: list[tuple], vettore_query: list[float], modo, k: int) -> list[Document]:
         """
+        Cerca i k chunk più rilevanti fra tutti i file insieme (e non k per ogni file).
+        "sorgenti" è la lista di tuple (chiave, vectorstore, filtro) dei file, dove il filtro seleziona i chunk
+        del file nella collection consolidata (None per le collection separate); "vettore_query" è
+        l'embedding del prompt, calcolato una sola volta per tutti i file.
         L'argomento "modo" specifica il tipo di ricerca da effettuare:
             - "mmr": effettua una ricerca Maximal Marginal Relevance. In sostanza vengono presi
                     un numero di chunk (fetch_k) che è più alto rispetto a quello impostato
                     (top_k) in modo da massimizzare la diversità dei chunk
             - "similarity": effettua una semplice ricerca in basse alla somiglianza tra la
                             query e il contenuto del testo nel chucnk.
+            - "hybrid": unisce i candidati della ricerca vettoriale a quelli di BM25 (indice lessicale
+                        del file) e li ordina fondendo i due punteggi: trova anche gli identificatori
+                        esatti (codici, nomi di funzione) che gli embedding riconoscono male.
+        Le distanze sono confrontabili fra i file perché tutti usano lo stesso modello di embedding.
         Qualunque sia la modalità scelta, poi si filtrano i doppioni in base al numero di pagina e al
         contenuto del chunk (si fa l'hash del testo del chuck)
         """
-        top_docs=None
-        if modo=="similarity":
-            top_docs = vectorstore.similarity_search(self._prompt.get_testo(), k=self._topk)
-        elif modo=="mmr":
-            # --------- MMR con deduplica --------------
-            # 1. Prima si fa la MMR recuperando più chuck di quelli previsti da top_k
-            fetch_k = max(self._topk * 4, 20)
-            top_docs = vectorstore.max_marginal_relevance_search(
-                self._prompt.get_testo(),
-                k=self._topk,
-                fetch_k=fetch_k,
-                lambda_mult=0.3,
-            )
-        # Elimino i chuck duplicati
+        # 1. Da ogni query si prendono i candidati migliori: per la MMR più chunk di quelli previsti da top_k.
+        # I file della collection consolidata vengono cercati con una query sola (vedi _raggruppa_sorgenti),
+        # quelli separati con una query ciascuno: in entrambi i casi poi si tengono i primi fetch_k in totale
+        fetch_k = k if modo == "similarity" else max(self._fetch_k or max(k * 4, 20), k)
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if modo == "mmr" else [])
+        candidati = []  # (distanza, Document, embedding)
+        for vectorstore, filtro in Rag._raggruppa_sorgenti(sorgenti):
+            trovati = vectorstore._collection.query(query_embeddings=[vettore_query], n_results=fetch_k,
+                                                    where=filtro, include=include)
+            embeddings = trovati["embeddings"][0] if modo == "mmr" else [None] * len(trovati["ids"][0])
+            for testo, metadati, distanza, embedding in zip(trovati["documents"][0], trovati["metadatas"][0],
+                                                            trovati["distances"][0], embeddings):
+                candidati.append((distanza, Document(page_content=testo or "", metadata=metadati or {}), embedding))
+        candidati.sort(key=lambda c: c[0])
+
+        # Elimino i chuck duplicati (prima della selezione, così non occupano posti nei top-k)
         chunk_unici = []
         seen = set()
-        for doc in top_docs:
-            content = doc.page_content or ""
-            key = (doc.metadata.get("source"), doc.metadata.get("page"), content)
+        for candidato in candidati:
+            doc = candidato[1]
+            key = (doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content)
             if key in seen:
                 continue
             seen.add(key)
-            chunk_unici.append(doc)
-        return chunk_unici
+            chunk_unici.append(candidato)
+
+        chunk_unici = chunk_unici[:fetch_k]
+        if modo == "mmr":
+            # 2. MMR sui candidati di tutti i file insieme, usando gli embedding già restituiti dalla ricerca
+            if not chunk_unici:
+                return []
+            indici = mmr(vettore_query, np.stack([c[2] for c in chunk_unici]), k=k, lambda_mult=self._lambda_mmr)
+            return [chunk_unici[i][1] for i in indici]
+        if modo == "hybrid":
+            return self._fusione_ibrida(sorgenti, [(c[0], c[1]) for c in chunk_unici], fetch_k, k)
+        return [c[1] for c in chunk_unici[:k]]
+
+    def _fusione_ibrida(self, sorgenti: list[tuple], vettoriali: list[tuple], fetch_k: int, k: int) -> list[Document]:
+        """
+        Aggiunge ai candidati della ricerca vettoriale (tuple (distanza, Document)) quelli trovati da BM25 in
+        ogni file e ritorna i primi k secondo la fusione dei due punteggi (vedi fondi_punteggi).
+        Ogni file ha il suo indice BM25, quindi i punteggi lessicali vengono prima normalizzati per file
+        (vedi IndiceBM25.cerca): senza, i file piccoli avrebbero punteggi più alti.
+        """
+        documenti, punteggi_vettoriali, punteggi_lessicali = {}, {}, {}
+        for distanza, doc in vettoriali:
+            chiave = (doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content)
+            documenti[chiave] = doc
+            punteggi_vettoriali[chiave] = -distanza  # distanza minore = più rilevante
+        for key, vectorstore, filtro in sorgenti:
+            for punteggio, testo, metadati in self._get_indice_bm25(key, vectorstore, filtro).cerca(self._prompt.get_testo(), fetch_k, normalizzati=True):
+                chiave = (metadati.get("source"), metadati.get("page"), testo)
+                documenti.setdefault(chiave, Document(page_content=testo, metadata=metadati))
+                punteggi_lessicali[chiave] = max(punteggio, punteggi_lessicali.get(chiave, 0.0))
+        ordinati = fondi_punteggi(punteggi_vettoriali, punteggi_lessicali, Rag.PESO_VETTORIALE_IBRIDO)
+        return [documenti[chiave] for chiave in ordinati[:k]]
+
+    @classmethod
+    def _get_pool_parsing(cls) -> ProcessPoolExecutor:
+        """
+        Ritorna il pool di processi per il parsing, creandolo alla prima richiesta. I processi vengono
+        avviati con "spawn": Streamlit e il ciclo di eventi usano thread che un fork copierebbe a metà.
+        """
+        with cls._lock_pool:
+            if cls._pool_parsing is None:
+                cls._pool_parsing = ProcessPoolExecutor(max_workers=max(1, cls.MAX_PROCESSI_PARSING),
+                                                        mp_context=multiprocessing.get_context("spawn"))
+            return cls._pool_parsing
+
+    def _analizza_documenti(self, da_analizzare: list[tuple]) -> tuple[dict, dict]:
+        """
+        Esegue il parsing dei file da_analizzare (lista di tuple (chiave, percorso, mimetype, nome)) e ritorna
+        due dizionari: chiave -> chunk dei file analizzati e chiave -> eccezione di quelli non riusciti
+        (es. un PDF corrotto), che non interrompono il parsing degli altri. Se i file sono più di uno il
+        parsing viene distribuito sul pool di processi; solo se il pool stesso si rompe i file rimasti
+        vengono analizzati uno alla volta in questo processo.
+        """
+        risultati, errori = {}, {}
+        if len(da_analizzare) > 1:
+            pool = None
+            try:
+                pool = Rag._get_pool_parsing()
+                futuri = {pool.submit(_analizza_documento, percorso, mimetype, self._parametri_chunker): (chiave, nome)
+                          for chiave, percorso, mimetype, nome in da_analizzare}
+                for futuro in as_completed(futuri):
+                    chiave, nome = futuri[futuro]
+                    try:
+                        risultati[chiave] = futuro.result()
+                        self._notify_status(f"📑 {nome}: analizzato ({len(risultati) + len(errori)}/{len(da_analizzare)})")
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        errori[chiave] = e
+                        self._notify_status(f"⚠️ {nome}: parsing non riuscito ({e})")
+                return risultati, errori
+            except (BrokenProcessPool, RuntimeError) as e:
+                # pool rotto (es. un processo terminato) o chiuso: lo sostituisco, senza toccarne uno già ricreato
+                logging.warning(f"[RAG] Pool di parsing non utilizzabile, analizzo i file rimasti uno alla volta: {e}")
+                with Rag._lock_pool:
+                    if pool is not None and Rag._pool_parsing is pool:
+                        Rag._pool_parsing.shutdown(wait=False)
+                        Rag._pool_parsing = None
+        for chiave, percorso, mimetype, nome in da_analizzare:
+            if chiave in risultati or chiave in errori:
+                continue
+            try:
+                risultati[chiave] = self._filtra_metadati_complessi(percorso, mimetype)
+                self._notify_status(f"📑 {nome}: analizzato")
+            except Exception as e:
+                errori[chiave] = e
+                self._notify_status(f"⚠️ {nome}: parsing non riuscito ({e})")
+        return risultati, errori
+
+    def _calcola_embeddings(self, splits: list[Document]) -> list[list[float]]:
+        """
+        Calcola gli embedding dei chunk di tutti i file in un'unica fase, a lotti di DIMENSIONE_LOTTO_EMBEDDING.
+        I chunk già incontrati con lo stesso modello vengono letti da CacheEmbedding invece di essere ricalcolati.
+        """
+        motore = self.get_motore_di_embedding()
+        embeddings = []
+        for inizio in range(0, len(splits), Rag.DIMENSIONE_LOTTO_EMBEDDING):
+            lotto = splits[inizio:inizio + Rag.DIMENSIONE_LOTTO_EMBEDDING]
+            embeddings.extend(CacheEmbedding.embed_documents(motore, self._modello, [doc.page_content for doc in lotto]))
+            self._notify_status(f"🧮 Embeddings: {len(embeddings)}/{len(splits)} chunk")
+        return embeddings
+
+    def _chiave_cache(self, file_id: str) -> tuple:
+        """Tupla che identifica univocamente il vectorstore di un file nella cache: (file_id, engine_name, model_name, chunker_sig)."""
+        engine_name = type(self.get_motore_di_embedding()).__name__
+        chunker_sig = f"{type(self._chunker).__name__}:{getattr(self._chunker,'max_tokens',None)}:{getattr(self._chunker,'overlap',None)}"
+        return (file_id, engine_name, self._modello, chunker_sig)
+
+    def _prepara_vectorstore(self, file: list[tuple]) -> tuple[int, set]:
+        """
+        Crea i vectorstore mancanti dei file, passati come tuple (chiave_cache, percorso, mimetype, nome):
+        parsing dei file nuovi (in parallelo su un pool di processi, saltando quelli già analizzati, ad esempio
+        con un altro modello di embedding), calcolo degli embedding di tutti i loro chunk in un'unica fase e
+        creazione delle collection. Ritorna il numero di vectorstore creati e l'insieme delle chiavi
+        (json) dei file il cui parsing non è riuscito, che restano senza vectorstore.
+        """
+        # 1) cerco i vectorstore già pronti (in cache o su disco)
+        da_analizzare = {}  # chiave -> (chiave, percorso, mimetype, nome), una sola volta per file uguali
+        nuovi = {}          # chiave -> tupla che identifica il vectorstore da creare
+        for chiave_cache, percorso, mimetype, nome in file:
+            key = json.dumps(chiave_cache, ensure_ascii=False)
+            if key in Rag._cache_vectorstores:
+                self._notify_status(f"💾 {nome}: vectorstore trovato in cache")
+            elif key in Rag.get_indice():
+                self._notify_status(f"💾 {nome}: caricamento vectorstore da disco")
+            elif key not in da_analizzare:
+                da_analizzare[key] = (key, percorso, mimetype, nome)
+                nuovi[key] = chiave_cache
+        if not da_analizzare:
+            return 0, set()
+
+        # 2) parsing dei file nuovi con Docling
+        splits_per_file = {}
+        for key, (_, _, _, nome) in da_analizzare.items():
+            splits = Rag._leggi_parsing(self._firma_parsing(nuovi[key][0]))
+            if splits is not None:
+                splits_per_file[key] = splits
+                self._notify_status(f"♻️ {nome}: parsing già in cache")
+        da_parsare = [valori for key, valori in da_analizzare.items() if key not in splits_per_file]
+        if da_parsare:
+            self._notify_status(f"🔍 Parsing di {len(da_parsare)} documenti con Docling...")
+            analizzati, errori = self._analizza_documenti(da_parsare)
+            for key, splits in analizzati.items():
+                Rag._salva_parsing(self._firma_parsing(nuovi[key][0]), splits)
+                splits_per_file[key] = splits
+            for key, errore in errori.items():
+                logging.warning(f"[RAG] Parsing di {da_analizzare[key][3]} non riuscito: {errore}")
+                del nuovi[key]
+        falliti = set(da_analizzare) - set(splits_per_file)
+
+        # 3) embeddings dei chunk di tutti i file nuovi in un'unica fase
+        self._notify_status(f"🧮 Creazione embeddings (modello: {self._modello})")
+        tutti_gli_splits = [doc for key in nuovi for doc in splits_per_file[key]]
+        embeddings = self._calcola_embeddings(tutti_gli_splits)
+        inizio = 0
+        for key, chiave_cache in nuovi.items():
+            splits = splits_per_file[key]
+            self._crea_vectorstore(chiave_cache, splits, embeddings[inizio:inizio + len(splits)])
+            inizio += len(splits)
+        try:
+            Rag.salva_indice_vectorstores()
+        except Exception as e:
+            logging.warning(f"Non riesco a salvare l'indice dei vector store: {e}")
+        return len(nuovi), falliti
+
+    def _file_dei_corpora(self) -> list[tuple]:
+        """
+        Ritorna i file dei corpora scelti come tuple (chiave_cache, percorso, mimetype, nome), usando l'elenco
+        salvato all'ultima indicizzazione: ad ogni messaggio la directory non viene riletta.
+        La chiave è calcolata dallo sha256 salvato, quindi i file modificati dopo l'ultima indicizzazione
+        (data di modifica o dimensione diverse da quelle salvate) vengono saltati: altrimenti il loro contenuto
+        attuale finirebbe nel vectorstore con la chiave del contenuto precedente.
+        """
+        file = []
+        for nome_corpus in self._corpora:
+            corpus = Corpora.get(nome_corpus)
+            if corpus is None:
+                continue
+            for relativo, voce in corpus["file"].items():
+                percorso = os.path.join(corpus["directory"], relativo)
+                try:
+                    stato = os.stat(percorso)
+                except OSError:
+                    continue  # file rimosso dopo l'ultima indicizzazione
+                nome = f"{nome_corpus}/{relativo}"
+                if stato.st_mtime != voce["mtime"] or stato.st_size != voce["dimensione"]:
+                    logging.warning(f"[RAG] {nome} modificato dopo l'ultima indicizzazione: file saltato")
+                    self._notify_status(f"⚠️ {nome}: modificato dopo l'ultima indicizzazione, reindicizza la base di conoscenza")
+                    continue
+                file.append((self._chiave_cache(voce["sha256"]), percorso, voce["mimetype"], nome))
+        return file
+
+    def indicizza_corpus(self, nome: str) -> dict:
+        """
+        Indicizza il corpus con il modello di embedding e il chunker correnti. Vengono analizzati solo i file
+        nuovi o modificati (data di modifica e sha256) e quelli senza vectorstore per il modello corrente.
+        I vectorstore delle vecchie versioni dei file restano nella cache globale, da cui si possono eliminare.
+        """
+        file, modificati, rimossi = Corpora.scansiona(nome)
+        directory = Corpora.get(nome)["directory"]
+        self._notify_status(f"📚 {nome}: {len(file)} file, {len(modificati)} nuovi o modificati, {len(rimossi)} rimossi")
+        creati, falliti = self._prepara_vectorstore([(self._chiave_cache(voce["sha256"]), os.path.join(directory, relativo),
+                                                      voce["mimetype"], relativo) for relativo, voce in file.items()])
+        # i file non analizzati restano fuori dall'elenco: vengono riprovati alla prossima indicizzazione
+        non_indicizzati = [relativo for relativo, voce in file.items()
+                           if json.dumps(self._chiave_cache(voce["sha256"]), ensure_ascii=False) in falliti]
+        for relativo in non_indicizzati:
+            del file[relativo]
+        Corpora.aggiorna(nome, file)
+        logging.info(f"[RAG] Indicizzato il corpus '{nome}': {creati} vectorstore creati, {len(non_indicizzati)} file non analizzabili")
+        return {"file": len(file), "modificati": len(modificati), "rimossi": len(rimossi), "vectorstore_creati": creati,
+                "errori": non_indicizzati}
 
     def run(self):
-        """Esegue il RAG e restituisce i top-k risultati per ciascun allegato"""
+        """
+        Esegue il RAG e restituisce un allegato con i top-k risultati fra tutti gli allegati e i file dei
+        corpora scelti. Le fasi sono: salvataggio degli allegati, creazione dei vectorstore mancanti (vedi
+        _prepara_vectorstore) e ricerca in tutti i file con un solo embedding del prompt.
+        """
         if not self._prompt:
             raise Exception("Errore in fase di RAG: prompt non impostato")
         risultato = []
+        directory_file = []
         try:
             os.makedirs(self._upload_dir, exist_ok=True)
-            # imposto le varie parti che compongono il nome della chiave nella cache dei vectorstores
-            engine_name = type(self._motore_di_embedding).__name__
-            model_name = self._modello
-            chunker_sig = f"{type(self._chunker).__name__}:{getattr(self._chunker,'max_tokens',None)}:{getattr(self._chunker,'overlap',None)}"
-            
-            num_files = len(self._prompt.get_allegati())
+            allegati = self._prompt.get_allegati()
+            num_files = len(allegati)
             self._notify_status(f"🔄 Inizio elaborazione RAG ({num_files} file)")
             
-            # inizio a scorrere gli allegati
-            for idx, f in enumerate(self._prompt.get_allegati(), 1):
+            # 1) salvo gli allegati
+            file = []  # (chiave_cache, percorso, mimetype, nome)
+            for idx, f in enumerate(allegati, 1):
                 self._notify_status(f"📄 File {idx}/{num_files}: {f.name}")
-                
-                save_path = os.path.join(self._upload_dir, f.name)
+                file_id=hashlib.sha256(f.getbuffer()).hexdigest()
+                # ogni file in una sua directory: allegati diversi con lo stesso nome non si sovrascrivono
+                directory = os.path.join(self._upload_dir, file_id)
+                os.makedirs(directory, exist_ok=True)
+                directory_file.append(directory)
+                save_path = os.path.join(directory, f.name)
                 with open(save_path, "wb") as out:
                     out.write(f.getbuffer())
-                    file_id=hashlib.sha256(f.getbuffer()).hexdigest()
-                
-                # Questa tupla identifica univocamente un vectorstore nella cache
-                chiave_cache = (file_id, engine_name, model_name, chunker_sig)
-                
-                # Verifica se il vectorstore è già in cache
+                file.append((self._chiave_cache(file_id), save_path, f.type, f.name))
+            # i file dei corpora sono già indicizzati: si aggiungono solo alla ricerca
+            file += self._file_dei_corpora()
+            if not file:
+                return risultato
+
+            # 2) vectorstore dei file che non ne hanno ancora uno (quelli non analizzabili vengono esclusi dalla ricerca)
+            _, falliti = self._prepara_vectorstore(file)
+            file = [f for f in file if json.dumps(f[0], ensure_ascii=False) not in falliti]
+            if not file:
+                raise Exception("nessun file è stato analizzato correttamente")
+            
+            # 3) ricerca dei top-k chunk più rilevanti fra tutti i file, con un solo embedding del prompt
+            sorgenti = {}
+            nomi = {}
+            for chiave_cache, percorso, mimetype, nome in file:
                 key = json.dumps(chiave_cache, ensure_ascii=False)
-                if key in Rag._cache_vectorstores:
-                    self._notify_status(f"💾 Vectorstore trovato in cache")
-                elif key in Rag.get_indice():
-                    self._notify_status(f"💾 Caricamento vectorstore da disco")
-                else:
-                    self._notify_status(f"🔍 Parsing documento con Docling...")
-                
-                # Recupera il vectorstore (dalla cache se già esiste)
-                vectorstore = self._get_vectorstore(path=save_path, vectorstore_id=chiave_cache, tipo=f.type)
-                
-                # Se non era in cache, significa che è stato appena creato
-                if key not in Rag._cache_vectorstores or key not in Rag.get_indice():
-                    self._notify_status(f"🧮 Creazione embeddings (modello: {model_name})")
-                
-                # Cancella il file ORIGINARIO (non serve più)
-                try:
-                    os.remove(save_path)
-                except Exception:
-                    # Non blocca il flusso se non riesce a cancellare il file (lock, antivirus, etc.)
-                    pass
-                
-                # Recupera i top-k chunk più rilevanti
-                modalita_emoji = "🔎" if self._modalita_ricerca == "similarity" else "🎯"
-                self._notify_status(f"{modalita_emoji} Ricerca semantica (top-{self._topk}, modalità: {self._modalita_ricerca})")
-                top_docs=self._recupero_chunk(vectorstore=vectorstore, modo=self._modalita_ricerca)
-                
-                # Rende ciascun chunk in un code fence "text" (niente interpretazione markdown)
-                def as_code_block(s: str) -> str:
-                    return f"```text\n{s}\n```"
-                risultato.append(Allegato(tipo="text", contenuto="\n\n---\n\n".join(as_code_block(doc.page_content) for doc in top_docs), mime_type="text/plain"))
-                
-                self._notify_status(f"✅ File {idx}/{num_files} completato")
+                if key in sorgenti:
+                    continue
+                vectorstore = self._get_vectorstore(path=percorso, vectorstore_id=chiave_cache, tipo=mimetype)
+                sorgenti[key] = (key, vectorstore, Rag._filtro_ricerca(key))
+                nomi[percorso] = nome
+            modalita_emoji = {"similarity": "🔎", "mmr": "🎯"}.get(self._modalita_ricerca, "🔀")
+            self._notify_status(f"{modalita_emoji} Ricerca semantica in {len(sorgenti)} file (top-{self._topk}, modalità: {self._modalita_ricerca})")
+            vettore_query = self.get_motore_di_embedding().embed_query(self._prompt.get_testo())
+            top_docs = self._recupero_chunk(list(sorgenti.values()), vettore_query, self._modalita_ricerca)
+
+            # Rende ciascun chunk in un code fence "text" (niente interpretazione markdown), indicando il file da cui viene
+            def as_code_block(doc: Document) -> str:
+                sorgente = doc.metadata.get("source", "")
+                return f"[{nomi.get(sorgente) or os.path.basename(sorgente)}]\n```text\n{doc.page_content}\n```"
+            if top_docs:
+                risultato.append(Allegato(tipo="text", contenuto="\n\n---\n\n".join(as_code_block(doc) for doc in top_docs), mime_type="text/plain"))
             
             self._notify_status(f"✅ RAG completato con successo")
             return risultato
         except Exception as e:
             self._notify_status(f"❌ Errore RAG: {str(e)}")
             raise Exception(f"Errore in fase RAG: {e}")
+        finally:
+            # Cancella i file ORIGINARI (non servono più)
+            for directory in directory_file:
+                # Non blocca il flusso se non riesce a cancellare il file (lock, antivirus, etc.)
+                shutil.rmtree(directory, ignore_errors=True)
 
     # funzione che carica i vectorstore da file
     @classmethod
     def carica_indice_vectorstores(cls):
         """
         Carica l'indice dei vector store. Ritorna un dict:
-            { vectorstore_id_str: { "collection_name": str, "label": str } }
+            { vectorstore_id_str: { "collection_name": str, "label": str[, "archivio": "consolidata"] } }
         """
         if os.path.exists(cls.DEFAULT_VECTORSTORE_INDEX_FILE_PATH):
             try:
@@ -504,6 +1164,8 @@ class Rag():
                     raw = json.load(f)
                 for k, v in raw.items():
                     data[k] = {"collection_name": v.get("collection_name", ""), "label": v.get("label", "")}
+                    if v.get("archivio"):
+                        data[k]["archivio"] = v["archivio"]
                 return data
             except Exception:
                 return {}
@@ -552,3 +1214,5 @@ class Rag():
             righe.append((id_str, collection_name, label, model_name))
 
         return righe
+
+RegistroEmbedding.registra_callback_evizione(Rag._rilascia_vectorstores_del_motore)
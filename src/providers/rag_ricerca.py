@@ -0,0 +1,165 @@
+from collections import Counter
+import numpy as np
+import os, re, json, math, logging, hashlib
+
+class IndiceBM25():
+    """
+    Indice invertito BM25 dei chunk di un file, costruito insieme alla sua collection e salvato su disco.
+    Serve alla ricerca ibrida: gli embedding trovano i chunk simili nel significato ma riconoscono male
+    gli identificatori esatti (codici di errore, codici prodotto, nomi di funzione), che invece BM25
+    trova con una semplice corrispondenza dei termini.
+    Il tokenizer conserva gli identificatori composti (es. "ERR-404", "get_user", "v2.1.3") come un unico
+    termine e in più ne indicizza le singole parti, così si trovano cercando sia l'intero sia una parte.
+    """
+
+    DIRECTORY = os.path.join("vectorstore_cache", "bm25")
+    # parametri classici di BM25: saturazione della frequenza dei termini e normalizzazione per lunghezza
+    K1 = 1.5
+    B = 0.75
+    _REGEX_TERMINI = re.compile(r"\w+(?:[-_.:/#]\w+)*")
+
+    def __init__(self, testi: list[str] = None, metadati: list[dict] = None):
+        self._testi = []
+        self._metadati = []
+        self._lunghezze = []
+        self._postings = {}  # termine -> [[indice del chunk, frequenza], ...]
+        if testi:
+            self.aggiungi(testi, metadati or [{} for _ in testi])
+
+    @classmethod
+    def tokenizza(cls, testo: str) -> list[str]:
+        termini = []
+        for termine in cls._REGEX_TERMINI.findall((testo or "").lower()):
+            termini.append(termine)
+            parti = re.split(r"[-_.:/#]", termine)
+            if len(parti) > 1:
+                termini.extend(p for p in parti if p)
+        return termini
+
+    def aggiungi(self, testi: list[str], metadati: list[dict]):
+        for testo, meta in zip(testi, metadati):
+            indice = len(self._testi)
+            termini = self.tokenizza(testo)
+            self._testi.append(testo)
+            self._metadati.append(meta)
+            self._lunghezze.append(len(termini))
+            for termine, frequenza in Counter(termini).items():
+                self._postings.setdefault(termine, []).append([indice, frequenza])
+
+    def __len__(self):
+        return len(self._testi)
+
+    def cerca(self, query: str, k: int, normalizzati: bool = False) -> list[tuple[float, str, dict]]:
+        """
+        Ritorna i k chunk con il punteggio BM25 più alto come tuple (punteggio, testo, metadati).
+        I punteggi di indici diversi non sono confrontabili (IDF e lunghezza media dipendono dal file):
+        con normalizzati=True vengono divisi per il punteggio massimo ottenibile dalla query in questo
+        indice (ogni termine con frequenza che satura BM25), quindi sono in [0, 1] e confrontabili.
+        """
+        if not self._testi:
+            return []
+        n = len(self._testi)
+        lunghezza_media = sum(self._lunghezze) / n or 1
+        punteggi = {}
+        massimo = 0.0
+        for termine in set(self.tokenizza(query)):
+            postings = self._postings.get(termine) or []
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            massimo += idf * (self.K1 + 1)
+            for indice, frequenza in postings:
+                normalizzazione = self.K1 * (1 - self.B + self.B * self._lunghezze[indice] / lunghezza_media)
+                punteggi[indice] = punteggi.get(indice, 0.0) + idf * frequenza * (self.K1 + 1) / (frequenza + normalizzazione)
+        migliori = sorted(punteggi.items(), key=lambda p: p[1], reverse=True)[:k]
+        divisore = massimo if normalizzati and massimo > 0 else 1.0
+        return [(punteggio / divisore, self._testi[i], self._metadati[i]) for i, punteggio in migliori]
+
+    @classmethod
+    def _percorso(cls, chiave: str) -> str:
+        return os.path.join(cls.DIRECTORY, hashlib.sha256(chiave.encode("utf-8")).hexdigest() + ".json")
+
+    def salva(self, chiave: str):
+        """Salva l'indice del vectorstore identificato da chiave (scrittura atomica)."""
+        percorso = self._percorso(chiave)
+        os.makedirs(os.path.dirname(percorso), exist_ok=True)
+        with open(f"{percorso}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"testi": self._testi, "metadati": self._metadati, "lunghezze": self._lunghezze,
+                       "postings": self._postings}, f, ensure_ascii=False)
+        os.replace(f"{percorso}.tmp", percorso)
+
+    @classmethod
+    def carica(cls, chiave: str) -> "IndiceBM25 | None":
+        """Ritorna l'indice salvato del vectorstore, o None se non esiste (es. collection creata prima della ricerca ibrida)."""
+        try:
+            with open(cls._percorso(chiave), "r", encoding="utf-8") as f:
+                dati = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"[RAG] Indice BM25 illeggibile, verrà ricostruito: {e}")
+            return None
+        indice = cls()
+        indice._testi, indice._metadati = dati["testi"], dati["metadati"]
+        indice._lunghezze, indice._postings = dati["lunghezze"], dati["postings"]
+        return indice
+
+    @classmethod
+    def elimina(cls, chiave: str):
+        try:
+            os.remove(cls._percorso(chiave))
+        except FileNotFoundError:
+            pass
+
+
+def fondi_punteggi(vettoriali: dict, lessicali: dict, peso_vettoriale: float) -> list:
+    """
+    Fusione convessa dei punteggi della ricerca vettoriale e di quella lessicale: entrambi vengono portati
+    in [0, 1] con una normalizzazione min-max (le due scale non sono confrontabili) e sommati con peso
+    peso_vettoriale e 1 - peso_vettoriale. Un chunk trovato da una sola delle due ricerche ha 0 nell'altra.
+    I dizionari hanno come chiave l'identificativo del chunk (più alto = più rilevante); ritorna le chiavi
+    ordinate per punteggio fuso decrescente.
+    """
+    def normalizza(punteggi: dict) -> dict:
+        if not punteggi:
+            return {}
+        minimo, massimo = min(punteggi.values()), max(punteggi.values())
+        if massimo == minimo:
+            return {k: 1.0 for k in punteggi}
+        return {k: (v - minimo) / (massimo - minimo) for k, v in punteggi.items()}
+
+    vettoriali, lessicali = normalizza(vettoriali), normalizza(lessicali)
+    # a parità di punteggio vale l'ordine della ricerca vettoriale e poi di quella lessicale
+    chiavi = list(vettoriali) + [k for k in lessicali if k not in vettoriali]
+    fusi = {k: peso_vettoriale * vettoriali.get(k, 0.0) + (1 - peso_vettoriale) * lessicali.get(k, 0.0) for k in chiavi}
+    return sorted(chiavi, key=fusi.get, reverse=True)
+
+
+def mmr(vettore_query, embeddings, k: int, lambda_mult: float = 0.5) -> list[int]:
+    """
+    Maximal Marginal Relevance vettorizzata con NumPy: ritorna gli indici dei k embedding scelti, in ordine
+    di selezione. Ad ogni passo si sceglie il candidato che massimizza
+        lambda_mult * sim(query, candidato) - (1 - lambda_mult) * max sim(candidato, già scelti)
+    (similarità del coseno). Le similarità con la query si calcolano una volta sola e quelle con i già
+    scelti vengono aggiornate con un solo prodotto matrice-vettore per passo, invece di ricalcolare
+    ogni volta la matrice delle similarità con tutti i già scelti.
+    """
+    matrice = np.asarray(embeddings, dtype=np.float32)
+    if matrice.ndim != 2 or not len(matrice) or k <= 0:
+        return []
+    norme = np.linalg.norm(matrice, axis=1)
+    norme[norme == 0] = 1
+    matrice = matrice / norme[:, None]
+    query = np.asarray(vettore_query, dtype=np.float32).reshape(-1)
+    similarita_query = matrice @ (query / (np.linalg.norm(query) or 1))
+
+    scelti = [int(np.argmax(similarita_query))]
+    disponibili = np.ones(len(matrice), dtype=bool)
+    disponibili[scelti[0]] = False
+    massima_con_scelti = matrice @ matrice[scelti[0]]
+    while len(scelti) < min(k, len(matrice)):
+        punteggi = lambda_mult * similarita_query - (1 - lambda_mult) * massima_con_scelti
+        punteggi[~disponibili] = -np.inf
+        scelto = int(np.argmax(punteggi))
+        scelti.append(scelto)
+        disponibili[scelto] = False
+        np.maximum(massima_con_scelti, matrice @ matrice[scelto], out=massima_con_scelti)
+    return scelti
@@ -1,4 +1,5 @@
 from src.providers.base import Provider
+from src.providers.embedding import RegistroEmbedding
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, AIMessage, ToolMessage
@@ -413,7 +414,8 @@ class ReplicateProvider(Provider):
         """
         if self._rag.get_modello():
             self._rag.set_motore_di_embedding(
-                OpenAIEmbeddings(
+                RegistroEmbedding.ottieni(
+                    OpenAIEmbeddings, self._rag.get_modello(), self._base_url,
                     model=self._rag.get_modello(),
                     base_url=self._base_url,
                     api_key=self._api_key
@@ -0,0 +1,94 @@
+from langchain_core.documents import Document
+import time, logging, threading
+
+class Riordinatore():
+    """
+    Riordina i chunk trovati dal RAG con un cross-encoder locale eseguito su CPU. A differenza degli
+    embedding, che confrontano vettori calcolati separatamente per la query e per il chunk, il
+    cross-encoder legge la coppia (query, chunk) insieme: è più preciso ma troppo lento per tutta la
+    collection, quindi viene usato solo sui candidati già trovati dalla ricerca per scegliere i migliori.
+    Il modello viene caricato in background quando il riordino viene attivato (vedi precarica) ed è
+    condiviso da tutti i provider: finché non è pronto i messaggi tengono l'ordine della ricerca.
+    """
+
+    DEFAULT_MODELLO = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    DEFAULT_BUDGET_MS = 1500
+    # coppie (query, chunk) valutate dal modello in una volta, al massimo
+    DIMENSIONE_LOTTO = 16
+    # coppie del primo lotto, usato per stimare il tempo per coppia quando non c'è ancora una stima
+    DIMENSIONE_PRIMO_LOTTO = 2
+
+    _modelli = {}
+    # nome del modello -> thread che lo sta caricando
+    _caricamenti = {}
+    # nome del modello -> millisecondi per coppia (media mobile delle valutazioni precedenti)
+    _ms_per_coppia = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def precarica(cls, nome_modello: str = DEFAULT_MODELLO):
+        """Avvia il caricamento del modello in un thread, se non è già caricato o in caricamento. Non blocca."""
+        with cls._lock:
+            if nome_modello in cls._modelli or nome_modello in cls._caricamenti:
+                return
+            thread = threading.Thread(target=cls._carica, args=(nome_modello,), name=f"carica-{nome_modello}", daemon=True)
+            cls._caricamenti[nome_modello] = thread
+        thread.start()
+
+    @classmethod
+    def pronto(cls, nome_modello: str = DEFAULT_MODELLO) -> bool:
+        """Ritorna True se il modello è caricato e il riordino può essere usato."""
+        return nome_modello in cls._modelli
+
+    @classmethod
+    def _carica(cls, nome_modello: str):
+        try:
+            # import ritardato: sentence-transformers e torch servono solo se il riordino viene usato
+            from sentence_transformers import CrossEncoder
+            modello = CrossEncoder(nome_modello, device="cpu")
+            with cls._lock:
+                cls._modelli[nome_modello] = modello
+            logging.info(f"[RAG] Caricato il cross-encoder {nome_modello}")
+        except Exception as e:
+            logging.warning(f"[RAG] Impossibile caricare il cross-encoder {nome_modello}: {e}")
+        finally:
+            with cls._lock:
+                cls._caricamenti.pop(nome_modello, None)
+
+    @classmethod
+    def riordina(cls, query: str, documenti: list[Document], k: int, budget_ms: int = DEFAULT_BUDGET_MS,
+                 nome_modello: str = DEFAULT_MODELLO) -> list[Document] | None:
+        """
+        Ritorna i k documenti con il punteggio più alto secondo il cross-encoder, oppure None se il modello
+        non è ancora pronto o se la valutazione non rientra in budget_ms millisecondi: il chiamante tiene
+        l'ordine della ricerca. I lotti sono dimensionati sul tempo rimasto, stimato dalle valutazioni
+        precedenti, così il budget non viene superato di un intero lotto.
+        """
+        if len(documenti) <= 1:
+            return documenti[:k]
+        modello = cls._modelli.get(nome_modello)
+        if modello is None:
+            cls.precarica(nome_modello)
+            logging.info(f"[RAG] Cross-encoder {nome_modello} non ancora caricato: riordino saltato")
+            return None
+        inizio = time.perf_counter()
+        punteggi = []
+        while len(punteggi) < len(documenti):
+            rimasto = budget_ms - (time.perf_counter() - inizio) * 1000
+            stima = cls._ms_per_coppia.get(nome_modello)
+            if stima is None:
+                dimensione = cls.DIMENSIONE_PRIMO_LOTTO
+            else:
+                dimensione = min(cls.DIMENSIONE_LOTTO, int(rimasto // stima))
+            if rimasto <= 0 or dimensione < 1:
+                logging.info(f"[RAG] Riordino interrotto dopo {budget_ms - rimasto:.0f} ms "
+                             f"({len(punteggi)}/{len(documenti)} chunk valutati, budget {budget_ms} ms)")
+                return None
+            lotto = documenti[len(punteggi):len(punteggi) + dimensione]
+            inizio_lotto = time.perf_counter()
+            punteggi.extend(float(p) for p in modello.predict([(query, doc.page_content) for doc in lotto],
+                                                               batch_size=len(lotto), show_progress_bar=False))
+            ms_per_coppia = (time.perf_counter() - inizio_lotto) * 1000 / len(lotto)
+            cls._ms_per_coppia[nome_modello] = ms_per_coppia if stima is None else (stima + ms_per_coppia) / 2
+        ordine = sorted(range(len(documenti)), key=lambda i: punteggi[i], reverse=True)
+        return [documenti[i] for i in ordine[:k]]
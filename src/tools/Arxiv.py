@@ -1,6 +1,4 @@
 from src.tools.Tool import Tool
-from langchain_community.tools.arxiv.tool import ArxivQueryRun
-from langchain_community.utilities import ArxivAPIWrapper
 
 class Arxiv(Tool):
 
@@ -32,6 +30,8 @@ class Arxiv(Tool):
         }
 
     def get_tool(self):
+        from langchain_community.tools.arxiv.tool import ArxivQueryRun
+        from langchain_community.utilities import ArxivAPIWrapper
         # Crea il wrapper Arxiv con i parametri configurati
         arxiv_wrapper = ArxivAPIWrapper(
             top_k_results=self.top_k_results,
@@ -1,5 +1,4 @@
 from src.tools.Tool import Tool
-from langchain_community.tools import DuckDuckGoSearchRun
 
 class DuckDuckGo(Tool):
 
@@ -46,6 +45,7 @@ class DuckDuckGo(Tool):
         Returns:
             Lista contenente un'istanza di DuckDuckGoSearchRun
         """
+        from langchain_community.tools import DuckDuckGoSearchRun
         # Crea il tool DuckDuckGo con i parametri configurati
         search_tool = DuckDuckGoSearchRun(
             name="duckduckgo_search",
@@ -1,5 +1,4 @@
 from src.tools.Tool import Tool
-from langchain_community.agent_toolkits import FileManagementToolkit
 
 class Filesystem(Tool):
 
@@ -44,4 +43,5 @@ class Filesystem(Tool):
         }
 
     def get_tool(self):
+        from langchain_community.agent_toolkits import FileManagementToolkit
         return FileManagementToolkit(root_dir=self.root_dir, selected_tools=self.selected_tools).get_tools()
\ No newline at end of file
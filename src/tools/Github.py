@@ -1,6 +1,4 @@
 from src.tools.Tool import Tool
-from langchain_community.agent_toolkits.github.toolkit import GitHubToolkit
-from langchain_community.utilities.github import GitHubAPIWrapper
 
 class Github(Tool):
 
@@ -30,6 +28,8 @@ class Github(Tool):
         }
 
     def get_tool(self):
+        from langchain_community.agent_toolkits.github.toolkit import GitHubToolkit
+        from langchain_community.utilities.github import GitHubAPIWrapper
         return GitHubToolkit.from_github_api_wrapper(
                 github_api_wrapper=GitHubAPIWrapper(), 
                 include_release_tools=self.include_release_tools
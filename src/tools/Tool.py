@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
-import subprocess, os
-import importlib.util
+import os
+from src.tools.installatore import InstallatorePacchetti
 
 class Tool(ABC):
 
@@ -20,19 +20,12 @@ class Tool(ABC):
 
     def installa_pacchetti(self) -> None:
         """
-        Installa i pacchetti python necessari per il corretto funzionamento del tool.
-        Verifica prima se il pacchetto è già installato per evitare chiamate inutili a uv.
-        pacchetti_python_necessari può essere una lista o un dizionario {pacchetto: modulo}.
+        Mette in coda l'installazione in background dei pacchetti python necessari per il tool.
+        La presenza dei moduli viene verificata senza importarli e l'installazione non blocca
+        il chiamante: lo stato è consultabile con InstallatorePacchetti.stato(nome del tool).
+        pacchetti_python_necessari è un dizionario {pacchetto: modulo}.
         """
-        for pacchetto, module_name in self._pacchetti_python_necessari.items():
-            # Verifica se il pacchetto è già installato provando a importarlo
-            try:
-                importlib.import_module(module_name)
-                # Pacchetto già installato, salta l'installazione
-            except ImportError:
-                # Pacchetto non installato, procedi con l'installazione
-                print(f"📦 Installazione pacchetto: {pacchetto}")
-                subprocess.run(["uv", "pip", "install", pacchetto])
+        InstallatorePacchetti.accoda(self._nome, self._pacchetti_python_necessari)
             
     def set_nome(self, nome: str) -> None:
         self._nome = nome
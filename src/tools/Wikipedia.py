@@ -1,6 +1,4 @@
 from src.tools.Tool import Tool
-from langchain_community.utilities import WikipediaAPIWrapper
-from langchain_community.tools.wikipedia.tool import WikipediaQueryRun
 
 class Wikipedia(Tool):
 
@@ -29,6 +27,8 @@ class Wikipedia(Tool):
         }
 
     def get_tool(self):
+        from langchain_community.utilities import WikipediaAPIWrapper
+        from langchain_community.tools.wikipedia.tool import WikipediaQueryRun
         # Crea il wrapper Arxiv con i parametri configurati
         wiki_wrapper = WikipediaAPIWrapper(
             top_k_results=self.top_k_results,
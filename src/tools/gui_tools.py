@@ -7,6 +7,18 @@ utilizzati in modalità agentica.
 import streamlit as st
 from datetime import datetime
 from src.ConfigurazioneDB import ConfigurazioneDB
+from src.tools.loader import Loader as tools_loader
+from src.tools.installatore import InstallatorePacchetti
+
+# Secondi tra un aggiornamento e l'altro dello stato delle installazioni in corso
+INTERVALLO_AGGIORNAMENTO_INSTALLAZIONI = 2
+
+_ICONE_INSTALLAZIONE = {
+    InstallatorePacchetti.IN_CODA: "⏳",
+    InstallatorePacchetti.IN_INSTALLAZIONE: "🔄",
+    InstallatorePacchetti.INSTALLATO: "✅",
+    InstallatorePacchetti.ERRORE: "❌"
+}
 
 
 def _on_close_tools_dialog():
@@ -33,6 +45,31 @@ def _on_close_tools_dialog():
             del st.session_state["provider_corrente_dialog"]
 
 
+def _mostra_stato_installazioni(in_aggiornamento: bool = False):
+    """
+    Mostra lo stato delle installazioni in background delle dipendenze dei tools.
+    Viene eseguita come fragment: finché ci sono installazioni in corso si aggiorna da sola
+    senza rieseguire la dialog. L'intervallo di aggiornamento è fissato quando la dialog viene
+    disegnata, quindi quando le installazioni finiscono (in_aggiornamento è True ma non c'è più
+    niente in corso) la dialog viene rieseguita per fermare l'aggiornamento automatico.
+    """
+    if in_aggiornamento and not InstallatorePacchetti.in_corso():
+        st.rerun()
+    stati = InstallatorePacchetti.stati()
+    if not stati:
+        return
+    st.caption("📦 Installazione dipendenze:")
+    for nome_tool, stato in sorted(stati.items()):
+        icona = _ICONE_INSTALLAZIONE.get(stato["stato"], "")
+        st.markdown(f"{icona} **{nome_tool}**: {stato['stato'].replace('_', ' ')} ({', '.join(stato['pacchetti'])})")
+        if stato["stato"] == InstallatorePacchetti.ERRORE:
+            st.caption(stato["errore"])
+            if st.button("🔁 Riprova", key=f"riprova_installazione_{nome_tool}"):
+                InstallatorePacchetti.accoda(nome_tool, stato["pacchetti"])
+                # rieseguo tutta la dialog perché il fragment riparta con l'aggiornamento automatico
+                st.rerun()
+
+
 @st.dialog(
     "⚙️ Configurazione Tools per Agent",
     width="large",
@@ -47,10 +84,10 @@ def mostra_dialog_tools_agent():
     """
     st.caption("Configura i tools disponibili per tutti i provider")
     
-    # Ottieni le istanze dei tools dal session state
-    tools_instances = st.session_state.get("tools_instances", {})
+    # Ottieni i metadati dei tools dal session state (i moduli non sono ancora importati)
+    tools_disponibili = st.session_state.get("tools_disponibili", {})
     
-    if not tools_instances:
+    if not tools_disponibili:
         st.warning("Nessun tool disponibile. Verifica l'installazione dei tools in src/tools/")
         return
     
@@ -74,20 +111,21 @@ def mostra_dialog_tools_agent():
     
         with col_left:
             st.subheader("📋 Tools Disponibili")
-            st.caption(f"Totale: {len(tools_instances)} tools")
+            st.caption(f"Totale: {len(tools_disponibili)} tools")
             
             # Filtro di ricerca
             search_filter = st.text_input("🔍 Cerca tool", placeholder="Filtra per nome...")
             
             # Filtra i tools in base alla ricerca
-            tool_names = list(tools_instances.keys())
+            tool_names = list(tools_disponibili.keys())
             filtered_tools = [t for t in tool_names if search_filter.lower() in t.lower()] if search_filter else tool_names
             
             # Container scrollabile per la lista
             with st.container(height=400):
                 for tool_name in sorted(filtered_tools):
                     # Pulsante che seleziona il tool quando cliccato
-                    if st.button(tool_name, key=f"select_btn_{tool_name}", use_container_width=True):
+                    pacchetti = ", ".join(tools_disponibili[tool_name].pacchetti_python_necessari)
+                    if st.button(tool_name, key=f"select_btn_{tool_name}", use_container_width=True, help=f"Pacchetti necessari: {pacchetti}" if pacchetti else None):
                         st.session_state["selected_tool_for_config"] = tool_name
                         # Carica la configurazione esistente se presente
                         if tool_name in tools_salvati_dict:
@@ -95,13 +133,18 @@ def mostra_dialog_tools_agent():
                         else:
                             st.session_state["tool_config_temp"] = {}
                         st.rerun()
+            
+            # Stato delle installazioni in background (non blocca la dialog)
+            in_corso = InstallatorePacchetti.in_corso()
+            run_every = INTERVALLO_AGGIORNAMENTO_INSTALLAZIONI if in_corso else None
+            st.fragment(_mostra_stato_installazioni, run_every=run_every)(in_aggiornamento=in_corso)
         
         # Multiselect per selezionare tools attivi (dopo le colonne)
         st.divider()
         st.subheader("🔧 Selezione Tools Attivi")
         
         # Ottieni tutti i tools disponibili dal loader
-        tutti_tools_disponibili = list(tools_instances.keys())
+        tutti_tools_disponibili = list(tools_disponibili.keys())
         
         # Ottieni i tools attivi dal DB, filtrando solo quelli che esistono ancora
         tools_attivi_db = [
@@ -135,11 +178,11 @@ def mostra_dialog_tools_agent():
             else:
                 st.markdown(f"**Tool selezionato:** `{selected_tool}`")
                 
-                # Ottieni l'istanza del tool
-                tool_instance = tools_instances.get(selected_tool)
-                
-                if not tool_instance:
-                    st.error(f"Tool '{selected_tool}' non trovato nelle istanze")
+                # Ottieni l'istanza del tool: il modulo viene importato solo ora che è stato aperto
+                try:
+                    tool_instance = tools_loader.get_istanza(selected_tool)
+                except Exception as e:
+                    st.error(f"Impossibile caricare il tool '{selected_tool}': {e}")
                     return
                 
                 # Ottieni la configurazione dal tool usando get_configurazione()
@@ -405,6 +448,8 @@ def mostra_dialog_tools_agent():
                         # Svuota i tools da tutti i provider
                         providers = st.session_state.get("providers", {})
                         for provider in providers.values():
+                            if not provider.caricato():
+                                continue
                             provider.set_tools([])
                             try:
                                 provider._crea_agent()
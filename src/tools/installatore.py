@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+import importlib, importlib.util, subprocess, threading, logging
+
+class InstallatorePacchetti():
+    """
+    Coda di installazione in background dei pacchetti python necessari ai tools.
+    Le installazioni (uv pip install) vengono eseguite in parallelo da un pool di thread,
+    così un tool con dipendenze mancanti non blocca mai il thread di Streamlit: finché
+    l'installazione non è terminata il tool risulta non pronto e viene saltato.
+    """
+
+    # numero massimo di installazioni contemporanee
+    MAX_INSTALLAZIONI_PARALLELE = 4
+
+    IN_CODA = "in_coda"
+    IN_INSTALLAZIONE = "in_installazione"
+    INSTALLATO = "installato"
+    ERRORE = "errore"
+
+    _executor = None
+    # nome tool -> {"stato": ..., "pacchetti": {pacchetto: modulo}, "errore": str}
+    _stati = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def pacchetti_mancanti(pacchetti: dict) -> dict:
+        """
+        Ritorna i pacchetti {pacchetto: modulo} il cui modulo non è installato.
+        La verifica usa find_spec, che cerca il modulo senza importarlo.
+        """
+        mancanti = {}
+        for pacchetto, modulo in pacchetti.items():
+            try:
+                trovato = importlib.util.find_spec(modulo) is not None
+            except (ImportError, ValueError):
+                trovato = False
+            if not trovato:
+                mancanti[pacchetto] = modulo
+        return mancanti
+
+    @classmethod
+    def accoda(cls, nome_tool: str, pacchetti: dict):
+        """Mette in coda l'installazione dei pacchetti mancanti del tool (se non è già in corso)."""
+        mancanti = cls.pacchetti_mancanti(pacchetti)
+        if not mancanti:
+            return
+        with cls._lock:
+            stato = cls._stati.get(nome_tool, {}).get("stato")
+            if stato in (cls.IN_CODA, cls.IN_INSTALLAZIONE):
+                return
+            cls._stati[nome_tool] = {"stato": cls.IN_CODA, "pacchetti": mancanti, "errore": ""}
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.MAX_INSTALLAZIONI_PARALLELE, thread_name_prefix="installatore")
+            cls._executor.submit(cls._installa, nome_tool, mancanti)
+        logging.info(f"[TOOLS] In coda l'installazione per {nome_tool}: {', '.join(mancanti)}")
+
+    @classmethod
+    def stato(cls, nome_tool: str) -> dict | None:
+        """Ritorna lo stato dell'installazione del tool, o None se non ne ha mai richiesta una."""
+        with cls._lock:
+            stato = cls._stati.get(nome_tool)
+            return dict(stato) if stato else None
+
+    @classmethod
+    def stati(cls) -> dict:
+        """Ritorna gli stati di tutte le installazioni richieste."""
+        with cls._lock:
+            return {nome: dict(stato) for nome, stato in cls._stati.items()}
+
+    @classmethod
+    def pronto(cls, nome_tool: str) -> bool:
+        """Ritorna True se il tool non ha installazioni in coda, in corso o fallite."""
+        stato = cls.stato(nome_tool)
+        return stato is None or stato["stato"] == cls.INSTALLATO
+
+    @classmethod
+    def in_corso(cls) -> bool:
+        """Ritorna True se c'è almeno un'installazione in coda o in corso."""
+        with cls._lock:
+            return any(s["stato"] in (cls.IN_CODA, cls.IN_INSTALLAZIONE) for s in cls._stati.values())
+
+    @classmethod
+    def _aggiorna(cls, nome_tool: str, stato: str, errore: str = ""):
+        with cls._lock:
+            cls._stati[nome_tool]["stato"] = stato
+            cls._stati[nome_tool]["errore"] = errore
+
+    @classmethod
+    def _installa(cls, nome_tool: str, pacchetti: dict):
+        cls._aggiorna(nome_tool, cls.IN_INSTALLAZIONE)
+        print(f"📦 Installazione pacchetti per {nome_tool}: {', '.join(pacchetti)}")
+        try:
+            processo = subprocess.run(["uv", "pip", "install", *pacchetti], capture_output=True, text=True)
+            if processo.returncode != 0:
+                righe = processo.stderr.strip().splitlines()
+                raise RuntimeError(righe[-1] if righe else f"uv pip install ha restituito {processo.returncode}")
+            # i moduli appena installati non sono visibili ai finder finché non si invalidano le cache
+            importlib.invalidate_caches()
+            ancora_mancanti = cls.pacchetti_mancanti(pacchetti)
+            if ancora_mancanti:
+                raise RuntimeError(f"moduli non trovati dopo l'installazione: {', '.join(ancora_mancanti.values())}")
+            cls._aggiorna(nome_tool, cls.INSTALLATO)
+            logging.info(f"[TOOLS] Pacchetti installati per {nome_tool}")
+        except Exception as e:
+            cls._aggiorna(nome_tool, cls.ERRORE, str(e))
+            logging.warning(f"[TOOLS] Installazione fallita per {nome_tool}: {e}")
@@ -1,24 +1,133 @@
-import importlib, pkgutil, src.tools
+import ast, importlib, pkgutil, threading, logging, src.tools
+from pathlib import Path
 from src.tools.Tool import Tool
 
+class MetadatiTool():
+    """
+    Descrizione di un tool (nome, parametri, descrizioni, variabili d'ambiente e pacchetti necessari)
+    ricavata dal sorgente del modulo senza importarlo: importare un tool significa importare i
+    toolkit di langchain_community e, a volte, i driver che usa (es. SqlDatabase).
+    """
+
+    def __init__(self, nome, modulo, classe, parametri=None, descrizioni=None, opzioni=None,
+                 variabili_necessarie=None, pacchetti_python_necessari=None):
+        self.nome = nome
+        self.modulo = modulo
+        self.classe = classe
+        self.parametri = parametri or {}
+        self.descrizioni = descrizioni or {}
+        self.opzioni = opzioni or {}
+        self.variabili_necessarie = variabili_necessarie or {}
+        self.pacchetti_python_necessari = pacchetti_python_necessari or {}
+
+    @classmethod
+    def da_istanza(cls, istanza: Tool, modulo: str) -> "MetadatiTool":
+        """Costruisce i metadati da un tool già istanziato (usato quando il sorgente non è analizzabile)."""
+        return cls(
+            nome=istanza.get_nome(),
+            modulo=modulo,
+            classe=type(istanza).__name__,
+            parametri={k: v for k, v in istanza.get_configurazione().items() if not k.startswith("_")},
+            descrizioni=getattr(istanza, "_param_descriptions", {}),
+            opzioni=getattr(istanza, "_param_options", {}),
+            variabili_necessarie=istanza.get_variabili_necessarie(),
+            pacchetti_python_necessari=istanza.get_pacchetti_python_necessari()
+        )
+
+
 class Loader():
     _caricamento_effettuato=False
-    _moduli={}
-    
+    _moduli={}      # nome tool -> MetadatiTool
+    _istanze={}     # nome tool -> istanza di Tool (solo per i tool effettivamente usati)
+    _lock=threading.Lock()
+
     @staticmethod
     def discover_tools():
-        # importa tutti i moduli del package tools
+        """
+        Ritorna i metadati di tutti i tool presenti nel package tools.
+        I moduli NON vengono importati: per ottenere il tool vero e proprio usare get_istanza().
+        """
         if not Loader._caricamento_effettuato:
             for _, module_name, _ in pkgutil.iter_modules(src.tools.__path__):
-                # Escludi Tool (classe base), gui_tools (modulo GUI) e loader (questo modulo)
-                if module_name in ("Tool", "gui_tools", "loader"):
+                # Escludi Tool (classe base), gui_tools (modulo GUI), installatore e loader (questo modulo)
+                if module_name in ("Tool", "gui_tools", "installatore", "loader"):
                     continue
-                importlib.import_module(f"{src.tools.__name__}.{module_name}")
+                for metadati in Loader._leggi_metadati(module_name):
+                    if not metadati.nome in Loader._moduli:
+                        Loader._moduli[metadati.nome] = metadati
             Loader._caricamento_effettuato=True
-            # istanzia tutte le sottoclassi concrete
-            for cls in Tool.__subclasses__():
-                instance = cls()
-                if not instance.get_nome() in Loader._moduli:
-                    Loader._moduli[instance.get_nome()] = instance
-                    instance.installa_pacchetti() # installa i pacchetti necessari per il tool
         return Loader._moduli
+
+    @staticmethod
+    def get_istanza(nome: str) -> Tool:
+        """
+        Importa il modulo del tool e lo istanzia alla prima richiesta, poi ritorna sempre la stessa istanza.
+        Viene chiamato solo per i tool attivi e per quelli aperti nella finestra di configurazione.
+        """
+        if nome in Loader._istanze:
+            return Loader._istanze[nome]
+        metadati = Loader.discover_tools().get(nome)
+        if metadati is None:
+            raise KeyError(f"Tool non trovato: {nome}")
+        with Loader._lock:
+            if nome not in Loader._istanze:
+                modulo = importlib.import_module(f"{src.tools.__name__}.{metadati.modulo}")
+                Loader._istanze[nome] = getattr(modulo, metadati.classe)()
+        return Loader._istanze[nome]
+
+    @staticmethod
+    def istanza_caricata(nome: str) -> bool:
+        return nome in Loader._istanze
+
+    @staticmethod
+    def _leggi_metadati(module_name: str) -> list[MetadatiTool]:
+        """
+        Analizza il sorgente del modulo e ricava i metadati delle sottoclassi di Tool che contiene,
+        leggendo gli argomenti passati a super().__init__() e i dizionari _param_descriptions e
+        _param_options assegnati nel costruttore. Se il sorgente non contiene solo valori letterali
+        (quindi non è analizzabile senza eseguirlo) il modulo viene importato come in passato.
+        """
+        percorso = Path(src.tools.__path__[0]) / f"{module_name}.py"
+        try:
+            albero = ast.parse(percorso.read_text(encoding="utf-8"))
+            return [Loader._metadati_da_classe(classe, module_name)
+                    for classe in albero.body
+                    if isinstance(classe, ast.ClassDef) and any(getattr(b, "id", None) == "Tool" for b in classe.bases)]
+        except Exception as e:
+            logging.info(f"[TOOLS] Metadati di '{module_name}' non ricavabili dal sorgente ({e}): importo il modulo")
+            modulo = importlib.import_module(f"{src.tools.__name__}.{module_name}")
+            metadati = []
+            for valore in vars(modulo).values():
+                if isinstance(valore, type) and issubclass(valore, Tool) and valore is not Tool and valore.__module__ == modulo.__name__:
+                    istanza = valore()
+                    Loader._istanze.setdefault(istanza.get_nome(), istanza)
+                    metadati.append(MetadatiTool.da_istanza(istanza, module_name))
+            return metadati
+
+    @staticmethod
+    def _metadati_da_classe(classe: ast.ClassDef, module_name: str) -> MetadatiTool:
+        costruttore = next(n for n in classe.body if isinstance(n, ast.FunctionDef) and n.name == "__init__")
+        argomenti, attributi = {}, {}
+        for nodo in ast.walk(costruttore):
+            # super().__init__(nome=..., pacchetti_python_necessari=..., ...)
+            if (isinstance(nodo, ast.Call) and isinstance(nodo.func, ast.Attribute) and nodo.func.attr == "__init__"
+                    and isinstance(nodo.func.value, ast.Call) and getattr(nodo.func.value.func, "id", None) == "super"):
+                argomenti = {k.arg: ast.literal_eval(k.value) for k in nodo.keywords}
+            # self._param_descriptions = {...} / self._param_options = {...}
+            elif isinstance(nodo, ast.Assign):
+                for destinazione in nodo.targets:
+                    if (isinstance(destinazione, ast.Attribute) and getattr(destinazione.value, "id", None) == "self"
+                            and destinazione.attr in ("_param_descriptions", "_param_options")):
+                        attributi[destinazione.attr] = ast.literal_eval(nodo.value)
+        if "nome" not in argomenti:
+            raise ValueError(f"nome del tool non trovato nella classe {classe.name}")
+        return MetadatiTool(
+            nome=argomenti["nome"],
+            modulo=module_name,
+            classe=classe.name,
+            parametri=argomenti.get("parametri_iniziali"),
+            descrizioni=attributi.get("_param_descriptions"),
+            opzioni=attributi.get("_param_options"),
+            variabili_necessarie=argomenti.get("variabili_necessarie"),
+            pacchetti_python_necessari=argomenti.get("pacchetti_python_necessari")
+        )